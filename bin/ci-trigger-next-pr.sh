@@ -11,7 +11,11 @@ set -euo pipefail
 
 page=1
 per_page=25
-candidates='[]'
+
+# One compact JSON object per line. This is never passed as a command argument (as with jq
+# --argjson), since with a few large listing entries it would exceed the kernel's limit on the
+# size of an argument.
+candidates=''
 
 while true; do
     # Search open PRs, oldest first
@@ -32,11 +36,10 @@ while true; do
 
     echo "::endgroup::"
 
-    candidates="$(
+    candidates+="$(
         echo "$run_page" | \
-        jq --argjson candidates "$candidates" \
-            '$candidates + [.[] | select(.labels[].name == "merge-pending")]'
-    )"
+        jq -c '.[] | select(any(.labels[]; .name == "merge-pending"))'
+    )"$'\n'
 
     maybe_more="$(
         echo "$run_page" | jq --argjson per_page "$per_page" 'length == $per_page'
@@ -51,7 +54,7 @@ done
 
 echo "::group ::Located candidates"
 
-echo "Candidates: $(echo "$candidates" | jq -C 'del(.[]["head", "base"].repo) | del(.[].body)')"
+echo "Candidates: $(echo "$candidates" | jq -sC 'del(.[]["head", "base"].repo) | del(.[].body)')"
 echo
 
 echo "::endgroup::"
@@ -85,4 +88,4 @@ while IFS= read -r candidate; do
 
         rerun_triggered=1
     fi
-done <<< "$(echo "$candidates" | jq -c '.[]')"
+done <<< "$candidates"
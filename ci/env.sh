@@ -3,3 +3,9 @@ unset BASH_ENV
 
 export USER_INSTALL_DIR=$HOME/bin
 export PATH="$USER_INSTALL_DIR:$PATH"
+
+# ci-tools caps the console output of the commands it runs and archives the full output here,
+# for workflows to upload
+if [ -n "${RUNNER_TEMP:-}" ]; then
+    export CI_TOOLS_LOG_DIR="${CI_TOOLS_LOG_DIR-$RUNNER_TEMP/ci-tools-logs}"
+fi
@@ -3,17 +3,36 @@
 from __future__ import annotations
 
 import argparse
+from pathlib import Path
 import subprocess
 import sys
 import traceback
 
-from . import commands
-from .output import AnsiStyle, emit_error, print_info_line
+from . import cassette, commands
+from .output import AnsiStyle, emit_error, print_capped
 
 
 def main():
     parser = argparse.ArgumentParser(prog="ci-tools")
 
+    cassette_group = parser.add_mutually_exclusive_group()
+    cassette_group.add_argument(
+        "--record-cassette",
+        type=Path,
+        help="Record GitHub API requests and subprocess runs to the given file",
+    )
+    cassette_group.add_argument(
+        "--replay-cassette",
+        type=Path,
+        help="Serve GitHub API requests and subprocess runs from the given recording",
+    )
+    parser.add_argument(
+        "--replay-time-scale",
+        type=float,
+        default=1.0,
+        help="Multiplier for recorded durations during replay (0 to replay without delay)",
+    )
+
     subparsers = parser.add_subparsers(required=True, dest="cmd")
 
     subparsers_by_name = {}
@@ -38,16 +57,30 @@ def main():
         raise ValueError(f"unhandled command {args.cmd!r}")
 
     subcmd_args = vars(args).copy()
-    del subcmd_args["cmd"]
+    for key in ["cmd", "record_cassette", "replay_cassette", "replay_time_scale"]:
+        del subcmd_args[key]
+
+    active_cassette = None
+    if args.record_cassette is not None:
+        active_cassette = cassette.Cassette.record(args.record_cassette)
+    elif args.replay_cassette is not None:
+        active_cassette = cassette.Cassette.replay(
+            args.replay_cassette, time_scale=args.replay_time_scale
+        )
+
+    cassette.install(active_cassette)
 
     try:
         impl.run_command(**subcmd_args)
+        if active_cassette is not None:
+            active_cassette.close()
 
     except subprocess.CalledProcessError as exc:
         emit_error("fatal: unsuccessful internal command")
         if exc.stderr:
-            for line in exc.stderr.splitlines():
-                print_info_line("stderr:", line, header_style=AnsiStyle.DimWhite)
+            print_capped(
+                f"{AnsiStyle.DimWhite('stderr:')} {line}" for line in exc.stderr.splitlines()
+            )
 
         traceback.print_exception(exc, file=sys.stderr)
         sys.exit(1)
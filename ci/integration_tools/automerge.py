@@ -0,0 +1,121 @@
+"""
+Poll-side handling for pull requests labelled for automerge
+
+This mirrors bin/ci-trigger-next-pr.sh and bin/ci-rerun-pr-workflow.sh: candidates carrying the
+merge-pending label are re-evaluated, the label is dropped from pull requests which can no longer
+become eligible, and the build workflow is re-dispatched for an eligible pull request so that its
+completion triggers the merge and deploy.
+
+Label changes go through a WriteQueue supplied by the caller, which decides when to flush it;
+trigger_rerun() flushes it before dispatching, since the dispatched run reads the label.
+"""
+
+from __future__ import annotations
+
+from dataclasses import dataclass
+import json
+import os
+from typing import Literal
+
+from .gh_state import (
+    PullRequestEvaluation,
+    evaluate_pull_request_state,
+    find_pull_request_workflow_run,
+    get_github_api,
+    list_open_pull_requests,
+)
+from .gh_writes import WriteQueue
+from .output import print_info_line, print_info_multi
+
+MERGE_PENDING_LABEL = "merge-pending"
+
+RerunOutcome = Literal["dispatched", "no-prior-run", "prior-run-incomplete", "prior-run-failed"]
+
+
+@dataclass(kw_only=True)
+class CandidateReview:
+    pr_number: int
+    pr_eval: PullRequestEvaluation
+
+    @property
+    def outcome(self) -> str:
+        if not self.pr_eval.pr_may_be_eligible:
+            return "ineligible"
+        if not self.pr_eval.pr_is_eligible:
+            return "awaiting-mergeability"
+        return "eligible"
+
+
+def find_merge_pending_candidates(repo: str) -> list[int]:
+    """List open pull requests carrying the merge-pending label, oldest first"""
+    return [pr.number for pr in list_open_pull_requests(repo) if MERGE_PENDING_LABEL in pr.labels]
+
+
+def review_candidate(repo: str, pr_number: int, writes: WriteQueue) -> CandidateReview:
+    pr_eval = evaluate_pull_request_state(pr_number, repo=repo)
+
+    if not pr_eval.pr_may_be_eligible and pr_eval.merge_pending_label_present:
+        print_info_line(f"#{pr_number}", "no longer eligible for automerge")
+        set_merge_pending_label(writes, repo, pr_number, False, current_labels=pr_eval.labels)
+
+    return CandidateReview(pr_number=pr_number, pr_eval=pr_eval)
+
+
+def set_merge_pending_label(
+    writes: WriteQueue, repo: str, pr_number: int, pending: bool, *, current_labels: list[str]
+) -> None:
+    if pending:
+        writes.add_label(repo, pr_number, MERGE_PENDING_LABEL, current_labels)
+    else:
+        writes.remove_label(repo, pr_number, MERGE_PENDING_LABEL, current_labels)
+
+
+def trigger_rerun(
+    repo: str, pr_number: int, pr_eval: PullRequestEvaluation, writes: WriteQueue
+) -> RerunOutcome:
+    """Re-dispatch the build workflow for an eligible pull request"""
+    assert pr_eval.pr_is_eligible, pr_eval
+
+    workflow_run = find_pull_request_workflow_run(pr_eval, repo=repo)
+
+    if workflow_run is None:
+        print_info_line(f"#{pr_number}", "no prior workflow run matches; not triggering rerun")
+        return "no-prior-run"
+
+    if workflow_run["status"] != "completed":
+        # The pending run should converge to a merge or refute mergeability by itself; the label
+        # is a hint that the pull request is expected to become mergeable
+        print_info_line(f"#{pr_number}", "prior workflow run is not completed")
+        if not pr_eval.merge_pending_label_present:
+            set_merge_pending_label(writes, repo, pr_number, True, current_labels=pr_eval.labels)
+        return "prior-run-incomplete"
+
+    if workflow_run["conclusion"] != "success":
+        print_info_line(f"#{pr_number}", "prior workflow run was not successful")
+        return "prior-run-failed"
+
+    if not pr_eval.merge_pending_label_present:
+        set_merge_pending_label(writes, repo, pr_number, True, current_labels=pr_eval.labels)
+
+    writes.flush()
+
+    dispatch_url = f"{workflow_run['workflow_url']}/dispatches"
+    dispatch_params = json.dumps(
+        {"ref": pr_eval.head_ref, "inputs": {"pull_request_number": str(pr_number)}}
+    )
+
+    if writes.dry_run:
+        print_info_multi("post [dry-run]", dispatch_url, dispatch_params)
+        return "dispatched"
+
+    token = os.getenv("GH_BOT_TOKEN")
+    if token is None:
+        raise ValueError("GH_BOT_TOKEN environment variable not provided")
+
+    with get_github_api(
+        dispatch_url, method="POST", token=token, data=dispatch_params.encode()
+    ) as response:
+        if response.status != 204:
+            raise ValueError(f"unexpected workflow dispatch response: {response.status}")
+
+    return "dispatched"
@@ -0,0 +1,470 @@
+"""
+Record and replay GitHub API exchanges and subprocess invocations
+
+A cassette is a JSON lines file with one entry per GitHub API request or subprocess run, in the
+order they were made, together with how long each one took. Replaying a cassette serves the
+recorded results back without touching the network or the local repository, which makes it
+possible to profile the control flow of a command offline or to reproduce a slow run exactly.
+
+Values a run derives from local state other than subprocesses, such as its ref namespace or the
+lock files of abandoned runs, are recorded too, so that a replay makes the same git calls.
+
+Requests and subprocesses made from several threads at once, within a concurrent() section, are
+recorded in whatever order they finished. Their entries are tagged with the section, and a replay
+matches calls within it by kind and arguments rather than by position; the entries of a section
+all have to be used by the time it ends.
+"""
+
+from __future__ import annotations
+
+import base64
+import contextlib
+from dataclasses import dataclass, field
+from email.message import Message
+from http.client import HTTPResponse
+import io
+import json
+from pathlib import Path
+import re
+import subprocess
+import tempfile
+import threading
+import time
+from typing import IO, Any, Callable, Iterator, Literal, TypeVar
+from urllib.error import HTTPError
+from urllib.request import Request, urlopen
+
+CASSETTE_VERSION = 2
+
+# Headers which should never be written out to a cassette
+_REDACTED_HEADERS = frozenset(["authorization", "set-cookie"])
+
+# Headers which are recomputed when a response is rebuilt from its recorded body
+_FRAMING_HEADERS = frozenset(["content-length", "transfer-encoding", "content-encoding"])
+
+_VOLATILE_ARG_PATTERNS = [
+    (re.compile(re.escape(tempfile.gettempdir()) + r"/[^/\s]+"), "<tmp>"),
+    (re.compile(r"\d{4}-\d{2}-\d{2}-\d{2}-\d{2}-\d{2}"), "<timestamp>"),
+]
+
+
+Opener = Callable[[Request], HTTPResponse]
+
+T = TypeVar("T")
+
+
+class CassetteMismatchError(ValueError):
+    """Raised when a replayed run diverges from the recorded one"""
+
+
+@dataclass
+class Cassette:
+    path: Path
+    mode: Literal["record", "replay"]
+    time_scale: float = 1.0
+
+    _entries: list[dict[str, Any]] = field(default_factory=list, repr=False)
+    _cursor: int = field(default=0, repr=False)
+    _sink: IO[str] | None = field(default=None, repr=False)
+
+    # Guards everything below as well as the cursor and sink, since calls come from worker threads
+    _lock: threading.Lock = field(default_factory=threading.Lock, repr=False)
+    _sections: int = field(default=0, repr=False)
+    _section: int | None = field(default=None, repr=False)
+    _section_depth: int = field(default=0, repr=False)
+    _section_used: set[int] = field(default_factory=set, repr=False)
+
+    @staticmethod
+    def record(path: Path) -> Cassette:
+        cassette = Cassette(path=path, mode="record")
+        cassette._sink = open(path, "w", encoding="utf8")
+        cassette._write({"kind": "header", "version": CASSETTE_VERSION})
+        return cassette
+
+    @staticmethod
+    def replay(path: Path, time_scale: float = 1.0) -> Cassette:
+        if time_scale < 0:
+            raise ValueError(f"time scale must be non-negative: got {time_scale}")
+
+        entries = [json.loads(line) for line in path.read_text().splitlines() if line.strip()]
+
+        match entries:
+            case [{"kind": "header", "version": int(version)}, *rest] if (
+                version == CASSETTE_VERSION
+            ):
+                pass
+            case _:
+                raise ValueError(f"{path} is not a version {CASSETTE_VERSION} cassette")
+
+        return Cassette(path=path, mode="replay", time_scale=time_scale, _entries=rest)
+
+    def close(self) -> None:
+        with self._lock:
+            if self._sink is not None:
+                self._sink.close()
+                self._sink = None
+
+            if self.mode == "replay" and self._cursor != len(self._entries):
+                raise CassetteMismatchError(
+                    f"replay finished with {len(self._entries) - self._cursor} unused entries in "
+                    f"{self.path}"
+                )
+
+    @contextlib.contextmanager
+    def concurrent(self) -> Iterator[None]:
+        with self._lock:
+            self._section_depth += 1
+            if self._section_depth == 1:
+                self._sections += 1
+                self._section = self._sections
+
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._section_depth -= 1
+                if self._section_depth == 0:
+                    if self.mode == "replay":
+                        self._end_section()
+                    self._section = None
+
+    def open_request(self, req: Request, opener: Opener) -> HTTPResponse:
+        method = req.get_method()
+
+        if self.mode == "replay":
+            entry = self._next("http", {"method": method, "url": req.full_url})
+            if entry.get("raised"):
+                raise HTTPError(
+                    req.full_url,
+                    entry["status"],
+                    entry["reason"],
+                    _rebuild_response(req, entry).headers,
+                    io.BytesIO(_decode_body(entry)),
+                )
+            return _rebuild_response(req, entry)
+
+        start = time.monotonic()
+        try:
+            response = opener(req)
+        except HTTPError as exc:
+            body = exc.read()
+            entry = self._http_entry(req, exc.code, exc.reason, exc.headers, body, start)
+            entry["raised"] = True
+            self._write(entry)
+            raise HTTPError(req.full_url, exc.code, exc.reason, exc.headers, io.BytesIO(body))
+
+        with response:
+            body = response.read()
+
+        entry = self._http_entry(
+            req, response.status, response.reason, response.headers, body, start
+        )
+        self._write(entry)
+        return _rebuild_response(req, entry)
+
+    def run_process(
+        self,
+        args: list[str],
+        *,
+        env: dict[str, str] | None,
+        capture_output: bool,
+        timeout: float | None = None,
+        input: str | None = None,
+    ) -> subprocess.CompletedProcess[str]:
+        if self.mode == "replay":
+            entry = self._next("run", {"args": _normalize_args(args)})
+            out = subprocess.CompletedProcess(
+                args, entry["returncode"], entry["stdout"], entry["stderr"]
+            )
+        else:
+            start = time.monotonic()
+            out = _run(args, env=env, capture_output=capture_output, timeout=timeout, input=input)
+            self._write(
+                {
+                    "kind": "run",
+                    "args": _normalize_args(args),
+                    "returncode": out.returncode,
+                    "stdout": out.stdout,
+                    "stderr": out.stderr,
+                    "elapsed": time.monotonic() - start,
+                }
+            )
+
+        out.check_returncode()
+        return out
+
+    def local_value(self, name: str, compute: Callable[[], T]) -> T:
+        if self.mode == "replay":
+            value: T = self._next("value", {"name": name})["value"]
+            return value
+
+        start = time.monotonic()
+        value = compute()
+        self._write(
+            {"kind": "value", "name": name, "value": value, "elapsed": time.monotonic() - start}
+        )
+        return value
+
+    def _http_entry(
+        self,
+        req: Request,
+        status: int,
+        reason: str,
+        headers: Message,
+        body: bytes,
+        start: float,
+    ) -> dict[str, Any]:
+        try:
+            body_text, body_encoding = body.decode("utf8"), "utf8"
+        except UnicodeDecodeError:
+            body_text, body_encoding = base64.b64encode(body).decode("ascii"), "base64"
+
+        return {
+            "kind": "http",
+            "method": req.get_method(),
+            "url": req.full_url,
+            "status": status,
+            "reason": reason,
+            "headers": [[k, v] for k, v in headers.items() if k.lower() not in _REDACTED_HEADERS],
+            "body": body_text,
+            "body_encoding": body_encoding,
+            "elapsed": time.monotonic() - start,
+        }
+
+    def _next(self, kind: str, expected: dict[str, Any]) -> dict[str, Any]:
+        with self._lock:
+            if self._section is None:
+                entry = self._next_in_order(kind, expected)
+            else:
+                entry = self._next_in_section(kind, expected)
+
+        # Outside the lock, so that concurrent calls take as long together as they did recorded
+        if self.time_scale:
+            time.sleep(entry["elapsed"] * self.time_scale)
+
+        return entry
+
+    def _next_in_order(self, kind: str, expected: dict[str, Any]) -> dict[str, Any]:
+        if self._cursor >= len(self._entries):
+            raise CassetteMismatchError(f"cassette exhausted: unexpected {kind} {expected!r}")
+
+        entry = self._entries[self._cursor]
+        recorded = {k: entry.get(k) for k in expected}
+
+        if entry["kind"] != kind or recorded != expected or "section" in entry:
+            raise CassetteMismatchError(
+                f"entry {self._cursor + 1} of {self.path}: expected {entry['kind']} {recorded!r}"
+                f"{' in a concurrent section' if 'section' in entry else ''}, got {kind} {expected!r}"
+            )
+
+        self._cursor += 1
+        return entry
+
+    def _next_in_section(self, kind: str, expected: dict[str, Any]) -> dict[str, Any]:
+        for i in self._section_indexes():
+            entry = self._entries[i]
+            if (
+                i not in self._section_used
+                and entry["kind"] == kind
+                and all(entry.get(k) == v for k, v in expected.items())
+            ):
+                self._section_used.add(i)
+                return entry
+
+        raise CassetteMismatchError(
+            f"no unused entry for {kind} {expected!r} in the concurrent section starting at entry "
+            f"{self._cursor + 1} of {self.path}"
+        )
+
+    def _end_section(self) -> None:
+        indexes = self._section_indexes()
+        unused = len(indexes) - len(self._section_used)
+
+        if unused:
+            raise CassetteMismatchError(
+                f"{unused} unused entries in the concurrent section starting at entry "
+                f"{self._cursor + 1} of {self.path}"
+            )
+
+        self._cursor += len(indexes)
+        self._section_used.clear()
+
+    def _section_indexes(self) -> range:
+        """Positions of the entries recorded in the concurrent section at the cursor"""
+        end = self._cursor
+        while end < len(self._entries) and "section" in self._entries[end]:
+            if self._entries[end]["section"] != self._entries[self._cursor]["section"]:
+                break
+            end += 1
+
+        return range(self._cursor, end)
+
+    def _write(self, entry: dict[str, Any]) -> None:
+        with self._lock:
+            assert self._sink is not None, self
+
+            if self._section is not None:
+                entry["section"] = self._section
+
+            self._sink.write(json.dumps(entry) + "\n")
+            self._sink.flush()
+
+
+_active: Cassette | None = None
+
+
+def install(cassette: Cassette | None) -> None:
+    global _active
+    _active = cassette
+
+
+def replaying() -> bool:
+    """Whether a cassette is being replayed, in which case local state mustn't be changed"""
+    return _active is not None and _active.mode == "replay"
+
+
+def local_value(name: str, compute: Callable[[], T]) -> T:
+    """Compute a value from local state, or return the recorded one when replaying
+
+    The value has to be JSON-serializable, and come back from JSON as the same type.
+    """
+    if _active is not None:
+        return _active.local_value(name, compute)
+
+    return compute()
+
+
+@contextlib.contextmanager
+def concurrent() -> Iterator[None]:
+    """Mark a section in which requests and subprocesses are made from several threads
+
+    Sections can nest, as when a concurrent task flushes a write queue; the outermost one counts.
+    """
+    if _active is None:
+        yield
+        return
+
+    with _active.concurrent():
+        yield
+
+
+def open_request(req: Request, opener: Opener | None = None) -> HTTPResponse:
+    opener = opener or _urlopen
+
+    if _active is not None:
+        return _active.open_request(req, opener)
+
+    return opener(req)
+
+
+def _urlopen(req: Request) -> HTTPResponse:
+    response = urlopen(req)
+
+    if not isinstance(response, HTTPResponse):
+        raise TypeError(f"unexpected response type for request to {req.full_url}: {response!r}")
+
+    return response
+
+
+def run_process(
+    args: list[str],
+    *,
+    env: dict[str, str] | None = None,
+    capture_output: bool = True,
+    timeout: float | None = None,
+    input: str | None = None,
+) -> subprocess.CompletedProcess[str]:
+    if _active is not None:
+        return _active.run_process(
+            args, env=env, capture_output=capture_output, timeout=timeout, input=input
+        )
+
+    out = _run(args, env=env, capture_output=capture_output, timeout=timeout, input=input)
+    out.check_returncode()
+    return out
+
+
+# Time a process which has timed out is given to exit after SIGTERM before it's killed
+_TERMINATE_GRACE_SECONDS = 10
+
+
+def _run(
+    args: list[str],
+    *,
+    env: dict[str, str] | None,
+    capture_output: bool,
+    timeout: float | None,
+    input: str | None,
+) -> subprocess.CompletedProcess[str]:
+    """Like subprocess.run without check, but stops a timed-out process with SIGTERM first
+
+    subprocess.run kills a process which times out outright, which would leave git's lock files
+    behind for the retry to trip over; git removes them when it's terminated.
+    """
+    pipe = subprocess.PIPE if capture_output else None
+
+    with subprocess.Popen(
+        args,
+        stdin=subprocess.PIPE if input is not None else None,
+        stdout=pipe,
+        stderr=pipe,
+        encoding="utf8",
+        env=env,
+    ) as process:
+        try:
+            stdout, stderr = process.communicate(input, timeout=timeout)
+        except subprocess.TimeoutExpired:
+            process.terminate()
+            output: tuple[str | None, str | None]
+            try:
+                output = process.communicate(timeout=_TERMINATE_GRACE_SECONDS)
+            except subprocess.TimeoutExpired:
+                # Output isn't waited for, since a surviving grandchild may hold the pipes open
+                process.kill()
+                output = (None, None)
+
+            assert timeout is not None
+            raise subprocess.TimeoutExpired(args, timeout, output=output[0], stderr=output[1])
+
+    return subprocess.CompletedProcess(args, process.returncode, stdout, stderr)
+
+
+def _normalize_args(args: list[str]) -> list[str]:
+    normalized = []
+    for arg in args:
+        for pattern, replacement in _VOLATILE_ARG_PATTERNS:
+            arg = pattern.sub(replacement, arg)
+        normalized.append(arg)
+    return normalized
+
+
+class _ReplaySocket:
+    def __init__(self, data: bytes) -> None:
+        self._data = data
+
+    def makefile(self, mode: str) -> io.BytesIO:
+        return io.BytesIO(self._data)
+
+
+def _decode_body(entry: dict[str, Any]) -> bytes:
+    match entry["body_encoding"]:
+        case "utf8":
+            return entry["body"].encode("utf8")
+        case "base64":
+            return base64.b64decode(entry["body"])
+        case other:
+            raise ValueError(f"unexpected body encoding {other!r}")
+
+
+def _rebuild_response(req: Request, entry: dict[str, Any]) -> HTTPResponse:
+    body = _decode_body(entry)
+
+    head = [f"HTTP/1.1 {entry['status']} {entry['reason']}"]
+    head.extend(f"{k}: {v}" for k, v in entry["headers"] if k.lower() not in _FRAMING_HEADERS)
+    head.append(f"Content-Length: {len(body)}")
+
+    raw = ("\r\n".join(head) + "\r\n\r\n").encode("latin-1") + body
+
+    response = HTTPResponse(_ReplaySocket(raw), method=req.get_method())  # type: ignore[arg-type]
+    response.begin()
+    return response
@@ -1,5 +1,21 @@
-from . import deploy_commit
+from . import (
+    bench_poll,
+    deploy_commit,
+    fleet,
+    listen,
+    maintain_repo,
+    metrics,
+    rollback,
+    site_manifest,
+)
 
 SUBCOMMAND_IMPLS = [
+    bench_poll,
     deploy_commit,
+    fleet,
+    listen,
+    maintain_repo,
+    metrics,
+    rollback,
+    site_manifest,
 ]
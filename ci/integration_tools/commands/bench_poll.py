@@ -0,0 +1,513 @@
+"""Benchmark pull request polling against a synthetic GitHub API
+
+For each requested size, a repository with that many open pull requests is generated and served
+locally (see synthetic_github for the mix of labels, reviews, author associations and
+mergeability), and poll cycles are run against it with each client:
+
+- python: the automerge module as the fleet and listen commands use it, evaluating candidates
+  with gh_state.evaluate_pull_request_state
+- shell: bin/ci-trigger-next-pr.sh, as the poll-mergeable-pr workflow runs it
+
+Each cycle runs in a fresh process. The first starts with an empty evaluation cache and later ones
+reuse what earlier ones stored, as consecutive poller runs sharing a cache would. A cycle's wall
+time, requests by route, peak RSS (of the largest process in the client's process tree) and time
+per evaluated pull request are recorded in a SQLite database (bench-poll.sqlite3 in
+$CI_TOOLS_CACHE_DIR, or --db) and compared with the last recorded run of the same configuration.
+"""
+
+from __future__ import annotations
+
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import contextlib
+from dataclasses import asdict, dataclass
+import json
+import os
+from pathlib import Path
+import sqlite3
+import subprocess
+import tempfile
+import time
+import traceback
+from typing import Any, Callable, Iterator
+
+from .. import automerge, metrics
+from ..gh_writes import WriteQueue
+from ..output import emit_summary, emit_warning, print_info_line
+from ..synthetic_github import SyntheticRepoSpec, request_counts, running_server
+from ..utils import cache_dir, run
+
+REPO_ROOT = Path(__file__).parent.parent.parent.parent
+
+DEFAULT_SIZES = [250, 1000]
+
+CLIENTS = ["python", "shell"]
+
+
+def parse_mix(value: str) -> dict[str, float]:
+    try:
+        return {
+            name.strip(): float(weight)
+            for name, weight in (item.split("=", maxsplit=1) for item in value.split(","))
+        }
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"expected NAME=WEIGHT,...: {value!r}")
+
+
+def fraction(value: str) -> float:
+    if not 0 <= (result := float(value)) <= 1:
+        raise argparse.ArgumentTypeError(f"expected a fraction between 0 and 1: {value!r}")
+    return result
+
+
+def init_parser(parser: argparse.ArgumentParser) -> None:
+    defaults = SyntheticRepoSpec()
+
+    parser.add_argument(
+        "--prs",
+        dest="sizes",
+        type=int,
+        action="append",
+        help="Number of open pull requests; may be given multiple times "
+        f"(default: {', '.join(map(str, DEFAULT_SIZES))})",
+    )
+    parser.add_argument(
+        "--client",
+        dest="clients",
+        choices=CLIENTS,
+        action="append",
+        help="Poller to benchmark; may be given multiple times (default: python)",
+    )
+    parser.add_argument("--cycles", type=int, default=2, help="Poll cycles per size and client")
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Concurrent evaluations in the python client (default: %(default)s)",
+    )
+    parser.add_argument("--automerge", type=fraction, default=defaults.automerge)
+    parser.add_argument("--merge-pending", type=fraction, default=defaults.merge_pending)
+    parser.add_argument("--drafts", type=fraction, default=defaults.drafts)
+    parser.add_argument("--null-mergeable", type=fraction, default=defaults.null_mergeable)
+    parser.add_argument("--conflicting", type=fraction, default=defaults.conflicting)
+    parser.add_argument("--max-reviews", type=int, default=defaults.max_reviews)
+    parser.add_argument(
+        "--author-mix",
+        type=parse_mix,
+        default=defaults.author_mix,
+        help="Relative weights of author associations, as NAME=WEIGHT,...",
+    )
+    parser.add_argument(
+        "--review-mix",
+        type=parse_mix,
+        default=defaults.review_mix,
+        help="Relative weights of review states, as NAME=WEIGHT,...",
+    )
+    parser.add_argument("--seed", type=int, default=defaults.seed)
+    parser.add_argument(
+        "--db",
+        type=Path,
+        help="Results database (default: bench-poll.sqlite3 in $CI_TOOLS_CACHE_DIR)",
+    )
+    parser.add_argument("--label", help="Name to record the results under")
+    parser.add_argument(
+        "--baseline",
+        help="Label of the run to compare with (default: the last run of the same configuration)",
+    )
+    parser.add_argument("--verbose", action="store_true", help="Show the clients' output")
+
+
+@dataclass(kw_only=True)
+class BenchPollParams:
+    sizes: list[int] | None
+    clients: list[str] | None
+    cycles: int
+    workers: int
+    automerge: float
+    merge_pending: float
+    drafts: float
+    null_mergeable: float
+    conflicting: float
+    max_reviews: int
+    author_mix: dict[str, float]
+    review_mix: dict[str, float]
+    seed: int
+    db: Path | None
+    label: str | None
+    baseline: str | None
+    verbose: bool
+
+    def spec(self, prs: int) -> SyntheticRepoSpec:
+        return SyntheticRepoSpec(
+            prs=prs,
+            automerge=self.automerge,
+            merge_pending=self.merge_pending,
+            drafts=self.drafts,
+            null_mergeable=self.null_mergeable,
+            conflicting=self.conflicting,
+            max_reviews=self.max_reviews,
+            author_mix=self.author_mix,
+            review_mix=self.review_mix,
+            seed=self.seed,
+        )
+
+    def config(self) -> str:
+        """Everything but the sizes and clients which affects the results, for comparisons"""
+        spec = asdict(self.spec(0))
+        del spec["prs"]
+        return json.dumps({**spec, "workers": self.workers}, sort_keys=True)
+
+
+@dataclass(kw_only=True)
+class CycleResult:
+    client: str
+    prs: int
+    cycle: int
+    seconds: float
+    requests: dict[str, int]
+    max_rss_kib: int
+    evaluations: list[float]
+    """Seconds taken by each evaluation, where the client allows timing them"""
+    error: str | None = None
+
+    @property
+    def total_requests(self) -> int:
+        return sum(n for route, n in self.requests.items() if route != "not modified")
+
+    @property
+    def evaluated(self) -> int:
+        return self.requests.get("GET get pull", 0)
+
+
+def run_command(**kwargs) -> None:
+    params = BenchPollParams(**kwargs)
+
+    if params.db is not None:
+        store = BenchStore(params.db)
+    elif (root := cache_dir()) is not None:
+        store = BenchStore(root / "bench-poll.sqlite3")
+    else:
+        raise ValueError("--db is required when CI_TOOLS_CACHE_DIR is not set")
+
+    results = []
+
+    for prs in params.sizes or DEFAULT_SIZES:
+        spec = params.spec(prs)
+
+        for client in params.clients or ["python"]:
+            # Clients change labels as they go, so each starts from a freshly generated repository
+            with (
+                running_server(spec) as url,
+                tempfile.TemporaryDirectory(prefix="bench-poll.") as client_cache,
+            ):
+                env = {
+                    "GITHUB_API_URL": url,
+                    "GITHUB_REPOSITORY": spec.repo,
+                    "GH_TOKEN": "bench",
+                    "GH_BOT_TOKEN": "bench",
+                    "CI_TOOLS_CACHE_DIR": client_cache,
+                    "CI_TOOLS_LOG_DIR": "",
+                }
+
+                for cycle in range(1, params.cycles + 1):
+                    request_counts(url, reset=True)
+                    result = run_cycle(params, spec, client, cycle, env)
+                    result.requests = dict(request_counts(url))
+                    results.append(result)
+
+                    # A client failing at a size is a result, but later cycles would only
+                    # repeat it
+                    if result.error is not None:
+                        emit_warning(f"{client} {prs} PRs cycle {cycle}: {result.error}")
+                        break
+
+                    print_info_line(
+                        f"{client} {prs} PRs cycle {cycle}",
+                        f"{result.seconds:.2f}s, {result.total_requests} requests, "
+                        f"peak RSS {result.max_rss_kib / 1024:.1f} MiB",
+                    )
+
+    revision = None
+    with contextlib.suppress(subprocess.CalledProcessError):
+        revision = run(["git", "-C", str(REPO_ROOT), "describe", "--always", "--dirty"]).strip()
+
+    run_id = store.record(params.config(), params.label, revision, results)
+    baseline = store.baseline(params.config(), run_id, label=params.baseline)
+
+    emit_summary(render_table(results, baseline), title="Poll benchmark")
+
+
+def run_cycle(
+    params: BenchPollParams, spec: SyntheticRepoSpec, client: str, cycle: int, env: dict[str, str]
+) -> CycleResult:
+    error = None
+
+    match client:
+        case "python":
+            outcome, max_rss_kib = _in_child(
+                lambda: _python_cycle(spec.repo, params.workers), env, verbose=params.verbose
+            )
+            seconds, evaluations = outcome["seconds"], outcome["evaluations"]
+
+        case "shell":
+            output = None if params.verbose else subprocess.DEVNULL
+            start = time.perf_counter()
+
+            proc = subprocess.Popen(
+                [str(REPO_ROOT / "bin" / "ci-trigger-next-pr.sh")],
+                cwd=REPO_ROOT,
+                env={**os.environ, **env},
+                stdout=output,
+                stderr=output,
+            )
+            _, status, usage = os.wait4(proc.pid, 0)
+            proc.returncode = os.waitstatus_to_exitcode(status)
+
+            seconds = time.perf_counter() - start
+            if proc.returncode != 0:
+                error = f"exited with status {proc.returncode}"
+
+            max_rss_kib, evaluations = usage.ru_maxrss, []
+
+        case _:
+            raise ValueError(f"unknown client {client!r}")
+
+    return CycleResult(
+        client=client,
+        prs=spec.prs,
+        cycle=cycle,
+        seconds=seconds,
+        requests={},
+        max_rss_kib=max_rss_kib,
+        evaluations=evaluations,
+        error=error,
+    )
+
+
+def _python_cycle(repo: str, workers: int) -> dict[str, Any]:
+    writes = WriteQueue()
+    start = time.perf_counter()
+
+    def review(pr_number: int) -> tuple[automerge.CandidateReview, float]:
+        review_start = time.perf_counter()
+        review = automerge.review_candidate(repo, pr_number, writes)
+        return review, time.perf_counter() - review_start
+
+    candidates = automerge.find_merge_pending_candidates(repo)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        reviews = list(executor.map(review, candidates))
+
+    # As the poller does, only the oldest eligible pull request is re-run
+    for candidate, _ in reviews:
+        if candidate.outcome == "eligible":
+            automerge.trigger_rerun(repo, candidate.pr_number, candidate.pr_eval, writes)
+            break
+
+    writes.flush(check=False)
+
+    return {
+        "seconds": time.perf_counter() - start,
+        "evaluations": [seconds for _, seconds in reviews],
+    }
+
+
+def _in_child(
+    fn: Callable[[], dict[str, Any]], env: dict[str, str], verbose: bool
+) -> tuple[dict[str, Any], int]:
+    """Run fn in a forked process, returning its result and the peak RSS of its process tree
+
+    Forking gives each cycle a fresh process, whose peak RSS isn't inflated by earlier cycles,
+    and which starts with nothing cached in memory.
+    """
+    read_fd, write_fd = os.pipe()
+
+    outcome: dict[str, Any]
+
+    if (pid := os.fork()) == 0:
+        os.close(read_fd)
+        try:
+            os.environ.update(env)
+            if not verbose:
+                os.dup2(os.open(os.devnull, os.O_WRONLY), 2)
+
+            outcome = {"result": fn()}
+        except BaseException:
+            outcome = {"error": traceback.format_exc()}
+
+        with os.fdopen(write_fd, "w") as f:
+            json.dump(outcome, f)
+        os._exit(0)
+
+    os.close(write_fd)
+    with os.fdopen(read_fd) as f:
+        outcome = json.loads(f.read() or "{}")
+
+    _, _, usage = os.wait4(pid, 0)
+
+    if "result" not in outcome:
+        raise RuntimeError(f"benchmark cycle failed:\n{outcome.get('error', 'no result')}")
+
+    return outcome["result"], usage.ru_maxrss
+
+
+def render_table(
+    results: list[CycleResult], baseline: dict[tuple[str, int, int], sqlite3.Row]
+) -> str:
+    rows = [
+        "| Client | PRs | Cycle | Time | Requests (304) | Peak RSS | Per PR | Eval p50 / p95 |",
+        "| --- | --- | --- | --- | --- | --- | --- | --- |",
+    ]
+
+    for result in results:
+        prior = baseline.get((result.client, result.prs, result.cycle))
+
+        if result.error is not None:
+            rows.append(
+                f"| {result.client} | {result.prs} | {result.cycle} | failed: {result.error} "
+                "| - | - | - | - |"
+            )
+            continue
+
+        time_cell = f"{result.seconds:.2f} s" + _change(result.seconds, prior, "seconds")
+        requests_cell = (
+            f"{result.total_requests} ({result.requests.get('not modified', 0)})"
+            + _change(result.total_requests, prior, "requests")
+        )
+        rss_cell = f"{result.max_rss_kib / 1024:.1f} MiB" + _change(
+            result.max_rss_kib, prior, "max_rss_kib"
+        )
+
+        per_pr = f"{result.seconds / result.evaluated * 1000:.1f} ms" if result.evaluated else "-"
+
+        evals = "-"
+        if result.evaluations:
+            p50, p95 = (metrics.percentile(result.evaluations, q) for q in (0.5, 0.95))
+            evals = f"{p50 * 1000:.1f} / {p95 * 1000:.1f} ms"
+
+        rows.append(
+            f"| {result.client} | {result.prs} | {result.cycle} | {time_cell} | {requests_cell} "
+            f"| {rss_cell} | {per_pr} | {evals} |"
+        )
+
+    if not baseline:
+        rows.extend(["", "No earlier run of this configuration to compare with."])
+
+    return "\n".join(rows)
+
+
+def _change(value: float, prior: sqlite3.Row | None, column: str) -> str:
+    if prior is None or prior["error"] is not None or not prior[column]:
+        return ""
+    return f" ({(value - prior[column]) / prior[column]:+.0%})"
+
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY,
+    started_at REAL NOT NULL,
+    label TEXT,
+    revision TEXT,
+    config TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS cycles (
+    run_id INTEGER NOT NULL REFERENCES runs (id) ON DELETE CASCADE,
+    client TEXT NOT NULL,
+    prs INTEGER NOT NULL,
+    cycle INTEGER NOT NULL,
+    seconds REAL NOT NULL,
+    requests INTEGER NOT NULL,
+    not_modified INTEGER NOT NULL,
+    routes TEXT NOT NULL,
+    max_rss_kib INTEGER NOT NULL,
+    evaluated INTEGER NOT NULL,
+    eval_p50 REAL,
+    eval_p95 REAL,
+    eval_max REAL,
+    error TEXT,
+    PRIMARY KEY (run_id, client, prs, cycle)
+);
+"""
+
+
+class BenchStore:
+    def __init__(self, path: Path) -> None:
+        self.path = path
+
+    def record(
+        self, config: str, label: str | None, revision: str | None, results: list[CycleResult]
+    ) -> int:
+        with self._connect() as db:
+            cursor = db.execute(
+                "INSERT INTO runs (started_at, label, revision, config) VALUES (?, ?, ?, ?)",
+                (time.time(), label, revision, config),
+            )
+            assert cursor.lastrowid is not None
+            run_id = cursor.lastrowid
+
+            db.executemany(
+                "INSERT INTO cycles (run_id, client, prs, cycle, seconds, requests, not_modified, "
+                "routes, max_rss_kib, evaluated, eval_p50, eval_p95, eval_max, error) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                [
+                    (
+                        run_id,
+                        r.client,
+                        r.prs,
+                        r.cycle,
+                        r.seconds,
+                        r.total_requests,
+                        r.requests.get("not modified", 0),
+                        json.dumps(r.requests, sort_keys=True),
+                        r.max_rss_kib,
+                        r.evaluated,
+                        *(
+                            (metrics.percentile(r.evaluations, q) for q in (0.5, 0.95, 1.0))
+                            if r.evaluations
+                            else (None, None, None)
+                        ),
+                        r.error,
+                    )
+                    for r in results
+                ],
+            )
+
+        return run_id
+
+    def baseline(
+        self, config: str, run_id: int, label: str | None = None
+    ) -> dict[tuple[str, int, int], sqlite3.Row]:
+        """Cycles of the latest earlier run with the label, or else with the same configuration"""
+        with self._connect() as db:
+            if label is not None:
+                prior = db.execute(
+                    "SELECT id FROM runs WHERE label = ? AND id != ? ORDER BY id DESC LIMIT 1",
+                    (label, run_id),
+                ).fetchone()
+            else:
+                prior = db.execute(
+                    "SELECT id FROM runs WHERE config = ? AND id < ? ORDER BY id DESC LIMIT 1",
+                    (config, run_id),
+                ).fetchone()
+
+            if prior is None:
+                return {}
+
+            return {
+                (row["client"], row["prs"], row["cycle"]): row
+                for row in db.execute("SELECT * FROM cycles WHERE run_id = ?", (prior["id"],))
+            }
+
+    @contextlib.contextmanager
+    def _connect(self) -> Iterator[sqlite3.Connection]:
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+
+        db = sqlite3.connect(self.path, timeout=30)
+        try:
+            db.row_factory = sqlite3.Row
+            db.execute("PRAGMA foreign_keys = ON")
+            db.executescript(_SCHEMA)
+            with db:
+                yield db
+        finally:
+            db.close()
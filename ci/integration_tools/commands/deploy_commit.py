@@ -3,44 +3,74 @@
 from __future__ import annotations
 
 import argparse
-from contextlib import contextmanager
-from dataclasses import dataclass
+import contextlib
+from dataclasses import dataclass, field
 from datetime import datetime
 import json
 import os
 from pathlib import Path
 import shlex
+import sqlite3
+import subprocess
 import sys
+import tempfile
 from typing import Any, Literal
 
-from ..merge_deploy import merge_prep, revision_info
+from .. import (
+    cassette,
+    deadlines,
+    gh_writes,
+    leases,
+    metrics,
+    object_cache,
+    repo_maintenance,
+)
+from ..merge_deploy import (
+    manifest,
+    merge_prep,
+    revision_info,
+    site_stamps,
+    sourcemaps,
+    speculation,
+    tree_copy,
+)
+from ..merge_deploy.manifest import Manifest, ManifestEntry
 from ..merge_deploy.revision_info import RevisionInfo
+from ..merge_deploy.speculation import SpeculationKey, SpeculativeCommits
+from ..repo_maintenance import ObjectStoreStats
 
 from ..gh_state import (
-    REPO,
     PullRequestEvaluation,
-    add_label,
+    compare_commits,
+    default_repo,
     evaluate_pull_request_state,
-    get_github_api,
-    remove_label,
+    find_workflow_run,
+    wait_for_mergeability,
 )
 from ..output import (
     emit_error,
     emit_notice,
     emit_summary,
     emit_warning,
-    enter_log_group,
     log_group,
     print_info_line,
-    print_info_multi,
 )
 from ..utils import resolve_commit, run, temporary_worktree, validate_branch_ref
 
 REPO_ROOT = Path(__file__).parent.parent.parent.parent
 
+# Long enough for a cold fetch of master, short enough that a stalled run doesn't hold up the
+# pull requests queued behind it
+DEFAULT_DEADLINE_SECONDS = 20 * 60
+
 
 def init_parser(parser: argparse.ArgumentParser) -> None:
     parser.add_argument("--remote", default="origin")
+    parser.add_argument(
+        "--repo",
+        default=default_repo(),
+        help="GitHub repository as owner/name (default: $GITHUB_REPOSITORY)",
+    )
     parser.add_argument("--base-ref", required=True)
     parser.add_argument("--head-ref", required=True)
     parser.add_argument("--effective-event", required=True, choices=["pull_request", "push"])
@@ -50,15 +80,55 @@ def init_parser(parser: argparse.ArgumentParser) -> None:
     parser.add_argument(
         "--deploy-revision-info", help="File describing the revision to be deployed", type=Path
     )
+    parser.add_argument(
+        "--deploy-manifest",
+        help="Manifest written by site-manifest for the deploy directory, which is verified "
+        "before committing and whose blob IDs are reused to build the deploy tree",
+        type=Path,
+    )
     parser.add_argument(
         "--outputs-file", help="File where step output should be written", type=Path
     )
+    parser.add_argument(
+        "--metrics-file",
+        type=Path,
+        help="Append the run's metrics to this JSON lines file instead of recording them in the "
+        "database in $CI_TOOLS_CACHE_DIR",
+    )
+    parser.add_argument(
+        "--speculative",
+        action="store_true",
+        help="Prepare merge and deploy commits for a pull request which may become eligible, "
+        "storing them for reuse by a later run instead of pushing",
+    )
+    parser.add_argument(
+        "--local-merge",
+        action="store_true",
+        help="When GitHub's merge ref is stale, merge the pull request locally and deploy that "
+        "if it matches the built tree, instead of requesting a branch update",
+    )
+    parser.add_argument(
+        "--mergeability-wait",
+        type=float,
+        default=0,
+        metavar="SECONDS",
+        help="If GitHub is still computing whether the pull request can be merged, wait up to "
+        "this long for it instead of stopping (default: don't wait)",
+    )
+    parser.add_argument(
+        "--deadline",
+        type=float,
+        default=DEFAULT_DEADLINE_SECONDS,
+        help="Seconds after which no further network operations are started, and to which "
+        "running ones are limited (default: %(default)s)",
+    )
     parser.add_argument("--dry-run", action="store_true")
 
 
 @dataclass(kw_only=True)
 class DeployParams:
     remote: str
+    repo: str
     head_ref: str
     base_ref: str
     effective_event: Literal["pull_request", "push"]
@@ -66,8 +136,21 @@ class DeployParams:
     run_url: str
     deploy_dir: Path | None
     deploy_revision_info: Path | None
+    deploy_manifest: Path | None
     outputs_file: Path | None
+    metrics_file: Path | None
+    speculative: bool
+    local_merge: bool
+    mergeability_wait: float
+    deadline: float
     dry_run: bool
+    namespace: str = "refs"
+    """Ref namespace holding the refs this run fetches and prepares"""
+    writes: gh_writes.WriteQueue = field(init=False)
+    """Label changes, approvals and branch updates for the pull request, sent at flush points"""
+
+    def __post_init__(self) -> None:
+        self.writes = gh_writes.WriteQueue(dry_run=self.dry_run)
 
     def allows_pages_deploy(self) -> bool:
         return (
@@ -88,14 +171,66 @@ class DeployParams:
         with open(self.outputs_file, "a", encoding="utf8") as f:
             f.write(f"{name}={value}\n")
 
+    def local_ref(self, ref: str) -> str:
+        """Name of this run's own copy of a ref"""
+        return f"{self.namespace}/{ref.removeprefix('refs/')}"
+
+    def remote_branch_ref(self, branch: str) -> str:
+        return self.local_ref(f"refs/remotes/{self.remote}/{branch}")
+
+    @property
+    def master_ref(self) -> str:
+        """The local master branch, which points at the deploy commit once it's prepared"""
+        return self.local_ref("refs/heads/master")
+
 
 def run_command(**kwargs) -> None:
     params = DeployParams(**kwargs)
 
+    cache = object_cache.default_cache()
+    recorder = metrics.RunRecorder(
+        repo=params.repo, event=params.effective_event, pr_number=params.pr_number
+    )
+
+    try:
+        with (
+            metrics.recording(recorder),
+            deadlines.budget(params.deadline),
+            cache.attached() if cache is not None else contextlib.nullcontext(),
+            leases.run_namespace() as namespace,
+            gh_writes.flushing(params.writes),
+        ):
+            params.namespace = namespace
+            deploy(params)
+    finally:
+        record_metrics(params, recorder)
+
+
+def record_metrics(params: DeployParams, recorder: metrics.RunRecorder) -> None:
+    # Dry runs skip the pushes and Sentry calls, and replayed runs have the recorded timings, so
+    # neither is comparable
+    if params.dry_run or cassette.replaying():
+        return
+
+    try:
+        if params.metrics_file is not None:
+            metrics.append_record(params.metrics_file, recorder)
+        elif (store := metrics.default_store()) is not None:
+            store.record(recorder)
+    except (OSError, sqlite3.Error) as exc:
+        emit_warning(f"failed to record deploy metrics: {exc!r}")
+
+
+def deploy(params: DeployParams) -> None:
     validate_branch_ref(params.head_ref)
     validate_branch_ref(params.base_ref)
 
+    if params.deploy_manifest is not None and params.deploy_dir is None:
+        raise ValueError("--deploy-manifest requires --deploy-dir")
+
     push_ref: str
+    speculation_key: SpeculationKey | None = None
+    prepared: SpeculativeCommits | None = None
 
     match params:
         case DeployParams(
@@ -115,12 +250,16 @@ def run_command(**kwargs) -> None:
             if pr_number is not None:
                 raise ValueError("--pr-number is not allowed when effective event is push")
 
+            if params.speculative:
+                raise ValueError("--speculative is only supported for pull_request events")
+
             if head_ref != base_ref:
                 raise ValueError(
                     f"head ref and base ref for push deploys should match: got {head_ref} and {base_ref}"
                 )
 
             if not params.allows_pages_deploy():
+                metrics.set_outcome("nothing-to-do")
                 emit_summary("Nothing to do for push to", params.base_ref)
                 return
 
@@ -133,6 +272,7 @@ def run_command(**kwargs) -> None:
         emit_summary("release", release_version)
 
         if not has_consistent_release_version(params, release_version=release_version):
+            metrics.set_outcome("stale")
             params.record_output("stale", "true")
             return
 
@@ -140,13 +280,34 @@ def run_command(**kwargs) -> None:
         case "pull_request":
             assert pr_number is not None  # Checked above
 
-            pr_eval = evaluate_pull_request_state(pr_number)
+            with metrics.phase("evaluate"):
+                pr_eval = evaluate_pull_request_state(pr_number, repo=params.repo)
+
+            # A speculative run prepares its commits whether or not the pull request turns out to
+            # be mergeable, so it has no reason to wait
+            if (
+                pr_eval.mergeability_pending
+                and params.mergeability_wait > 0
+                and not params.speculative
+            ):
+                with metrics.phase("mergeability"):
+                    pr_eval, waited = wait_for_mergeability(
+                        pr_number, pr_eval, repo=params.repo, timeout=params.mergeability_wait
+                    )
+
+                params.record_output("mergeability_wait", f"{waited:.1f}")
+
             params.record_output("pr_eval", json.dumps(json.loads(pr_eval.raw)))
 
             if pr_eval.pr_may_be_eligible != pr_eval.merge_pending_label_present:
-                update_pull_request_merge_pending_label(params, pr_eval.pr_may_be_eligible)
+                update_pull_request_merge_pending_label(
+                    params, pr_eval.pr_may_be_eligible, current_labels=pr_eval.labels
+                )
 
-            if not pr_eval.pr_is_eligible:
+            if not pr_eval.pr_is_eligible and not (
+                params.speculative and pr_eval.pr_may_be_eligible
+            ):
+                metrics.set_outcome("ineligible")
                 params.record_output("stale", "true")
                 emit_summary("Pull request", pr_number, "is not currently eligible to merge")
                 return
@@ -154,39 +315,59 @@ def run_command(**kwargs) -> None:
             fetch_deploy_refs(params)
 
             merge_ref = merge_prep.pull_request_merge_ref(pr_number)
-            run(["git", "fetch", "--no-tags", "--", remote, f"+{merge_ref}:{merge_ref}"])
 
             current_revs = RevisionInfo(
                 base_ref=base_ref,
-                base_sha=resolve_commit(f"refs/remotes/{remote}/{base_ref}"),
+                base_sha=resolve_commit(params.remote_branch_ref(base_ref)),
                 head_ref=head_ref,
-                head_sha=resolve_commit(f"refs/remotes/{remote}/{head_ref}"),
-                merge_sha=resolve_commit(merge_ref),
+                head_sha=resolve_commit(params.remote_branch_ref(head_ref)),
+                merge_sha=resolve_commit(params.local_ref(merge_ref)),
             )
 
             stale = not pull_request_revisions_up_to_date(
                 params, pr_eval=pr_eval, current=current_revs
             )
-            params.record_output("stale", json.dumps(stale))
 
-            if stale:
-                trigger_pull_request_merge_update(params)
+            local_merge_sha = None
+            if stale and params.local_merge and not params.speculative:
+                local_merge_sha = prepare_local_merge_commit(params, pr_eval, current=current_revs)
+
+            params.record_output("stale", json.dumps(stale and local_merge_sha is None))
+
+            if local_merge_sha is not None:
+                params.record_output("local_merge", "true")
+                push_sha = local_merge_sha
+
+            elif stale:
+                metrics.set_outcome("stale")
+                if not params.speculative:
+                    trigger_pull_request_merge_update(params)
                 return
 
-            with enter_log_group("Prepare merge commit"):
-                push_ref = f'merge.{pr_number}.{head_ref.replace("/", "-")}.{datetime.utcnow().strftime("%Y-%m-%d-%H-%M-%S")}'
-
-                with temporary_worktree(merge_ref, args=["-b", push_ref]) as worktree_dir:
-                    merge_prep.rewrite_pull_request_merge_commit_message(
-                        pr_number,
-                        pr_eval,
-                        global_git_args=[
-                            f"--git-dir={worktree_dir}/.git",
-                            f"--work-tree={worktree_dir}",
-                        ],
+            else:
+                assert current_revs.base_sha is not None and current_revs.merge_sha is not None
+
+                speculation_key = SpeculationKey(
+                    pr_number=pr_number,
+                    head_sha=current_revs.head_sha,
+                    base_sha=current_revs.base_sha,
+                    merge_sha=current_revs.merge_sha,
+                    master_sha=(
+                        resolve_commit(params.remote_branch_ref("master"))
+                        if params.allows_pages_deploy()
+                        else None
+                    ),
+                )
+
+                if not params.speculative:
+                    prepared = speculation.lookup(
+                        remote, speculation_key, namespace=params.namespace
                     )
 
-                push_sha = resolve_commit(push_ref)
+                if prepared is not None:
+                    push_sha = prepared.merge_commit
+                else:
+                    push_sha = prepare_merge_commit(params, pr_eval)
 
         case "push":
             push_ref, push_sha = head_ref, resolve_commit(head_ref)
@@ -197,10 +378,20 @@ def run_command(**kwargs) -> None:
             params.record_output("stale", json.dumps(stale))
 
             if stale:
+                metrics.set_outcome("stale")
                 return
 
-            match find_prior_deploy(params, push_sha=push_sha):
+            with metrics.phase("evaluate"):
+                prior_deploy = find_prior_deploy(params, push_sha=push_sha)
+                superseding_push = (
+                    find_superseding_push(params, push_sha=push_sha)
+                    if prior_deploy is None
+                    else None
+                )
+
+            match prior_deploy:
                 case (commit, tag):
+                    metrics.set_outcome("already-deployed")
                     emit_summary(
                         f"Source commit for {head_ref} ({push_sha}) already deployed via {commit} ({tag})"
                     )
@@ -208,26 +399,112 @@ def run_command(**kwargs) -> None:
                 case other:
                     assert other is None, repr(other)
 
+            match superseding_push:
+                case (newer_sha, workflow_run):
+                    metrics.set_outcome("superseded")
+                    params.record_output("superseded", "true")
+                    emit_summary(
+                        f"Push of {push_sha} to {head_ref} is superseded by {newer_sha}, which is",
+                        f"being deployed via {workflow_run['html_url']}; skipping deploy",
+                    )
+                    return
+                case other:
+                    assert other is None, repr(other)
+
             fetch_deploy_refs(params)
 
         case _:
             raise ValueError(f"unexpected effective event {params.effective_event!r}")
 
-    deploy_number = deploy_tag = None
+    deploy_number = deploy_tag = deploy_tree = deploy_commit = None
     if params.allows_pages_deploy():
-        deploy_number, deploy_tag = prepare_deploy_commit(params, push_sha=push_sha)
+        remote_master = params.remote_branch_ref("master")
+        deploy_number = next_deploy_number(remote_master)
+
+        if prepared is not None and prepared.deploy_commit is not None:
+            deploy_commit = prepared.deploy_commit
+            deploy_tree = tree_of(deploy_commit)
+        else:
+            site_manifest = (
+                verify_deploy_manifest(params) if params.deploy_manifest is not None else None
+            )
+            deploy_tree = prepare_deploy_tree(params, site_manifest=site_manifest)
+
+            # Content-neutral changes (to CI or tooling, say) build the site master already has,
+            # stamped with a different release version
+            if site_stamps.same_site(deploy_tree, remote_master):
+                print_info_line(
+                    "deploy", f"tree {deploy_tree} matches master apart from build stamps"
+                )
+            else:
+                deploy_commit = commit_deploy_tree(
+                    params,
+                    deploy_tree,
+                    push_sha=push_sha,
+                    deploy_number=deploy_number,
+                    parent=resolve_commit(remote_master),
+                )
     elif base_ref == "develop":
         emit_warning("Event targeting", base_ref, "is not deployable:", params)
 
+    if deploy_tree is not None and (recorder := metrics.active()) is not None:
+        recorder.tree_bytes = tree_size(deploy_tree)
+
+    if params.speculative:
+        assert speculation_key is not None, params
+
+        speculation.store(
+            remote,
+            speculation_key,
+            SpeculativeCommits(merge_commit=push_sha, deploy_commit=deploy_commit),
+            dry_run=params.dry_run,
+        )
+        metrics.set_outcome("speculative")
+        params.record_output("speculative", "true")
+        emit_summary("Prepared merge and deploy commits for pull request", pr_number)
+        return
+
     if (
         params.effective_event == "pull_request"
         and not pr_eval.pr_eligibility["approver_is_collaborator"]
     ):
         approve_pull_request(params, pr_eval)
 
-    with sentry_deploy(
-        params, push_sha=push_sha, release_version=release_version, deploy_number=deploy_number
-    ):
+    sentry_prepared = False
+    if release_version is not None and deploy_commit is not None:
+        prepare_sentry_deploy(params, release_version=release_version, deploy_commit=deploy_commit)
+        sentry_prepared = True
+
+    # The approval has to be in place before the merge is pushed
+    params.writes.flush()
+
+    # Everything up to here runs concurrently with other runs on this machine; numbering the
+    # deploy and pushing it is done by one run at a time
+    with leases.push_lease(remote):
+        if deploy_tree is not None:
+            deploy_number, deploy_commit = renumber_deploy_commit(
+                params, push_sha=push_sha, deploy_tree=deploy_tree, deploy_commit=deploy_commit
+            )
+
+            if deploy_commit is None:
+                deploy_tag = tag_unchanged_deploy(
+                    params, push_sha=push_sha, deploy_number=deploy_number
+                )
+            else:
+                # Only if master has moved away from a tree which was unchanged when checked
+                if release_version is not None and not sentry_prepared:
+                    prepare_sentry_deploy(
+                        params, release_version=release_version, deploy_commit=deploy_commit
+                    )
+                    sentry_prepared = True
+
+                deploy_tag = tag_deploy_commit(
+                    params,
+                    push_sha=push_sha,
+                    deploy_number=deploy_number,
+                    deploy_commit=deploy_commit,
+                )
+
         push_args = ["--atomic", remote]
 
         if params.dry_run:
@@ -249,104 +526,223 @@ def run_command(**kwargs) -> None:
                 ]
             )
 
-        if params.allows_pages_deploy():
-            assert deploy_tag is not None
+        if deploy_commit is not None:
+            push_args.append(f"{params.master_ref}:refs/heads/master")
 
-            push_args.extend(
-                [
-                    "master:master",
-                    f"refs/tags/{deploy_tag}:refs/tags/{deploy_tag}",
-                ]
-            )
+        if deploy_tag is not None:
+            push_args.append(f"refs/tags/{deploy_tag}:refs/tags/{deploy_tag}")
 
-        run(["git", "push", *push_args])
+        if (recorder := metrics.active()) is not None:
+            recorder.bytes_pushed = push_size(params, push_sha, deploy_commit)
+
+        with metrics.phase("push"):
+            run(["git", "push", *push_args], network="git-push", idempotent=False)
+
+    if sentry_prepared:
+        assert release_version is not None and deploy_number is not None
+        finalize_sentry_deploy(
+            params, release_version=release_version, push_sha=push_sha, deploy_number=deploy_number
+        )
+
+    if params.effective_event == "pull_request":
+        assert pr_number is not None
+
+        # The deploy has happened; failing to tidy up after it shouldn't fail the run
+        try:
+            speculation.discard(remote, pr_number, dry_run=params.dry_run)
+        except subprocess.CalledProcessError as exc:
+            emit_warning(f"failed to remove speculative refs: {exc!r}")
+
+    if deploy_tree is not None and deploy_commit is None:
+        metrics.set_outcome("unchanged")
+        emit_summary(f"Site unchanged; master is still deploy {deploy_number} ({deploy_tag})")
+    else:
+        metrics.set_outcome("deployed")
 
     emit_summary("Successfully handled push")
 
 
-def update_pull_request_merge_pending_label(params: DeployParams, pending: bool) -> None:
+def update_pull_request_merge_pending_label(
+    params: DeployParams, pending: bool, *, current_labels: list[str]
+) -> None:
     assert params.pr_number is not None, params
 
-    if params.dry_run:
-        action = "post [dry-run]" if pending else "delete [dry-run]"
-        print_info_multi(action, "PR", params.pr_number, "label", "merge-pending")
-        return
-
     if pending:
-        add_label(params.pr_number, "merge-pending")
+        params.writes.add_label(params.repo, params.pr_number, "merge-pending", current_labels)
     else:
-        remove_label(params.pr_number, "merge-pending")
+        params.writes.remove_label(params.repo, params.pr_number, "merge-pending", current_labels)
 
 
+@metrics.phase("fetch")
 def fetch_deploy_refs(params: DeployParams) -> None:
     remote = params.remote
 
+    if (recorder := metrics.active()) is not None:
+        size_before = ObjectStoreStats.collect().size
+
     if params.allows_pages_deploy():
-        # TODO: avoid full-depth fetch here; see prepare_deploy_commit
-        run(
-            [
-                "git",
-                "fetch",
-                "--no-tags",
-                "--",
-                remote,
-                f"+refs/heads/master:refs/remotes/{remote}/master",
-            ]
-        )
+        fetch_master(params)
 
     if params.effective_event == "pull_request":
         head_ref, base_ref = params.head_ref, params.base_ref
 
-        # Base ref
-        run(
-            [
-                "git",
-                "fetch",
-                "--no-tags",
-                "--depth=1",
-                "--",
-                remote,
-                f"+refs/heads/{base_ref}:refs/remotes/{remote}/{base_ref}",
-            ]
-        )
+        # Fetches which move the shallow boundary can't overlap with another run's
+        with leases.repo_lease("shallow"):
+            # Base ref
+            run(
+                [
+                    "git",
+                    "fetch",
+                    "--no-tags",
+                    "--no-write-fetch-head",
+                    "--depth=1",
+                    "--",
+                    remote,
+                    f"+refs/heads/{base_ref}:{params.remote_branch_ref(base_ref)}",
+                ],
+                network="git-fetch",
+            )
 
-        # Head ref
-        run(
-            [
-                "git",
-                "fetch",
-                "--no-tags",
-                f"--shallow-exclude=refs/heads/{base_ref}",
-                "--",
-                remote,
-                f"+refs/heads/{head_ref}:refs/remotes/{remote}/{head_ref}",
-            ]
-        )
+            # Head ref
+            run(
+                [
+                    "git",
+                    "fetch",
+                    "--no-tags",
+                    "--no-write-fetch-head",
+                    f"--shallow-exclude=refs/heads/{base_ref}",
+                    "--",
+                    remote,
+                    f"+refs/heads/{head_ref}:{params.remote_branch_ref(head_ref)}",
+                ],
+                network="git-fetch",
+            )
 
+            run(
+                [
+                    "git",
+                    "fetch",
+                    "--no-tags",
+                    "--no-write-fetch-head",
+                    "--deepen=1",
+                    "--",
+                    remote,
+                    f"+refs/heads/{head_ref}:{params.remote_branch_ref(head_ref)}",
+                ],
+                network="git-fetch",
+            )
+
+        assert params.pr_number is not None, params
+        merge_ref = merge_prep.pull_request_merge_ref(params.pr_number)
         run(
             [
                 "git",
                 "fetch",
                 "--no-tags",
-                "--deepen=1",
+                "--no-write-fetch-head",
                 "--",
                 remote,
-                f"+refs/heads/{head_ref}:refs/remotes/{remote}/{head_ref}",
-            ]
+                f"+{merge_ref}:{params.local_ref(merge_ref)}",
+            ],
+            network="git-fetch",
         )
 
+    if recorder is not None:
+        recorder.bytes_fetched = ObjectStoreStats.collect().size - size_before
+
+    # Only now that master's full history has been fetched is there enough in the object store to
+    # be worth indexing for the rev-list in next_deploy_number, and for later runs' fetches
+    with leases.repo_lease("maintenance"):
+        repo_maintenance.maintain_if_needed()
+
+    # Only master's history is fetched in full; the base ref's is shallow
+    if (cache := object_cache.default_cache()) is not None and params.allows_pages_deploy():
+        cache.update(remote, {"master": params.remote_branch_ref("master")})
+
+
+def fetch_master(params: DeployParams) -> str:
+    """Fetch the remote master with its full history, returning its SHA"""
+    # TODO: avoid full-depth fetch here; see prepare_deploy_commit
+    run(
+        [
+            "git",
+            "fetch",
+            "--no-tags",
+            "--no-write-fetch-head",
+            "--",
+            params.remote,
+            f"+refs/heads/master:{params.remote_branch_ref('master')}",
+        ],
+        network="git-fetch",
+    )
+
+    return resolve_commit(params.remote_branch_ref("master"))
+
 
 def find_prior_deploy(params: DeployParams, push_sha: str) -> tuple[str, str] | None:
+    """Find the deploy commit and tag of an earlier deploy of this source commit
+
+    That's either a deploy tag or, if deploying it left the site unchanged, a tag of the deploy
+    which was already serving it.
+    """
     for line in run(
-        ["git", "ls-remote", "--tags", params.remote, f"deploy/master/*-{push_sha}^{{}}"]
+        [
+            "git",
+            "ls-remote",
+            "--tags",
+            params.remote,
+            f"deploy/master/*-{push_sha}^{{}}",
+            f"deploy/unchanged/*-{push_sha}^{{}}",
+        ],
+        network="git-fetch",
     ).splitlines():
+        # The listed commit is the tag's target, which is the deploy commit
         match line.split("\t", maxsplit=1):
-            case [commit, tag] if commit == push_sha:
-                return commit, tag.removeprefix("refs/tags/")
+            case [commit, tag] if tag.endswith(f"-{push_sha}^{{}}"):
+                return commit, tag.removeprefix("refs/tags/").removesuffix("^{}")
 
     return None
 
 
+def find_superseding_push(params: DeployParams, push_sha: str) -> tuple[str, dict] | None:
+    """Check whether a later push to the branch will deploy a descendant of this commit
+
+    If so there's no point deploying this commit: the later run's deploy includes it, and our
+    push would fail its lease on the branch anyway. Builds which failed don't count, since their
+    deploy won't happen.
+    """
+    assert params.effective_event == "push", params
+
+    match run(
+        ["git", "ls-remote", "--heads", params.remote, f"refs/heads/{params.head_ref}"],
+        network="git-fetch",
+    ).split():
+        case [remote_sha, _]:
+            pass
+        case _:
+            return None
+
+    if remote_sha == push_sha:
+        return None
+
+    relation = compare_commits(push_sha, remote_sha, repo=params.repo)
+    print_info_line(
+        "supersede", f"{params.head_ref} at {remote_sha} is {relation} relative to {push_sha}"
+    )
+
+    if relation != "ahead":
+        return None
+
+    workflow_run = find_workflow_run(
+        event="push", branch=params.head_ref, head_sha=remote_sha, repo=params.repo
+    )
+
+    if workflow_run is None or workflow_run["conclusion"] not in (None, "success"):
+        return None
+
+    return remote_sha, workflow_run
+
+
 def pull_request_revisions_up_to_date(
     params: DeployParams,
     pr_eval: PullRequestEvaluation,
@@ -377,29 +773,159 @@ def push_deploy_revisions_up_to_date(params: DeployParams, current: RevisionInfo
     )
 
 
-@log_group("Prepare deploy")
-def prepare_deploy_commit(params: DeployParams, push_sha: str) -> tuple[str, str]:
-    assert params.deploy_dir is not None
-    assert params.deploy_revision_info is not None
+@log_group("Prepare merge commit")
+@metrics.phase("prepare")
+def prepare_merge_commit(params: DeployParams, pr_eval: PullRequestEvaluation) -> str:
+    assert params.pr_number is not None, params
+
+    push_ref = params.local_ref(
+        f'refs/heads/merge.{params.pr_number}.{params.head_ref.replace("/", "-")}.{datetime.utcnow().strftime("%Y-%m-%d-%H-%M-%S")}'
+    )
+    merge_ref = params.local_ref(merge_prep.pull_request_merge_ref(params.pr_number))
+
+    # Detached, since branches checked out in a worktree are visible to every run
+    with temporary_worktree(merge_ref, args=["--detach"]) as worktree_dir:
+        worktree_args = [
+            f"--git-dir={worktree_dir}/.git",
+            f"--work-tree={worktree_dir}",
+        ]
+        merge_prep.rewrite_pull_request_merge_commit_message(
+            params.pr_number, pr_eval, global_git_args=worktree_args
+        )
+        run(["git", *worktree_args, "update-ref", push_ref, "HEAD"])
+
+    return resolve_commit(push_ref)
+
+
+@log_group("Prepare local merge commit")
+@metrics.phase("prepare")
+def prepare_local_merge_commit(
+    params: DeployParams, pr_eval: PullRequestEvaluation, current: RevisionInfo
+) -> str | None:
+    """Merge the pull request head into the current base without waiting for GitHub
+
+    The merge is only usable if it reproduces the tree that was built and tested, and if the
+    evaluated head is still current (the push leases on it and the approval refers to it).
+    Returns the merge commit SHA, or None if the update-branch path should be taken instead.
+    """
+    assert params.pr_number is not None, params
+
+    if params.deploy_revision_info is None:
+        print_info_line("local merge", "no built revision to compare against")
+        return None
+
+    built = RevisionInfo.load_deploy_json(params.deploy_revision_info)
+
+    # Only the base may have moved; everything else must still be what was built and evaluated
+    heads = [
+        (name, RevisionInfo(head_ref=rev.head_ref, head_sha=rev.head_sha, base_ref=rev.base_ref))
+        for name, rev in [
+            ("current", current),
+            ("evaluated", RevisionInfo.from_pr_eval(pr_eval)),
+            ("built", built),
+        ]
+    ]
+
+    if not revision_info.verify_revision_consistency(heads):
+        print_info_line("local merge", "pull request head changed since the build")
+        return None
+
+    assert current.base_sha is not None, current
+
+    if merge_prep.merge_base(current.base_sha, current.head_sha) is None:
+        # The base was fetched with depth 1; deepen it to where it diverges from the head (which
+        # was fetched the same way) so that the merge base is available
+        for depth_arg in [f"--shallow-exclude=refs/heads/{params.head_ref}", "--deepen=1"]:
+            run(
+                [
+                    "git",
+                    "fetch",
+                    "--no-tags",
+                    "--no-write-fetch-head",
+                    depth_arg,
+                    "--",
+                    params.remote,
+                    f"+refs/heads/{params.base_ref}:{params.remote_branch_ref(params.base_ref)}",
+                ],
+                network="git-fetch",
+            )
+
+    tree = merge_prep.merge_tree(current.base_sha, current.head_sha)
+
+    if tree is None:
+        print_info_line("local merge", f"{params.head_ref} conflicts with {params.base_ref}")
+        return None
 
-    # Get the number of commits there will be on the deploy branch; this will give us a
-    # monotonically increasing deploy number (up to history rewrites and deploy branch changes).
+    if tree != built.tree:
+        print_info_line("local merge", f"merged tree {tree} differs from built tree {built.tree}")
+        return None
+
+    merge_commit = merge_prep.commit_merge_tree(
+        tree,
+        [current.base_sha, current.head_sha],
+        merge_prep.pull_request_merge_message(params.pr_number, pr_eval),
+    )
+    print_info_line(
+        "local merge", f"merged {params.head_ref} into {params.base_ref} as {merge_commit}"
+    )
+
+    return merge_commit
+
+
+def next_deploy_number(remote_master: str) -> str:
+    return str(int(current_deploy_number(remote_master)) + 1)
+
+
+def current_deploy_number(remote_master: str) -> str:
+    # Get the number of commits on the deploy branch; this gives us a monotonically increasing
+    # deploy number (up to history rewrites and deploy branch changes).
     #
     # Note that we do a non-shallow fetch of master in fetch_deploy_refs to ensure this works.
-    deploy_number = str(
-        len(run(["git", "rev-list", f"refs/remotes/{params.remote}/master"]).splitlines()) + 1
-    )
+    return run(["git", "rev-list", "--count", remote_master]).removesuffix("\n")
 
-    deploy_description = (
+
+def tree_of(rev: str) -> str:
+    return run(["git", "rev-parse", "--verify", f"{rev}^{{tree}}"]).removesuffix("\n")
+
+
+def describe_deploy(params: DeployParams, deploy_number: str) -> str:
+    return (
         deploy_number
         if params.pr_number is None
         else f"{deploy_number} from PR #{params.pr_number}"
     )
 
+
+@log_group("Verify deploy manifest")
+@metrics.phase("prepare")
+def verify_deploy_manifest(params: DeployParams) -> Manifest:
+    assert params.deploy_dir is not None
+    assert params.deploy_manifest is not None
+
+    site_manifest = manifest.load_manifest(params.deploy_manifest)
+    manifest.verify_manifest(params.deploy_dir, site_manifest)
+
+    return site_manifest
+
+
+@log_group("Prepare deploy")
+@metrics.phase("prepare")
+def prepare_deploy_tree(params: DeployParams, site_manifest: Manifest | None = None) -> str:
+    """Write the tree of the deploy directory plus .nojekyll, returning its ID
+
+    Given the deploy directory's verified manifest, the tree is built directly from the manifest's
+    blob IDs rather than by copying the directory into a worktree and staging it.
+    """
+    assert params.deploy_dir is not None
+    assert params.deploy_revision_info is not None
+
+    if site_manifest is not None:
+        return write_manifest_tree(params.deploy_dir, site_manifest)
+
     with temporary_worktree(
-        f"refs/remotes/{params.remote}/master", args=["--no-checkout", "-B", "master"]
+        params.remote_branch_ref("master"), args=["--no-checkout", "--detach"]
     ) as worktree_dir:
-        run(["rsync", "-a", f"{params.deploy_dir}/", f"{worktree_dir}/"])
+        tree_copy.populate_tree(params.deploy_dir, Path(worktree_dir))
 
         (Path(worktree_dir) / ".nojekyll").touch()
 
@@ -414,8 +940,6 @@ def prepare_deploy_commit(params: DeployParams, push_sha: str) -> tuple[str, str
             f"core.excludesfile={REPO_ROOT}/.deploy-gitignore",
         ]
 
-        deploy_tag = f"deploy/master/{deploy_number}-{push_sha}"
-
         run(
             [
                 "git",
@@ -426,37 +950,215 @@ def prepare_deploy_commit(params: DeployParams, push_sha: str) -> tuple[str, str
             ]
         )
 
+        return run(["git", *worktree_args, "write-tree"]).removesuffix("\n")
+
+
+@metrics.phase("prepare")
+def commit_deploy_tree(
+    params: DeployParams, tree: str, push_sha: str, deploy_number: str, parent: str
+) -> str:
+    """Commit the deploy tree on top of the given master commit, returning the commit SHA
+
+    For real runs the run's local master is left pointing at the commit; speculative runs leave
+    it untouched.
+    """
+    deploy_commit = run(
+        [
+            "git",
+            "commit-tree",
+            tree,
+            "-p",
+            parent,
+            *deploy_commit_message(params, push_sha=push_sha, deploy_number=deploy_number),
+        ]
+    ).removesuffix("\n")
+
+    if not params.speculative:
+        run(["git", "update-ref", params.master_ref, deploy_commit])
+
+    return deploy_commit
+
+
+def deploy_commit_message(params: DeployParams, push_sha: str, deploy_number: str) -> list[str]:
+    return [
+        "-m",
+        f"Deploy to GitHub Pages [{describe_deploy(params, deploy_number)}]",
+        "-m",
+        "Source commit for this deployment:",
+        "-m",
+        run(["git", "show", "--no-patch", "--format=fuller", push_sha]),
+    ]
+
+
+def write_manifest_tree(deploy_dir: Path, site_manifest: Manifest) -> str:
+    """Write a tree of the manifest's entries plus .nojekyll, returning its ID
+
+    Only blobs the repository doesn't already have are read from the deploy directory.
+    """
+    entries = dict(site_manifest)
+    entries.setdefault(".nojekyll", ManifestEntry(mode="100644", size=0, blob=manifest.EMPTY_BLOB))
+
+    blobs = sorted({entry.blob for entry in entries.values()})
+    missing = {
+        line.split()[0]
+        for line in run(
+            ["git", "cat-file", "--batch-check"], input="".join(f"{b}\n" for b in blobs)
+        ).splitlines()
+        if line.endswith(" missing")
+    }
+
+    reused = set(blobs) - missing
+
+    files = {}
+    for path, entry in entries.items():
+        if entry.blob not in missing:
+            continue
+
+        missing.discard(entry.blob)
+
+        if entry.mode == "120000":
+            link_blob = run(
+                ["git", "hash-object", "-w", "--stdin"], input=os.readlink(deploy_dir / path)
+            ).removesuffix("\n")
+            assert link_blob == entry.blob, (path, link_blob, entry)
+        else:
+            files[path] = entry
+
+    if files:
+        written_blobs = run(
+            ["git", "hash-object", "-w", "--no-filters", "--stdin-paths"],
+            input="".join(f"{deploy_dir.absolute() / path}\n" for path in files),
+        ).split()
+        assert written_blobs == [e.blob for e in files.values()], "hash-object disagrees"
+
+    print_info_line(
+        "blobs",
+        f"{len(blobs)} in tree: {len(blobs) - len(reused)} written, {len(reused)} already present",
+    )
+
+    with tempfile.TemporaryDirectory(prefix="deploy-index.") as index_dir:
+        env = {**os.environ, "GIT_INDEX_FILE": f"{index_dir}/index"}
+
         run(
-            [
-                "git",
-                *base_args,
-                "commit",
-                "--allow-empty",
-                "-m",
-                f"Deploy to GitHub Pages [{deploy_description}]",
-                "-m",
-                "Source commit for this deployment:",
-                "-m",
-                run(["git", "show", "--no-patch", "--format=fuller", push_sha]),
-            ]
+            ["git", "update-index", "--add", "-z", "--index-info"],
+            env=env,
+            input="".join(f"{e.mode} {e.blob}\t{path}\0" for path, e in entries.items()),
         )
 
+        return run(["git", "write-tree"], env=env).removesuffix("\n")
+
+
+def renumber_deploy_commit(
+    params: DeployParams, push_sha: str, deploy_tree: str, deploy_commit: str | None
+) -> tuple[str, str | None]:
+    """Check the deploy commit against the remote master as of now
+
+    Another run may have pushed a deploy since the commit was prepared: if so the tree is
+    committed again on top of it. Returns the deploy number and the commit to push, or, if
+    master already serves the same site, master's own deploy number and None.
+
+    The push lease must be held, so that no other run on this machine can push a deploy between
+    this and the push.
+    """
+    with metrics.phase("fetch"):
+        master_sha = fetch_master(params)
+
+    remote_master = params.remote_branch_ref("master")
+
+    # A commit prepared on this master was only made because the site differed from it
+    if deploy_commit is not None and resolve_commit(f"{deploy_commit}^") == master_sha:
+        return next_deploy_number(remote_master), deploy_commit
+
+    if site_stamps.same_site(deploy_tree, master_sha):
+        return current_deploy_number(remote_master), None
+
+    deploy_number = next_deploy_number(remote_master)
+    print_info_line("deploy", f"master moved to {master_sha}; deploying as {deploy_number}")
+
+    return deploy_number, commit_deploy_tree(
+        params, deploy_tree, push_sha=push_sha, deploy_number=deploy_number, parent=master_sha
+    )
+
+
+@metrics.phase("prepare")
+def tag_unchanged_deploy(params: DeployParams, push_sha: str, deploy_number: str) -> str:
+    """Tag the remote master as serving a source commit which changed nothing in the site"""
+    deploy_tag = f"deploy/unchanged/{deploy_number}-{push_sha}"
+
+    run(
+        [
+            "git",
+            "tag",
+            "--force",
+            "-a",
+            deploy_tag,
+            params.remote_branch_ref("master"),
+            "-m",
+            f"Source commit {push_sha} left the site unchanged; deploy {deploy_number} serves it",
+            "-m",
+            params.run_url,
+        ]
+    )
+
+    return deploy_tag
+
+
+@metrics.phase("prepare")
+def tag_deploy_commit(
+    params: DeployParams, push_sha: str, deploy_number: str, deploy_commit: str
+) -> str:
+    """Point the local master at the deploy commit and tag it, returning the tag name"""
+    deploy_tag = f"deploy/master/{deploy_number}-{push_sha}"
+
+    run(["git", "update-ref", params.master_ref, deploy_commit])
+
+    # Replaces any tag left behind by a run whose push failed; the push refuses to replace a
+    # remote tag
+    run(
+        [
+            "git",
+            "tag",
+            "--force",
+            "-a",
+            deploy_tag,
+            deploy_commit,
+            "-m",
+            f'Deploy {describe_deploy(params, deploy_number)} triggered by {params.effective_event.replace("_", " ")}',
+            "-m",
+            params.run_url,
+        ]
+    )
+
+    return deploy_tag
+
+
+def tree_size(tree: str) -> int:
+    """Total size of the blobs in a tree"""
+    return sum(
+        int(line.split(maxsplit=4)[3])
+        for line in run(["git", "ls-tree", "-r", "-l", "--full-tree", tree]).splitlines()
+        if line.split(maxsplit=2)[1] == "blob"
+    )
+
+
+def push_size(params: DeployParams, push_sha: str, deploy_commit: str | None) -> int:
+    """Approximate size of the objects the push will send, from what the remote is known to have"""
+    new_tips = [push_sha, *([deploy_commit] if deploy_commit is not None else [])]
+
+    return int(
         run(
             [
                 "git",
-                *worktree_args,
-                "tag",
-                "-a",
-                deploy_tag,
-                "master",
-                "-m",
-                f'Deploy {deploy_description} triggered by {params.effective_event.replace("_", " ")}',
-                "-m",
-                params.run_url,
+                "rev-list",
+                "--objects",
+                "--disk-usage",
+                *new_tips,
+                "--not",
+                f"--remotes={params.remote}",
+                f"--glob={params.remote_branch_ref('*')}",
             ]
         )
-
-    return deploy_number, deploy_tag
+    )
 
 
 def approve_pull_request(params: DeployParams, pr_eval: PullRequestEvaluation) -> None:
@@ -480,12 +1182,8 @@ def approve_pull_request(params: DeployParams, pr_eval: PullRequestEvaluation) -
         }
     )
 
-    url = f"/repos/{REPO}/pulls/{params.pr_number}/reviews"
-
-    if params.dry_run:
-        print_info_multi("post [dry-run]", url, review_params)
-    else:
-        get_github_api(url, method="POST", token=token, data=review_params.encode())
+    assert params.pr_number is not None, params
+    params.writes.approve(params.repo, params.pr_number, review_params, token=token)
 
 
 def trigger_pull_request_merge_update(params: DeployParams) -> None:
@@ -493,37 +1191,12 @@ def trigger_pull_request_merge_update(params: DeployParams) -> None:
     assert params.effective_event == "pull_request", params
     assert params.pr_number is not None, params
 
-    url = f"/repos/{REPO}/pulls/{params.pr_number}/update-branch"
-
-    if params.dry_run:
-        print_info_multi("put [dry-run]", url)
-    else:
-        get_github_api(url, method="PUT", data=b"{}")
-
-
-@contextmanager
-def sentry_deploy(
-    params: DeployParams, push_sha: str, release_version: str | None, deploy_number: str | None
-):
-    if not params.allows_pages_deploy():
-        assert release_version is None, f"{release_version!r}, params"
-        assert deploy_number is None, f"{deploy_number!r}, params"
-
-        yield
-        return
-
-    assert release_version is not None, params
-    assert deploy_number is not None, params
-
-    prepare_sentry_deploy(params, release_version=release_version)
-    yield
-    finalize_sentry_deploy(
-        params, release_version=release_version, push_sha=push_sha, deploy_number=deploy_number
-    )
+    params.writes.update_branch(params.repo, params.pr_number)
 
 
 @log_group("Initialize sentry release")
-def prepare_sentry_deploy(params: DeployParams, release_version: str) -> None:
+@metrics.phase("sentry")
+def prepare_sentry_deploy(params: DeployParams, release_version: str, deploy_commit: str) -> None:
     assert params.deploy_dir is not None, params
 
     run_sentry(
@@ -537,20 +1210,36 @@ def prepare_sentry_deploy(params: DeployParams, release_version: str) -> None:
         ],
     )
 
-    run_sentry(
-        params,
-        [
-            "sourcemaps",
-            "upload",
-            f"--release={release_version}",
-            "--url-prefix",
-            "/home-assets",
-            str(params.deploy_dir / "home-assets"),
-        ],
+    # The remote master is the previous deploy, or one earlier than the deploy commit ends up
+    # following if another run pushes first; either way it's a deploy whose uploads Sentry has
+    assets_dir = params.deploy_dir / "home-assets"
+    plan = sourcemaps.plan_upload(
+        assets_dir,
+        "home-assets",
+        previous_commit=params.remote_branch_ref("master"),
+        current_commit=deploy_commit,
+    )
+    print_info_line("sourcemaps", plan.describe())
+
+    sourcemaps.upload(
+        plan,
+        assets_dir,
+        lambda staging_dir: run_sentry(
+            params,
+            [
+                "sourcemaps",
+                "upload",
+                f"--release={release_version}",
+                "--url-prefix",
+                "/home-assets",
+                str(staging_dir),
+            ],
+        ),
     )
 
 
 @log_group("Finalize sentry release and deploy")
+@metrics.phase("sentry")
 def finalize_sentry_deploy(
     params: DeployParams, release_version: str, push_sha: str, deploy_number: str
 ) -> None:
@@ -561,7 +1250,7 @@ def finalize_sentry_deploy(
             "set-commits",
             release_version,
             "--commit",
-            f"wabain/wabain.github.io@{push_sha}",
+            f"{params.repo}@{push_sha}",
         ],
     )
 
@@ -588,7 +1277,8 @@ def run_sentry(params: DeployParams, args: list[str]) -> None:
     if params.dry_run:
         print_info_line("run [dry-run]", "sentry-cli", *(shlex.quote(s) for s in args))
     else:
-        run(["sentry-cli", *args])
+        # A repeated `releases deploys <version> new` would record a second deploy
+        run(["sentry-cli", *args], network="sentry", idempotent=args[:2] != ["releases", "deploys"])
 
 
 def get_release_version(params: DeployParams) -> str:
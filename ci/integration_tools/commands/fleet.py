@@ -0,0 +1,228 @@
+"""Process automerge candidates across several repositories
+
+For each repository, pull requests labelled merge-pending are re-evaluated and the build workflow
+is re-dispatched for the oldest eligible one, as bin/ci-trigger-next-pr.sh does for a single
+repository. All repositories share one connection pool and rate limit budget; work is scheduled
+with a per-repository concurrency limit so that a slow repository can't starve the others.
+
+Label changes for a repository are queued while its candidates are reviewed and sent as one
+batch once the reviews are done, or before its rerun is dispatched.
+
+Only automerge candidates are handled. Deploys of pushes to the base branch aren't tracked:
+after-pr-build.yml starts them when the push's build completes, and one which failed or never ran
+has to be started again by re-running that workflow, as for a single repository.
+"""
+
+from __future__ import annotations
+
+import argparse
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from dataclasses import dataclass, field
+import functools
+from typing import Any, Callable
+
+from .. import automerge, cassette
+from ..automerge import CandidateReview
+from ..gh_transport import POOL
+from ..gh_writes import WriteQueue, WriteResult
+from ..output import emit_error, emit_summary, print_info_line
+
+
+def init_parser(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument(
+        "--repo",
+        dest="repos",
+        action="append",
+        required=True,
+        help="GitHub repository as owner/name; may be given multiple times",
+    )
+    parser.add_argument(
+        "--max-workers", type=int, default=8, help="Maximum concurrent requests overall"
+    )
+    parser.add_argument(
+        "--per-repo-concurrency",
+        type=int,
+        default=2,
+        help="Maximum concurrent requests for any one repository",
+    )
+    parser.add_argument("--dry-run", action="store_true")
+
+
+@dataclass(kw_only=True)
+class FleetParams:
+    repos: list[str]
+    max_workers: int
+    per_repo_concurrency: int
+    dry_run: bool
+
+
+@dataclass
+class RepoState:
+    repo: str
+    writes: WriteQueue
+    candidates: list[int] | None = None
+    reviews: dict[int, CandidateReview] = field(default_factory=dict)
+    rerun: tuple[int, str] | None = None
+    errors: list[BaseException] = field(default_factory=list)
+
+    def summary_line(self) -> str:
+        if self.errors:
+            return f"| {self.repo} | failed: {self.errors[0]!r} |"
+
+        outcomes = ", ".join(f"#{n} {r.outcome}" for n, r in sorted(self.reviews.items()))
+        rerun = f"; rerun #{self.rerun[0]}: {self.rerun[1]}" if self.rerun else ""
+        return f"| {self.repo} | {outcomes or 'no candidates'}{rerun} |"
+
+
+Callback = Callable[[Future], None]
+
+
+class FleetScheduler:
+    """Run tasks on a shared thread pool with a concurrency cap per repository
+
+    Tasks beyond a repository's cap wait in that repository's queue rather than in the executor,
+    so they never hold a worker thread that another repository could use. Completion callbacks run
+    on the calling thread and may schedule follow-up tasks.
+    """
+
+    def __init__(self, max_workers: int, per_repo_concurrency: int) -> None:
+        if max_workers < 1 or per_repo_concurrency < 1:
+            raise ValueError("concurrency limits must be positive")
+
+        self.max_workers = max_workers
+        self.per_repo_concurrency = per_repo_concurrency
+        self._queues: dict[str, deque[tuple[Callable[..., Any], tuple[Any, ...], Callback]]] = {}
+        self._running: dict[str, int] = {}
+
+    def submit(self, repo: str, fn: Callable[..., Any], *args: Any, then: Callback) -> None:
+        self._queues.setdefault(repo, deque()).append((fn, args, then))
+        self._running.setdefault(repo, 0)
+
+    def run(self) -> None:
+        in_flight: dict[Future, tuple[str, Callback]] = {}
+
+        with (
+            cassette.concurrent(),
+            ThreadPoolExecutor(
+                max_workers=self.max_workers, thread_name_prefix="fleet"
+            ) as executor,
+        ):
+            while True:
+                for repo, queue in self._queues.items():
+                    while queue and self._running[repo] < self.per_repo_concurrency:
+                        fn, args, then = queue.popleft()
+                        in_flight[executor.submit(fn, *args)] = (repo, then)
+                        self._running[repo] += 1
+
+                if not in_flight:
+                    return
+
+                done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+
+                for future in done:
+                    repo, then = in_flight.pop(future)
+                    self._running[repo] -= 1
+                    then(future)
+
+
+def run_command(**kwargs) -> None:
+    params = FleetParams(**kwargs)
+
+    scheduler = FleetScheduler(params.max_workers, params.per_repo_concurrency)
+    states = {
+        repo: RepoState(repo, writes=WriteQueue(dry_run=params.dry_run))
+        for repo in dict.fromkeys(params.repos)
+    }
+
+    for state in states.values():
+        schedule_repo(scheduler, state)
+
+    try:
+        scheduler.run()
+    finally:
+        POOL.close()
+
+    for remaining, limit in POOL.budget.snapshot().values():
+        print_info_line("rate limit", f"{remaining}/{limit} remaining")
+
+    emit_summary(
+        "\n".join(
+            ["| Repository | Outcome |", "| --- | --- |"]
+            + [state.summary_line() for state in states.values()]
+        ),
+        title="Fleet automerge",
+    )
+
+    failed = [state for state in states.values() if state.errors]
+    for state in failed:
+        for exc in state.errors:
+            emit_error(f"{state.repo}: {exc!r}")
+
+    if failed:
+        raise RuntimeError(f"{len(failed)} of {len(states)} repositories failed")
+
+
+def schedule_repo(scheduler: FleetScheduler, state: RepoState) -> None:
+    repo = state.repo
+
+    def on_candidates(future: Future) -> None:
+        if (exc := future.exception()) is not None:
+            state.errors.append(exc)
+            return
+
+        state.candidates = future.result()
+        print_info_line(repo, "candidates:", state.candidates)
+
+        for pr_number in state.candidates:
+            scheduler.submit(
+                repo, automerge.review_candidate, repo, pr_number, state.writes, then=on_review
+            )
+
+    def on_review(future: Future) -> None:
+        if (exc := future.exception()) is not None:
+            state.errors.append(exc)
+        else:
+            review = future.result()
+            state.reviews[review.pr_number] = review
+
+        assert state.candidates is not None
+        if len(state.reviews) + len(state.errors) < len(state.candidates):
+            return
+
+        # Only the oldest eligible pull request is re-run; merging it will change the base for
+        # the others anyway
+        for pr_number in state.candidates:
+            review = state.reviews.get(pr_number)
+            if review is not None and review.outcome == "eligible":
+                scheduler.submit(
+                    repo,
+                    automerge.trigger_rerun,
+                    repo,
+                    pr_number,
+                    review.pr_eval,
+                    state.writes,
+                    then=functools.partial(on_rerun, pr_number),
+                )
+                return
+
+        scheduler.submit(repo, state.writes.flush, False, then=on_flush)
+
+    def on_rerun(pr_number: int, future: Future) -> None:
+        if (exc := future.exception()) is not None:
+            state.errors.append(exc)
+        else:
+            state.rerun = (pr_number, future.result())
+
+        # Whatever wasn't sent before the dispatch
+        scheduler.submit(repo, state.writes.flush, False, then=on_flush)
+
+    def on_flush(future: Future) -> None:
+        if (exc := future.exception()) is not None:
+            state.errors.append(exc)
+            return
+
+        results: list[WriteResult] = future.result()
+        state.errors.extend(result.error for result in results if result.error is not None)
+
+    scheduler.submit(repo, automerge.find_merge_pending_candidates, repo, then=on_candidates)
@@ -0,0 +1,333 @@
+"""Serve GitHub webhooks and act on automerge candidates as soon as they change
+
+This is an event-driven alternative to the cron poller (bin/ci-trigger-next-pr.sh). Deliveries
+for pull_request, pull_request_review and check_suite events schedule the affected pull requests
+for evaluation; label events, which aren't tied to a pull request, schedule each merge-pending
+candidate. Events are deduplicated by delivery ID and debounced per pull request so that a burst
+of related deliveries results in a single evaluation. Label changes for the pull requests which
+become due together are sent as one batch once they've all been evaluated.
+"""
+
+from __future__ import annotations
+
+import argparse
+from collections import OrderedDict
+from dataclasses import dataclass
+import hashlib
+import hmac
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import os
+import threading
+import time
+from typing import Any, Callable
+
+from .. import automerge
+from ..gh_state import default_repo
+from ..gh_writes import WriteQueue
+from ..output import emit_error, emit_notice, print_info_line
+
+HANDLED_EVENTS = frozenset(["pull_request", "pull_request_review", "check_suite", "label"])
+
+# Upper bound on accepted payload size; GitHub caps deliveries at 25 MB
+MAX_PAYLOAD_BYTES = 25 * 1024 * 1024
+
+# Number of delivery IDs remembered for deduplication
+DELIVERY_HISTORY = 4096
+
+
+def init_parser(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument(
+        "--repo",
+        dest="repos",
+        action="append",
+        help="Repository to accept events for, as owner/name; may be given multiple times "
+        "(default: $GITHUB_REPOSITORY)",
+    )
+    parser.add_argument(
+        "--secret-env",
+        default="GH_WEBHOOK_SECRET",
+        help="Environment variable holding the webhook secret",
+    )
+    parser.add_argument(
+        "--debounce",
+        type=float,
+        default=5.0,
+        help="Seconds to wait for further events before evaluating a pull request",
+    )
+    parser.add_argument("--dry-run", action="store_true")
+
+
+@dataclass(kw_only=True)
+class ListenParams:
+    host: str
+    port: int
+    repos: list[str] | None
+    secret_env: str
+    debounce: float
+    dry_run: bool
+
+
+# (repository, pull request number), or (repository, None) to schedule all candidates
+WorkKey = tuple[str, int | None]
+
+
+class Debouncer:
+    """Collapse repeated work items, running each once it has been quiet for the delay
+
+    after_batch, if given, runs once the items which became due together have all been handled.
+    """
+
+    def __init__(
+        self,
+        delay: float,
+        handler: Callable[[WorkKey], None],
+        after_batch: Callable[[], None] | None = None,
+    ) -> None:
+        self.delay = delay
+        self.handler = handler
+        self.after_batch = after_batch
+        self._due: dict[WorkKey, float] = {}
+        self._cond = threading.Condition()
+        self._stopped = False
+        self._thread = threading.Thread(target=self._run, name="debouncer", daemon=True)
+
+    def start(self) -> None:
+        self._thread.start()
+
+    def stop(self) -> None:
+        with self._cond:
+            self._stopped = True
+            self._cond.notify()
+        self._thread.join()
+
+    def add(self, key: WorkKey) -> None:
+        with self._cond:
+            self._due[key] = time.monotonic() + self.delay
+            self._cond.notify()
+
+    def pending(self) -> int:
+        with self._cond:
+            return len(self._due)
+
+    def _run(self) -> None:
+        while True:
+            with self._cond:
+                while not self._stopped:
+                    now = time.monotonic()
+                    ready = [k for k, due in self._due.items() if due <= now]
+                    if ready:
+                        break
+                    timeout = min(self._due.values(), default=now + 60) - now
+                    self._cond.wait(timeout)
+
+                if self._stopped:
+                    return
+
+                for key in ready:
+                    del self._due[key]
+
+            for key in ready:
+                try:
+                    self.handler(key)
+                except Exception as exc:
+                    emit_error(f"failed to process {key}: {exc!r}")
+
+            if self.after_batch is not None:
+                try:
+                    self.after_batch()
+                except Exception as exc:
+                    emit_error(f"failed to finish batch: {exc!r}")
+
+
+class WebhookListener:
+    def __init__(self, params: ListenParams, secret: bytes) -> None:
+        self.params = params
+        self.secret = secret
+        self.repos = frozenset(params.repos or [default_repo()])
+        self.writes = WriteQueue(dry_run=params.dry_run)
+        self.debouncer = Debouncer(params.debounce, self.process, after_batch=self.flush_writes)
+
+        self._deliveries: OrderedDict[str, None] = OrderedDict()
+        self._deliveries_lock = threading.Lock()
+
+        # Head SHAs for which a rerun was already dispatched, so that follow-up events for the
+        # same commit don't dispatch it again
+        self._dispatched: set[tuple[str, int, str]] = set()
+
+    def verify_signature(self, body: bytes, signature: str | None) -> bool:
+        if signature is None or not signature.startswith("sha256="):
+            return False
+
+        expected = hmac.new(self.secret, body, hashlib.sha256).hexdigest()
+        return hmac.compare_digest(signature.removeprefix("sha256="), expected)
+
+    def is_new_delivery(self, delivery_id: str) -> bool:
+        with self._deliveries_lock:
+            if delivery_id in self._deliveries:
+                return False
+
+            self._deliveries[delivery_id] = None
+            while len(self._deliveries) > DELIVERY_HISTORY:
+                self._deliveries.popitem(last=False)
+
+            return True
+
+    def accept(self, event: str, payload: dict[str, Any]) -> list[WorkKey]:
+        """Schedule the work implied by an event, returning what was scheduled"""
+        repo = (payload.get("repository") or {}).get("full_name")
+        if repo not in self.repos:
+            print_info_line("ignore", f"{event} event for unexpected repository {repo!r}")
+            return []
+
+        keys: list[WorkKey]
+
+        match event, payload:
+            case ("pull_request" | "pull_request_review"), {"pull_request": {"number": int(n)}}:
+                keys = [(repo, n)]
+
+            case "check_suite", {"check_suite": {"pull_requests": list(prs)}}:
+                keys = [(repo, pr["number"]) for pr in prs]
+
+            case "label", _:
+                keys = [(repo, None)]
+
+            case _:
+                keys = []
+
+        for key in keys:
+            self.debouncer.add(key)
+
+        return keys
+
+    def process(self, key: WorkKey) -> None:
+        repo, pr_number = key
+
+        if pr_number is None:
+            for candidate in automerge.find_merge_pending_candidates(repo):
+                self.debouncer.add((repo, candidate))
+            return
+
+        review = automerge.review_candidate(repo, pr_number, self.writes)
+        print_info_line(f"{repo}#{pr_number}", review.outcome)
+
+        if review.outcome != "eligible":
+            return
+
+        dispatch_key = (repo, pr_number, review.pr_eval.head_sha)
+        if dispatch_key in self._dispatched:
+            print_info_line(f"{repo}#{pr_number}", "rerun already dispatched for head")
+            return
+
+        outcome = automerge.trigger_rerun(repo, pr_number, review.pr_eval, self.writes)
+        if outcome == "dispatched":
+            self._dispatched.add(dispatch_key)
+
+    def flush_writes(self) -> None:
+        # Failures are reported by the queue, and retried by the next evaluation of the same pull
+        # request, which finds the label still needing to change
+        self.writes.flush(check=False)
+
+
+class _WebhookHandler(BaseHTTPRequestHandler):
+    server: _WebhookServer
+
+    def do_POST(self) -> None:
+        listener = self.server.listener
+
+        try:
+            length = int(self.headers.get("Content-Length", ""))
+        except ValueError:
+            return self._reply(411, "content length required")
+
+        # A negative length would have rfile.read() block until the client closes the connection
+        if length < 0:
+            return self._reply(400, "invalid content length")
+
+        if length > MAX_PAYLOAD_BYTES:
+            return self._reply(413, "payload too large")
+
+        body = self.rfile.read(length)
+
+        if not listener.verify_signature(body, self.headers.get("X-Hub-Signature-256")):
+            return self._reply(401, "invalid signature")
+
+        event = self.headers.get("X-GitHub-Event", "")
+        delivery = self.headers.get("X-GitHub-Delivery", "")
+
+        if event == "ping":
+            return self._reply(200, "pong")
+
+        if event not in HANDLED_EVENTS:
+            return self._reply(202, f"ignored {event} event")
+
+        if delivery and not listener.is_new_delivery(delivery):
+            return self._reply(202, "duplicate delivery")
+
+        try:
+            payload = json.loads(body)
+        except ValueError:
+            return self._reply(400, "invalid payload")
+
+        if not isinstance(payload, dict):
+            return self._reply(400, "invalid payload")
+
+        keys = listener.accept(event, payload)
+        self._reply(202, f"scheduled {len(keys)}")
+
+    def _reply(self, status: int, message: str) -> None:
+        body = (message + "\n").encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "text/plain")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format: str, *args: Any) -> None:
+        print_info_line("webhook", format % args)
+
+
+class _WebhookServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address: tuple[str, int], listener: WebhookListener) -> None:
+        super().__init__(address, _WebhookHandler)
+        self.listener = listener
+
+
+def serve(params: ListenParams, secret: bytes) -> _WebhookServer:
+    """Start listening in the background, returning the server"""
+    listener = WebhookListener(params, secret)
+    server = _WebhookServer((params.host, params.port), listener)
+
+    listener.debouncer.start()
+    threading.Thread(target=server.serve_forever, name="webhook-server", daemon=True).start()
+
+    return server
+
+
+def shutdown(server: _WebhookServer) -> None:
+    server.shutdown()
+    server.server_close()
+    server.listener.debouncer.stop()
+
+
+def run_command(**kwargs) -> None:
+    params = ListenParams(**kwargs)
+
+    secret = os.getenv(params.secret_env)
+    if not secret:
+        raise ValueError(f"{params.secret_env} environment variable not provided")
+
+    server = serve(params, secret.encode())
+    host, port = server.server_address[:2]
+    emit_notice(f"Listening for webhooks on {host!s}:{port}")
+
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        shutdown(server)
@@ -0,0 +1,126 @@
+"""Write a commit-graph and multi-pack-index for the current repository
+
+By default this only does anything once the object store exceeds the thresholds in
+repo_maintenance (deploy-commit checks the same thresholds before fetching). With --benchmark, the
+history walks deploy-commit makes are timed with git's indexes disabled and enabled, after any
+maintenance has run.
+
+With --object-cache, the object cache in $CI_TOOLS_CACHE_DIR is pruned instead. A job should do
+this only after the last of its steps which use the cache: its checkout relies on the cache for
+objects it didn't fetch itself, which nothing protects from pruning between steps.
+"""
+
+from __future__ import annotations
+
+import argparse
+from dataclasses import dataclass
+import statistics
+import subprocess
+import time
+
+from .. import object_cache, repo_maintenance
+from ..output import emit_summary, print_info_line
+from ..repo_maintenance import ObjectStoreStats
+
+# Configuration which stops git reading the indexes written by maintenance
+INDEXES_DISABLED = [
+    "-c",
+    "core.commitGraph=false",
+    "-c",
+    "core.multiPackIndex=false",
+    "-c",
+    "pack.useBitmaps=false",
+]
+
+
+def init_parser(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument(
+        "--force", action="store_true", help="Run maintenance regardless of thresholds"
+    )
+    parser.add_argument(
+        "--benchmark",
+        action="store_true",
+        help="Time rev-list and merge-base with and without the indexes",
+    )
+    parser.add_argument(
+        "--rev", default="HEAD", help="Revision to walk with rev-list when benchmarking"
+    )
+    parser.add_argument(
+        "--merge-base",
+        nargs=2,
+        metavar=("BASE", "HEAD"),
+        help="Revisions to find the merge base of when benchmarking",
+    )
+    parser.add_argument("--iterations", type=int, default=5)
+    parser.add_argument(
+        "--object-cache",
+        action="store_true",
+        help="Prune the object cache in $CI_TOOLS_CACHE_DIR instead of maintaining this repository",
+    )
+
+
+@dataclass(kw_only=True)
+class MaintainParams:
+    force: bool
+    benchmark: bool
+    rev: str
+    merge_base: list[str] | None
+    iterations: int
+    object_cache: bool
+
+
+def run_command(**kwargs) -> None:
+    params = MaintainParams(**kwargs)
+
+    if params.object_cache:
+        if (cache := object_cache.default_cache()) is not None:
+            cache.prune()
+        else:
+            print_info_line("maintenance", "no object cache configured")
+        return
+
+    stats = ObjectStoreStats.collect()
+    print_info_line("maintenance", stats)
+
+    if params.force:
+        repo_maintenance.maintain(stats)
+    elif not repo_maintenance.maintain_if_needed():
+        print_info_line("maintenance", "not needed")
+
+    if params.benchmark:
+        benchmark(params)
+
+
+def benchmark(params: MaintainParams) -> None:
+    commands = [["rev-list", "--count", params.rev]]
+    if params.merge_base is not None:
+        commands.append(["merge-base", *params.merge_base])
+
+    rows = ["| Command | Without indexes | With indexes | Speedup |", "| --- | --- | --- | --- |"]
+
+    for args in commands:
+        without = time_git(INDEXES_DISABLED + args, params.iterations)
+        with_indexes = time_git(args, params.iterations)
+
+        rows.append(
+            f"| `git {' '.join(args)}` | {without * 1000:.1f} ms | {with_indexes * 1000:.1f} ms "
+            f"| {without / with_indexes:.1f}x |"
+        )
+
+    emit_summary("\n".join(rows), title=f"Median of {params.iterations} runs")
+
+
+def time_git(args: list[str], iterations: int) -> float:
+    """Return the median wall time of a git command in seconds
+
+    This deliberately bypasses utils.run: the command line would be logged on every iteration,
+    and a replayed cassette has no meaningful timings.
+    """
+    timings = []
+
+    for _ in range(iterations):
+        start = time.perf_counter()
+        subprocess.run(["git", *args], check=True, stdout=subprocess.DEVNULL)
+        timings.append(time.perf_counter() - start)
+
+    return statistics.median(timings)
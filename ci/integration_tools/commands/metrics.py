@@ -0,0 +1,191 @@
+"""Report percentiles of recorded deploy-commit timings
+
+Runs are read from the metrics database in $CI_TOOLS_CACHE_DIR (or --db), restricted to a recent
+window, after importing any JSON lines files written by deploy-commit --metrics-file. The report covers p50/p95/p99 of each phase, of whole deploys and of the bytes fetched,
+pushed and deployed, plus counts of each outcome; --format=openmetrics prints the same data in the
+OpenMetrics text format.
+"""
+
+from __future__ import annotations
+
+import argparse
+from collections import Counter
+from dataclasses import dataclass
+from pathlib import Path
+import re
+import time
+
+from .. import metrics
+from ..metrics import MetricsStore
+from ..output import emit_summary, print_info_line
+
+QUANTILES = [0.5, 0.95, 0.99]
+
+WINDOW_UNITS = {"m": 60, "h": 60 * 60, "d": 24 * 60 * 60, "w": 7 * 24 * 60 * 60}
+
+# Run columns reported as size distributions, with their OpenMetrics label
+SIZE_COLUMNS = {"bytes_fetched": "fetched", "bytes_pushed": "pushed", "tree_bytes": "tree"}
+
+
+def parse_window(value: str) -> float:
+    match re.fullmatch(r"(\d+)([mhdw])", value):
+        case None:
+            raise argparse.ArgumentTypeError(
+                f"expected a window like 30m, 12h, 7d or 4w: {value!r}"
+            )
+        case m:
+            return int(m[1]) * WINDOW_UNITS[m[2]]
+
+
+def init_parser(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument(
+        "--db",
+        type=Path,
+        help="Metrics database (default: deploy-metrics.sqlite3 in $CI_TOOLS_CACHE_DIR)",
+    )
+    parser.add_argument(
+        "--window",
+        type=parse_window,
+        default="7d",
+        help="How far back to report, e.g. 12h, 7d or 4w",
+    )
+    parser.add_argument(
+        "--import",
+        dest="imports",
+        type=Path,
+        nargs="*",
+        default=[],
+        metavar="FILE",
+        help="JSON lines files of runs to add to the database before reporting",
+    )
+    parser.add_argument("--repo", help="Only report runs for this repository")
+    parser.add_argument("--format", choices=["table", "openmetrics"], default="table")
+
+
+@dataclass(kw_only=True)
+class MetricsParams:
+    db: Path | None
+    imports: list[Path]
+    window: float
+    repo: str | None
+    format: str
+
+
+@dataclass(kw_only=True)
+class Report:
+    durations: dict[str, list[float]]
+    sizes: dict[str, list[float]]
+    outcomes: Counter[str]
+
+
+def run_command(**kwargs) -> None:
+    params = MetricsParams(**kwargs)
+
+    if params.db is not None:
+        store = MetricsStore(params.db)
+    elif (default := metrics.default_store()) is not None:
+        store = default
+    else:
+        raise ValueError("--db is required when CI_TOOLS_CACHE_DIR is not set")
+
+    imported = sum(store.import_records(path) for path in params.imports)
+    if params.imports:
+        print_info_line("metrics", f"imported {imported} runs from {len(params.imports)} files")
+
+    since = time.time() - params.window
+    runs = store.runs_since(since, repo=params.repo)
+
+    report = Report(durations={}, sizes={}, outcomes=Counter(row["outcome"] for row in runs))
+
+    for row in store.phases_since(since, repo=params.repo):
+        report.durations.setdefault(row["phase"], []).append(row["seconds"])
+
+    # Only runs which got as far as deploying say anything about end-to-end latency
+    if deployed := [row["total_seconds"] for row in runs if row["outcome"] == "deployed"]:
+        report.durations["total"] = deployed
+
+    for column, label in SIZE_COLUMNS.items():
+        if values := [row[column] for row in runs if row[column] is not None]:
+            report.sizes[label] = values
+
+    match params.format:
+        case "openmetrics":
+            print(render_openmetrics(report), end="")
+        case _:
+            emit_summary(render_table(report), title=f"Deploy metrics over {len(runs)} runs")
+
+
+def ordered_phases(durations: dict[str, list[float]]) -> list[str]:
+    known = [p for p in [*metrics.PHASES, "total"] if p in durations]
+    return known + sorted(set(durations) - set(known))
+
+
+def render_table(report: Report) -> str:
+    rows = ["| Metric | Runs | p50 | p95 | p99 |", "| --- | --- | --- | --- | --- |"]
+
+    for name in ordered_phases(report.durations):
+        values = report.durations[name]
+        quantiles = " | ".join(f"{metrics.percentile(values, q):.2f} s" for q in QUANTILES)
+        rows.append(f"| {name} | {len(values)} | {quantiles} |")
+
+    for label, values in report.sizes.items():
+        quantiles = " | ".join(f"{metrics.percentile(values, q) / 1024:.0f} KiB" for q in QUANTILES)
+        rows.append(f"| {label} bytes | {len(values)} | {quantiles} |")
+
+    outcomes = ", ".join(f"{outcome} {n}" for outcome, n in report.outcomes.most_common())
+    rows.extend(["", f"Outcomes: {outcomes or 'none'}"])
+
+    return "\n".join(rows)
+
+
+def render_openmetrics(report: Report) -> str:
+    lines: list[str] = []
+
+    summary_family(
+        lines,
+        "ci_tools_deploy_phase_seconds",
+        unit="seconds",
+        help="Time spent in each deploy-commit phase",
+        label="phase",
+        samples={name: report.durations[name] for name in ordered_phases(report.durations)},
+    )
+    summary_family(
+        lines,
+        "ci_tools_deploy_bytes",
+        unit="bytes",
+        help="Bytes fetched, pushed and deployed by deploy-commit",
+        label="kind",
+        samples=report.sizes,
+    )
+
+    lines.extend(
+        [
+            "# TYPE ci_tools_deploy_runs counter",
+            "# HELP ci_tools_deploy_runs deploy-commit runs by outcome",
+        ]
+    )
+    for outcome, n in sorted(report.outcomes.items()):
+        lines.append(f'ci_tools_deploy_runs_total{{outcome="{outcome}"}} {n}')
+
+    lines.append("# EOF")
+    return "\n".join(lines) + "\n"
+
+
+def summary_family(
+    lines: list[str],
+    family: str,
+    *,
+    unit: str,
+    help: str,
+    label: str,
+    samples: dict[str, list[float]],
+) -> None:
+    lines.extend([f"# TYPE {family} summary", f"# UNIT {family} {unit}", f"# HELP {family} {help}"])
+
+    for name, values in samples.items():
+        for q in QUANTILES:
+            lines.append(
+                f'{family}{{{label}="{name}",quantile="{q}"}} {metrics.percentile(values, q):.6g}'
+            )
+        lines.append(f'{family}_sum{{{label}="{name}"}} {sum(values):.6g}')
+        lines.append(f'{family}_count{{{label}="{name}"}} {len(values)}')
@@ -0,0 +1,229 @@
+"""Redeploy the site tree of an earlier deploy
+
+Every deploy is tagged as deploy/master/<n>-<source sha>, and its tree is still in master's
+history. Rolling back commits that tree on top of the current master with no build or copy,
+tags the commit with the next deploy number and the earlier deploy's source commit, and pushes
+both atomically. Sentry records the deploy against the earlier release, which is read from the
+.test-meta.json in the earlier tree.
+
+The whole rollback holds the push lease for the remote, so that deploys from the same machine
+can't take its deploy number.
+"""
+
+from __future__ import annotations
+
+import argparse
+import contextlib
+from dataclasses import dataclass
+import json
+import re
+import shlex
+import subprocess
+
+from .. import leases, object_cache
+from ..gh_state import default_repo
+from ..output import emit_summary, emit_warning, log_group, print_info_line
+from ..utils import resolve_commit, run
+from .deploy_commit import next_deploy_number
+
+DEPLOY_TAG_ROOT = "refs/tags/deploy/master"
+
+DEPLOY_TAG = re.compile(r"deploy/master/(?P<number>\d+)-(?P<source_sha>[0-9a-f]{40})")
+
+
+def init_parser(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument(
+        "target",
+        help="Deploy to roll back to, as a deploy number or a deploy/master/<n>-<sha> tag",
+    )
+    parser.add_argument("--remote", default="origin")
+    parser.add_argument(
+        "--repo",
+        default=default_repo(),
+        help="GitHub repository as owner/name (default: $GITHUB_REPOSITORY)",
+    )
+    parser.add_argument("--run-url", required=True, help="URL describing this run")
+    parser.add_argument("--dry-run", action="store_true")
+
+
+@dataclass(kw_only=True)
+class RollbackParams:
+    target: str
+    remote: str
+    repo: str
+    run_url: str
+    dry_run: bool
+
+
+@dataclass(frozen=True, kw_only=True)
+class DeployTag:
+    name: str
+    number: str
+    source_sha: str
+
+    @staticmethod
+    def parse(name: str) -> DeployTag:
+        name = name.removeprefix("refs/tags/")
+
+        match DEPLOY_TAG.fullmatch(name):
+            case None:
+                raise ValueError(f"not a deploy tag: {name!r}")
+            case m:
+                return DeployTag(name=name, number=m["number"], source_sha=m["source_sha"])
+
+
+def run_command(**kwargs) -> None:
+    params = RollbackParams(**kwargs)
+
+    cache = object_cache.default_cache()
+
+    with (
+        cache.attached() if cache is not None else contextlib.nullcontext(),
+        leases.push_lease(params.remote),
+    ):
+        rollback(params)
+
+
+def rollback(params: RollbackParams) -> None:
+    remote_master = f"refs/remotes/{params.remote}/master"
+
+    fetch_deploys(params)
+
+    target = find_deploy_tag(params.target)
+    target_commit = resolve_commit(f"refs/tags/{target.name}")
+    master_sha = resolve_commit(remote_master)
+
+    tree = run(["git", "rev-parse", "--verify", f"{target_commit}^{{tree}}"]).removesuffix("\n")
+
+    if tree == run(["git", "rev-parse", "--verify", f"{master_sha}^{{tree}}"]).removesuffix("\n"):
+        emit_summary(f"master already serves the tree of {target.name}; nothing to roll back")
+        return
+
+    release_version = get_release_version(target_commit)
+    deploy_number = next_deploy_number(remote_master)
+    deploy_tag = f"deploy/master/{deploy_number}-{target.source_sha}"
+
+    rollback_commit = run(
+        [
+            "git",
+            "commit-tree",
+            tree,
+            "-p",
+            master_sha,
+            "-m",
+            f"Roll back GitHub Pages to deploy {target.number} [{deploy_number}]",
+            "-m",
+            f"Redeploys the tree of {target.name} ({target_commit}).",
+            "-m",
+            params.run_url,
+        ]
+    ).removesuffix("\n")
+
+    # Replaces any tag left behind by an earlier dry run; the push refuses to replace a remote tag
+    run(
+        [
+            "git",
+            "tag",
+            "--force",
+            "-a",
+            deploy_tag,
+            rollback_commit,
+            "-m",
+            f"Deploy {deploy_number} rolling back to deploy {target.number}",
+            "-m",
+            params.run_url,
+        ]
+    )
+
+    push_args = [
+        "--atomic",
+        f"--force-with-lease=refs/heads/master:{master_sha}",
+        params.remote,
+        f"{rollback_commit}:refs/heads/master",
+        f"refs/tags/{deploy_tag}:refs/tags/{deploy_tag}",
+    ]
+
+    if params.dry_run:
+        push_args.insert(0, "--dry-run")
+
+    run(["git", "push", *push_args], network="git-push", idempotent=False)
+
+    if release_version is not None:
+        record_sentry_deploy(params, release_version=release_version, deploy_number=deploy_number)
+
+    emit_summary(f"Rolled back master to deploy {target.number} as deploy {deploy_number}")
+
+
+@log_group("Fetch deploys")
+def fetch_deploys(params: RollbackParams) -> None:
+    # The full history of master is needed for the deploy number; the tags' commits are in it
+    run(
+        [
+            "git",
+            "fetch",
+            "--no-tags",
+            "--",
+            params.remote,
+            f"+refs/heads/master:refs/remotes/{params.remote}/master",
+            f"+{DEPLOY_TAG_ROOT}/*:{DEPLOY_TAG_ROOT}/*",
+        ],
+        network="git-fetch",
+    )
+
+    if (cache := object_cache.default_cache()) is not None:
+        cache.update(params.remote, {"master": f"refs/remotes/{params.remote}/master"})
+
+
+def find_deploy_tag(target: str) -> DeployTag:
+    if not target.isdigit():
+        return DeployTag.parse(target)
+
+    tags = run(
+        ["git", "for-each-ref", "--format=%(refname)", f"{DEPLOY_TAG_ROOT}/{target}-*"]
+    ).split()
+
+    match tags:
+        case [tag]:
+            return DeployTag.parse(tag)
+        case []:
+            raise ValueError(f"no deploy tag for deploy {target}")
+        case _:
+            raise ValueError(f"ambiguous deploy number {target}: {', '.join(tags)}")
+
+
+def get_release_version(commit: str) -> str | None:
+    """Read the Sentry release an earlier deploy was built as from its .test-meta.json"""
+    try:
+        test_meta = json.loads(run(["git", "show", f"{commit}:.test-meta.json"]))
+    except subprocess.CalledProcessError:
+        test_meta = None
+
+    match test_meta:
+        case {"release_version": str(release_version)}:
+            print_info_line("release", release_version)
+            return release_version
+
+        case _:
+            emit_warning(f"No release version in {commit}; not recording a Sentry deploy")
+            return None
+
+
+@log_group("Record sentry deploy")
+def record_sentry_deploy(params: RollbackParams, release_version: str, deploy_number: str) -> None:
+    args = [
+        "releases",
+        "deploys",
+        release_version,
+        "new",
+        "--name",
+        deploy_number,
+        "--env",
+        "production",
+        "--url",
+        params.run_url,
+    ]
+
+    if params.dry_run:
+        print_info_line("run [dry-run]", "sentry-cli", *(shlex.quote(s) for s in args))
+    else:
+        run(["sentry-cli", *args], network="sentry", idempotent=False)
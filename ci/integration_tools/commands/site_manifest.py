@@ -0,0 +1,52 @@
+"""Write a content manifest of a built site for deploy-commit to verify
+
+Lists each file and symlink with its size, git mode and git blob ID. With --files-from, only the
+listed paths (NUL-separated, as from `git ls-files -z`, and under DIR) are included; otherwise the
+whole of DIR is.
+"""
+
+from __future__ import annotations
+
+import argparse
+from dataclasses import dataclass
+from pathlib import Path
+
+from ..merge_deploy import manifest
+from ..output import print_info_line
+
+
+def init_parser(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument("dir", type=Path, help="Directory containing the site content")
+    parser.add_argument("--output", type=Path, required=True, help="Manifest file to write")
+    parser.add_argument(
+        "--files-from", type=Path, help="NUL-separated list of the paths to include"
+    )
+
+
+@dataclass(kw_only=True)
+class SiteManifestParams:
+    dir: Path
+    output: Path
+    files_from: Path | None
+
+
+def run_command(**kwargs) -> None:
+    params = SiteManifestParams(**kwargs)
+
+    if params.files_from is None:
+        paths = manifest.list_tree(params.dir)
+    else:
+        paths = [
+            Path(path).relative_to(params.dir).as_posix()
+            for path in params.files_from.read_text().split("\0")
+            if path
+        ]
+
+    site_manifest = manifest.build_manifest(params.dir, paths)
+    manifest.write_manifest(site_manifest, params.output)
+
+    print_info_line(
+        "manifest",
+        f"{params.output}: {len(site_manifest)} files, "
+        f"{sum(e.size for e in site_manifest.values())} bytes",
+    )
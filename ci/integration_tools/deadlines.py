@@ -0,0 +1,182 @@
+"""
+Timeouts, retries and an overall deadline for network operations
+
+Each network operation has a kind (a GitHub API request, a git fetch, a git push or a sentry-cli
+call) whose policy gives its initial timeout and the bounds its timeout may adapt within. Once a
+kind has completed a few operations, its timeout follows the slowest of its recent latencies, so
+that a stalled connection is abandoned once it's clearly slower than usual rather than at the
+workflow's time limit. A run-wide budget (see budget()) caps every timeout, so that no one
+operation can take the run past its deadline.
+
+Operations which are safe to repeat are retried after timeouts and transient failures, with
+exponential backoff and full jitter.
+"""
+
+from __future__ import annotations
+
+from collections import deque
+import contextlib
+from dataclasses import dataclass
+import random
+import subprocess
+import threading
+import time
+from typing import Callable, Iterator, Literal, TypeVar
+
+from .output import emit_warning
+
+Kind = Literal["github", "git-fetch", "git-push", "sentry"]
+
+
+@dataclass(frozen=True, kw_only=True)
+class Policy:
+    initial: float
+    """Timeout in seconds until enough latencies have been observed"""
+    floor: float
+    ceiling: float
+    attempts: int = 3
+    backoff: float = 1.0
+    """Upper bound of the first retry's delay in seconds, doubling with each retry"""
+    max_backoff: float = 30.0
+
+
+POLICIES: dict[Kind, Policy] = {
+    "github": Policy(initial=30, floor=5, ceiling=120, attempts=4),
+    "git-fetch": Policy(initial=600, floor=60, ceiling=1800),
+    "git-push": Policy(initial=300, floor=60, ceiling=900),
+    "sentry": Policy(initial=300, floor=30, ceiling=900),
+}
+
+# An adapted timeout is this multiple of the 95th percentile of recent latencies
+LATENCY_MULTIPLIER = 4.0
+
+# Latencies needed before a kind's timeout adapts, and how many recent ones are considered
+MIN_SAMPLES = 5
+SAMPLE_WINDOW = 50
+
+
+class DeadlineExceededError(TimeoutError):
+    pass
+
+
+class LatencyTracker:
+    def __init__(self, policy: Policy) -> None:
+        self.policy = policy
+        self._lock = threading.Lock()
+        self._samples: deque[float] = deque(maxlen=SAMPLE_WINDOW)
+
+    def observe(self, seconds: float) -> None:
+        with self._lock:
+            self._samples.append(seconds)
+
+    def timeout(self) -> float:
+        with self._lock:
+            samples = sorted(self._samples)
+
+        if len(samples) < MIN_SAMPLES:
+            return self.policy.initial
+
+        p95 = samples[min(len(samples) - 1, int(0.95 * len(samples)))]
+        return min(max(p95 * LATENCY_MULTIPLIER, self.policy.floor), self.policy.ceiling)
+
+
+_trackers = {kind: LatencyTracker(policy) for kind, policy in POLICIES.items()}
+
+_deadline: float | None = None
+
+
+@contextlib.contextmanager
+def budget(seconds: float | None) -> Iterator[None]:
+    """Limit network operations started within the block to the given number of seconds
+
+    Nested budgets can only shorten the deadline.
+    """
+    global _deadline
+
+    previous = _deadline
+    if seconds is not None:
+        deadline = time.monotonic() + seconds
+        _deadline = deadline if previous is None else min(previous, deadline)
+
+    try:
+        yield
+    finally:
+        _deadline = previous
+
+
+def remaining() -> float | None:
+    return None if _deadline is None else _deadline - time.monotonic()
+
+
+def timeout_for(kind: Kind) -> float:
+    """Return the timeout for an operation starting now, within the remaining budget"""
+    timeout = _trackers[kind].timeout()
+
+    if (left := remaining()) is not None:
+        if left <= 0:
+            raise DeadlineExceededError(f"run deadline passed before starting {kind} operation")
+        timeout = min(timeout, left)
+
+    return timeout
+
+
+_T = TypeVar("_T")
+
+
+def call(
+    kind: Kind,
+    operation: Callable[[float], _T],
+    *,
+    retryable: Callable[[Exception], bool],
+    idempotent: bool = True,
+    description: str,
+) -> _T:
+    """Run operation with a timeout, retrying if it's idempotent and fails in a retryable way
+
+    The operation is passed its timeout in seconds and is expected to raise once it's exceeded.
+    """
+    policy = POLICIES[kind]
+    tracker = _trackers[kind]
+    attempts = policy.attempts if idempotent else 1
+
+    for attempt in range(1, attempts + 1):
+        timeout = timeout_for(kind)
+        start = time.monotonic()
+
+        try:
+            result = operation(timeout)
+        except Exception as exc:
+            # A timed-out attempt took at least this long, which lengthens later timeouts
+            if isinstance(exc, (TimeoutError, subprocess.TimeoutExpired)):
+                tracker.observe(time.monotonic() - start)
+
+            if attempt == attempts or not retryable(exc):
+                raise
+
+            delay = random.uniform(0, min(policy.max_backoff, policy.backoff * 2 ** (attempt - 1)))
+
+            if (left := remaining()) is not None and left <= delay:
+                raise
+
+            emit_warning(
+                f"{description} failed on attempt {attempt} of {attempts} "
+                f"({_describe(exc)}); retrying in {delay:.1f}s"
+            )
+            time.sleep(delay)
+            continue
+
+        tracker.observe(time.monotonic() - start)
+        return result
+
+    raise AssertionError("unreachable")
+
+
+def _describe(exc: Exception) -> str:
+    description = f"{type(exc).__name__}: {exc}"
+
+    # The last line of a failed process's error output usually says what went wrong
+    match getattr(exc, "stderr", None):
+        case str(stderr) if stderr.strip():
+            description += f" {stderr.strip().splitlines()[-1]}"
+
+    return description
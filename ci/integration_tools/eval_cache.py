@@ -0,0 +1,168 @@
+"""
+Persistent cache of pull request evaluations
+
+Entries are stored per pull request along with the ETags of the responses they were computed
+from and a key made of everything ci/pull-request/pull-request.jq depends on (head and base
+refs, head, base and merge SHAs, labels, draft state, mergeability, author association and
+reviews). An evaluation is reused when GitHub reports both responses unmodified or when the
+refetched state produces the same key. Evaluations made while GitHub's mergeability is still
+unknown are never stored.
+
+Replayed runs get the entries the recorded run found, and leave the cache file as it is.
+"""
+
+from __future__ import annotations
+
+import contextlib
+from dataclasses import dataclass
+import fcntl
+import json
+import os
+from pathlib import Path
+import tempfile
+import threading
+import time
+from typing import Any, Iterator
+
+from . import cassette
+from .utils import cache_dir
+
+CACHE_VERSION = 3
+DEFAULT_MAX_ENTRIES = 256
+
+
+@dataclass(kw_only=True)
+class CachedEvaluation:
+    pr_etag: str | None
+    reviews_etag: str | None
+    key: list[Any]
+    raw: str
+
+
+def evaluation_key(pr: dict[str, Any], reviews: list[dict[str, Any]]) -> list[Any]:
+    return [
+        pr["head"]["ref"],
+        pr["base"]["ref"],
+        pr["head"]["sha"],
+        pr["base"]["sha"],
+        pr["merge_commit_sha"],
+        sorted(label["name"] for label in pr["labels"]),
+        pr["draft"],
+        pr["mergeable"],
+        pr["author_association"],
+        sorted((r["id"], r["state"], r["author_association"]) for r in reviews),
+    ]
+
+
+class EvaluationCache:
+    def __init__(self, path: Path, max_entries: int = DEFAULT_MAX_ENTRIES) -> None:
+        self.path = path
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+
+    def get(self, repo: str, pr_number: int) -> CachedEvaluation | None:
+        name = _entry_name(repo, pr_number)
+        entry = cassette.local_value(f"cached evaluation {name}", lambda: self._use(name))
+        if entry is None:
+            return None
+
+        return CachedEvaluation(
+            pr_etag=entry["pr_etag"],
+            reviews_etag=entry["reviews_etag"],
+            key=entry["key"],
+            raw=entry["raw"],
+        )
+
+    def put(self, repo: str, pr_number: int, evaluation: CachedEvaluation) -> None:
+        if cassette.replaying():
+            return
+
+        with self._locked_entries() as entries:
+            entries[_entry_name(repo, pr_number)] = {
+                "pr_etag": evaluation.pr_etag,
+                "reviews_etag": evaluation.reviews_etag,
+                "key": evaluation.key,
+                "raw": evaluation.raw,
+                "last_used": time.time(),
+            }
+
+            # Evict least recently used entries beyond the cap
+            excess = len(entries) - self.max_entries
+            if excess > 0:
+                for name in sorted(entries, key=lambda n: entries[n]["last_used"])[:excess]:
+                    del entries[name]
+
+    def invalidate(self, repo: str, pr_number: int) -> None:
+        if cassette.replaying():
+            return
+
+        with self._locked_entries() as entries:
+            entries.pop(_entry_name(repo, pr_number), None)
+
+    def _use(self, name: str) -> dict[str, Any] | None:
+        """Look up an entry, marking it as used"""
+        with self._locked_entries() as entries:
+            entry: dict[str, Any] | None = entries.get(name)
+            if entry is not None:
+                entry["last_used"] = time.time()
+
+        return entry
+
+    @contextlib.contextmanager
+    def _locked_entries(self) -> Iterator[dict[str, Any]]:
+        """Read-modify-write the cache file while holding an exclusive lock
+
+        The lock file is separate from the data file since the latter is replaced atomically.
+        """
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+
+        with self._lock, open(f"{self.path}.lock", "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+
+            entries = self._load()
+            snapshot = json.dumps(entries, sort_keys=True)
+
+            yield entries
+
+            if json.dumps(entries, sort_keys=True) != snapshot:
+                self._store(entries)
+
+    def _load(self) -> dict[str, Any]:
+        try:
+            content = json.loads(self.path.read_text())
+        except FileNotFoundError:
+            return {}
+        except ValueError:
+            # A corrupt cache is just a cold cache
+            return {}
+
+        match content:
+            case {"version": int(version), "entries": dict(entries)} if version == CACHE_VERSION:
+                return entries
+            case _:
+                return {}
+
+    def _store(self, entries: dict[str, Any]) -> None:
+        with tempfile.NamedTemporaryFile(
+            "w", dir=self.path.parent, prefix=f"{self.path.name}.", delete=False
+        ) as f:
+            json.dump({"version": CACHE_VERSION, "entries": entries}, f)
+
+        os.replace(f.name, self.path)
+
+
+def _entry_name(repo: str, pr_number: int) -> str:
+    return f"{repo}#{pr_number}"
+
+
+_default_cache: EvaluationCache | None = None
+
+
+def default_cache() -> EvaluationCache | None:
+    """Return the process-wide cache if a cache directory is configured"""
+    global _default_cache
+
+    if _default_cache is None and (root := cache_dir()) is not None:
+        _default_cache = EvaluationCache(root / "pr-evaluations.json")
+
+    return _default_cache
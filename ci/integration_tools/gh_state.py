@@ -2,22 +2,72 @@
 
 from __future__ import annotations
 
+import codecs
 from dataclasses import dataclass
 import dataclasses
+import functools
+import http.client
 from http.client import HTTPResponse
 import json
 from pathlib import Path
 from tempfile import NamedTemporaryFile
-from typing import Any
+import re
+import time
+from typing import IO, Any, Iterator
 from urllib.error import HTTPError
-from urllib.parse import quote_plus
-from urllib.request import Request, urlopen
+from urllib.parse import quote, quote_plus
+from urllib.request import Request
 import os
 
+from . import cassette, deadlines, eval_cache
+from .eval_cache import CachedEvaluation, EvaluationCache
+from .gh_transport import POOL
 from .utils import run
 from .output import print_info_line, print_info_multi
 
-REPO = "wabain/wabain.github.io"
+DEFAULT_REPO = "wabain/wabain.github.io"
+
+# Name of the workflow whose successful run for a pull request's head allows it to be deployed
+BUILD_WORKFLOW_NAME = "Build and test"
+
+# Bounds of the delay between polls while GitHub computes a pull request's mergeability
+MERGEABILITY_POLL_MIN_SECONDS = 1.0
+MERGEABILITY_POLL_MAX_SECONDS = 8.0
+
+_REPO_PATH = re.compile(r"repos/(?P<repo>[^/]+/[^/?]+)(?P<rest>[/?].*)?$")
+
+
+def default_repo() -> str:
+    return os.getenv("GITHUB_REPOSITORY") or DEFAULT_REPO
+
+
+def api_url() -> str:
+    return os.getenv("GITHUB_API_URL") or "https://api.github.com"
+
+
+@dataclass(frozen=True, kw_only=True)
+class PullRequestSummary:
+    """The parts of a pull request listing entry which candidate selection uses"""
+
+    number: int
+    labels: tuple[str, ...]
+    created_at: str
+    head_ref: str
+    head_sha: str
+    base_ref: str
+    base_sha: str
+
+    @staticmethod
+    def from_listing(pr: dict[str, Any]) -> PullRequestSummary:
+        return PullRequestSummary(
+            number=pr["number"],
+            labels=tuple(label["name"] for label in pr["labels"]),
+            created_at=pr["created_at"],
+            head_ref=pr["head"]["ref"],
+            head_sha=pr["head"]["sha"],
+            base_ref=pr["base"]["ref"],
+            base_sha=pr["base"]["sha"],
+        )
 
 
 @dataclass(kw_only=True)
@@ -29,26 +79,133 @@ class PullRequestEvaluation:
     base_ref: str
     merge_sha: str | None
 
+    labels: list[str]
     merge_pending_label_present: bool
     pr_is_eligible: bool
     pr_may_be_eligible: bool
 
     pr_eligibility: dict[str, Any]
 
+    @property
+    def mergeability_pending(self) -> bool:
+        """Whether only GitHub's still unknown mergeability stands in the way of eligibility"""
+        return (
+            self.pr_may_be_eligible
+            and not self.pr_is_eligible
+            and self.pr_eligibility.get("mergeable") is None
+        )
 
-def evaluate_pull_request_state(pr_number: int) -> PullRequestEvaluation:
-    with get_github_api(f"/repos/{REPO}/pulls/{pr_number}") as response:
-        if response.status != 200:
-            raise ValueError(f"unsuccessful pull request query response: {response}")
 
-        pr = json.load(response)
+def evaluate_pull_request_state(
+    pr_number: int, *, repo: str, cache: EvaluationCache | None = None
+) -> PullRequestEvaluation:
+    cache = cache or eval_cache.default_cache()
+    cached = cache.get(repo, pr_number) if cache is not None else None
+
+    pr_url = f"/repos/{repo}/pulls/{pr_number}"
+    reviews_url = f"{pr_url}/reviews"
+
+    pr, pr_etag = _get_json_if_modified(pr_url, cached.pr_etag if cached else None)
+    reviews, reviews_etag = _get_json_if_modified(
+        reviews_url, cached.reviews_etag if cached else None
+    )
+
+    if cached is not None and pr is None and reviews is None:
+        return _load_evaluation(pr_number, cached.raw, source="unmodified")
+
+    # At least one side changed; we need both bodies to compute the key
+    if pr is None:
+        pr, pr_etag = _get_json_if_modified(pr_url, None)
+    if reviews is None:
+        reviews, reviews_etag = _get_json_if_modified(reviews_url, None)
+
+    assert pr is not None and reviews is not None
+
+    key = eval_cache.evaluation_key(pr, reviews)
+
+    if cached is not None and cached.key == key and pr["mergeable"] is not None:
+        eval_result = cached.raw
+        source = "cached"
+    else:
+        eval_result = _run_evaluation(pr_number, pr, reviews)
+        source = None
+
+    if cache is not None:
+        if pr["mergeable"] is None:
+            # GitHub is still computing mergeability; the result is about to go stale
+            cache.invalidate(repo, pr_number)
+        else:
+            cache.put(
+                repo,
+                pr_number,
+                CachedEvaluation(
+                    pr_etag=pr_etag, reviews_etag=reviews_etag, key=key, raw=eval_result
+                ),
+            )
+
+    return _load_evaluation(pr_number, eval_result, source=source)
+
+
+def wait_for_mergeability(
+    pr_number: int, pr_eval: PullRequestEvaluation, *, repo: str, timeout: float
+) -> tuple[PullRequestEvaluation, float]:
+    """Re-evaluate a pull request once GitHub has computed whether it can be merged
+
+    The pull request is polled with conditional requests, which don't count against the rate
+    limit while nothing changes, backing off while its mergeability stays unknown. Returns the
+    latest evaluation, whose mergeability is still pending if the timeout or the run's deadline
+    passed first, and the seconds spent waiting.
+    """
+    pr_url = f"/repos/{repo}/pulls/{pr_number}"
+    etag = None
+    delay = MERGEABILITY_POLL_MIN_SECONDS
+    polls = 0
+    start = time.monotonic()
+
+    while pr_eval.mergeability_pending:
+        left = timeout - (time.monotonic() - start)
+        if (run_left := deadlines.remaining()) is not None:
+            left = min(left, run_left)
+
+        if left <= 0:
+            break
+
+        time.sleep(min(delay, left))
+
+        pr, etag = _get_json_if_modified(pr_url, etag)
+        polls += 1
+
+        if pr is not None and pr["mergeable"] is not None:
+            pr_eval = evaluate_pull_request_state(pr_number, repo=repo)
+        else:
+            delay = min(delay * 2, MERGEABILITY_POLL_MAX_SECONDS)
+
+    waited = time.monotonic() - start
+
+    print_info_line(
+        f"#{pr_number} mergeability",
+        "still unknown" if pr_eval.mergeability_pending else "known",
+        f"after {waited:.1f}s and {polls} polls",
+    )
+
+    return pr_eval, waited
+
+
+def _get_json_if_modified(url: str, etag: str | None) -> tuple[Any, str | None]:
+    """Fetch JSON from the API, returning None for the content if it matches the given ETag"""
+    headers = {"If-None-Match": etag} if etag else {}
+
+    with get_github_api(url, headers=headers) as response:
+        if response.status == 304 and etag:
+            return None, etag
 
-    with get_github_api(pr["_links"]["self"]["href"] + "/reviews") as response:
         if response.status != 200:
-            raise ValueError(f"unsuccessful pull request review query response: {response}")
+            raise ValueError(f"unsuccessful query response for {url}: {response.status}")
+
+        return json.load(response), response.headers.get("ETag")
 
-        reviews = json.load(response)
 
+def _run_evaluation(pr_number: int, pr: dict[str, Any], reviews: list[dict[str, Any]]) -> str:
     with (
         NamedTemporaryFile(mode="wt+", prefix=f"pr-{pr_number}.", suffix=".json") as pr_file,
         NamedTemporaryFile(
@@ -63,7 +220,7 @@ def evaluate_pull_request_state(pr_number: int) -> PullRequestEvaluation:
 
         root_path = Path(__file__).parent.parent
 
-        eval_result = run(
+        return run(
             [
                 "jq",
                 "--slurp",
@@ -74,6 +231,10 @@ def evaluate_pull_request_state(pr_number: int) -> PullRequestEvaluation:
             ]
         )
 
+
+def _load_evaluation(
+    pr_number: int, eval_result: str, source: str | None = None
+) -> PullRequestEvaluation:
     mergeability = json.loads(eval_result)
 
     for k in ["head_commit", "base_commit", "merge_commit"]:
@@ -81,7 +242,7 @@ def evaluate_pull_request_state(pr_number: int) -> PullRequestEvaluation:
             del mergeability[k]
 
     print_info_multi(
-        f"#{pr_number} eval",
+        f"#{pr_number} eval" + (f" ({source})" if source else ""),
         f'eligible {json.dumps(mergeability["pr_is_eligible"])}',
         json.dumps(mergeability, indent=2),
     )
@@ -89,19 +250,157 @@ def evaluate_pull_request_state(pr_number: int) -> PullRequestEvaluation:
     return PullRequestEvaluation(**mergeability, raw=eval_result)
 
 
-def add_label(pr_number: int, label: str) -> None:
-    get_github_api(
-        f"/repos/{REPO}/issues/{pr_number}/labels",
+def add_label(pr_number: int, label: str, *, repo: str) -> None:
+    add_labels(pr_number, [label], repo=repo)
+
+
+def add_labels(pr_number: int, labels: list[str], *, repo: str) -> None:
+    send_github_api(
+        f"/repos/{repo}/issues/{pr_number}/labels",
         method="POST",
-        data=json.dumps({"labels": [label]}).encode(),
+        data=json.dumps({"labels": labels}).encode(),
     )
 
 
-def remove_label(pr_number: int, label: str) -> None:
+def set_labels(pr_number: int, labels: list[str], *, repo: str) -> None:
+    """Replace all of a pull request's labels"""
+    send_github_api(
+        f"/repos/{repo}/issues/{pr_number}/labels",
+        method="PUT",
+        data=json.dumps({"labels": labels}).encode(),
+    )
+
+
+def remove_label(pr_number: int, label: str, *, repo: str) -> None:
     if label != quote_plus(label):
         raise ValueError(f"invalid label: {label}")
 
-    get_github_api(f"/repos/{REPO}/issues/{pr_number}/labels/{label}", method="DELETE")
+    send_github_api(f"/repos/{repo}/issues/{pr_number}/labels/{label}", method="DELETE")
+
+
+def list_open_pull_requests(repo: str, per_page: int = 100) -> Iterator[PullRequestSummary]:
+    """Yield summaries of the repository's open pull requests, oldest first
+
+    Listing entries carry the body and both repositories in full, so each page is decoded one
+    entry at a time as it's read and only the summary is kept. Pages are requested as the
+    summaries are consumed, so memory use depends on the page size and not on how many pull
+    requests are open.
+    """
+    url: str | None = (
+        f"/repos/{repo}/pulls?state=open&sort=created&direction=asc&per_page={per_page}"
+    )
+
+    while url is not None:
+        # The page's summaries are collected before yielding any, so that the connection isn't
+        # held open for however long the caller takes over them
+        with get_github_api(url) as response:
+            url = _next_page_url(response.headers.get("Link"))
+            page = [PullRequestSummary.from_listing(pr) for pr in _iter_json_array(response)]
+
+        yield from page
+
+
+def find_pull_request_workflow_run(
+    pr_eval: PullRequestEvaluation, *, repo: str
+) -> dict[str, Any] | None:
+    """Locate the build workflow run for the pull request's current head commit"""
+    return find_workflow_run(
+        event="pull_request", branch=pr_eval.head_ref, head_sha=pr_eval.head_sha, repo=repo
+    )
+
+
+def find_workflow_run(
+    *, event: str, branch: str, head_sha: str, repo: str, per_page: int = 25
+) -> dict[str, Any] | None:
+    """Locate the most recent build workflow run for a commit"""
+    url: str | None = (
+        f"/repos/{repo}/actions/runs?event={event}"
+        f"&branch={quote(branch, safe='')}&head_sha={head_sha}&per_page={per_page}"
+    )
+
+    while url is not None:
+        with get_github_api(url) as response:
+            page = json.load(response)
+            url = _next_page_url(response.headers.get("Link"))
+
+        for workflow_run in page["workflow_runs"]:
+            if (
+                workflow_run["name"] == BUILD_WORKFLOW_NAME
+                and workflow_run["event"] == event
+                and workflow_run["head_sha"] == head_sha
+            ):
+                return workflow_run
+
+    return None
+
+
+def compare_commits(base: str, head: str, *, repo: str) -> str:
+    """Describe head relative to base as one of ahead, behind, identical or diverged"""
+    with get_github_api(f"/repos/{repo}/compare/{base}...{head}?per_page=1") as response:
+        return json.load(response)["status"]
+
+
+def _iter_json_array(stream: IO[bytes], chunk_size: int = 64 * 1024) -> Iterator[Any]:
+    """Decode the elements of a JSON array one at a time as the stream is read
+
+    Only the element being decoded and the unread rest of the current chunk are held in memory.
+    """
+    decoder = json.JSONDecoder()
+    utf8 = codecs.getincrementaldecoder("utf-8")()
+    buffer, pos, eof = "", 0, False
+    expecting = "["
+
+    while True:
+        while pos < len(buffer) and buffer[pos] in " \t\n\r":
+            pos += 1
+
+        if pos < len(buffer):
+            match expecting, buffer[pos]:
+                case "[", "[":
+                    pos += 1
+                    expecting = "first"
+                    continue
+
+                case ("first" | "separator"), "]":
+                    return
+
+                case "separator", ",":
+                    pos += 1
+                    expecting = "value"
+                    continue
+
+                case ("first" | "value"), _:
+                    try:
+                        value, end = decoder.raw_decode(buffer, pos)
+                    except json.JSONDecodeError:
+                        if eof:
+                            raise
+                    else:
+                        # A value running to the end of the buffer may continue in the next chunk
+                        if end < len(buffer) or eof:
+                            yield value
+                            buffer, pos = buffer[end:], 0
+                            expecting = "separator"
+                            continue
+
+                case _:
+                    raise ValueError(f"expected {expecting!r} in JSON array, got {buffer[pos]!r}")
+
+        if eof:
+            raise ValueError("truncated JSON array")
+
+        chunk = stream.read(chunk_size)
+        eof = not chunk
+        buffer, pos = buffer[pos:] + utf8.decode(chunk, final=eof), 0
+
+
+def _next_page_url(link_header: str | None) -> str | None:
+    for link in (link_header or "").split(","):
+        match link.strip().split(";"):
+            case [target, *link_params] if any(p.strip() == 'rel="next"' for p in link_params):
+                return target.strip().removeprefix("<").removesuffix(">")
+
+    return None
 
 
 def get_github_api(
@@ -114,30 +413,29 @@ def get_github_api(
 ) -> HTTPResponse:
     base_headers = {
         "Accept": "application/vnd.github.v3+json",
-        "User-Agent": REPO,
+        "User-Agent": DEFAULT_REPO,
     }
 
     if (token := token or os.getenv("GH_TOKEN")) is not None:
         base_headers["Authorization"] = f"token {token}"
 
+    api_root = api_url().removesuffix("/") + "/"
+
     url = subpath
     if not (url.startswith("http://") or url.startswith("https://")):
-        url = "https://api.github.com/" + subpath.removeprefix("/")
+        url = api_root + subpath.removeprefix("/")
 
-    if (relative_url := url.removeprefix("https://api.github.com/")) != url:
-        if (repo_url := relative_url.removeprefix(f"repos/{REPO}/")) != relative_url:
-            relative_url = "<repo>/" + repo_url
+    if (relative_url := url.removeprefix(api_root)) != url:
+        if (repo_match := _REPO_PATH.match(relative_url)) is not None:
+            relative_url = f"<{repo_match['repo']}>" + (repo_match["rest"] or "")
         else:
             relative_url = "<github>/" + relative_url
     print_info_line(method.lower(), relative_url)
 
     req = Request(url, headers={**base_headers, **(headers or {})}, method=method, data=data)
 
-    try:
-        response = urlopen(req)
-
-        if not isinstance(response, HTTPResponse):
-            raise TypeError(f"unexpected response type for {method} request to {url}: {response!r}")
+    def attempt(timeout: float) -> HTTPResponse:
+        response = cassette.open_request(req, opener=functools.partial(POOL.open, timeout=timeout))
 
         match response.status:
             case s if not check_status or 200 <= s < 300:
@@ -149,12 +447,42 @@ def get_github_api(
                     raise HTTPError(req.full_url, response.status, msg, response.headers, None)
 
             case _:
+                response.close()
                 raise HTTPError(
                     req.full_url, response.status, response.reason, response.headers, None
                 )
 
         return response
 
+    try:
+        return deadlines.call(
+            "github",
+            attempt,
+            retryable=_is_transient_failure,
+            idempotent=method in ("GET", "HEAD"),
+            description=f"{method} {relative_url}",
+        )
+
     except HTTPError as exc:
         exc.add_note(f"unsuccessful {method} request to {url}")
         raise
+
+
+def send_github_api(subpath: str, **kwargs: Any) -> None:
+    """Make a request whose response isn't needed
+
+    The response is read to the end and closed, which lets the pool reuse its connection.
+    """
+    with get_github_api(subpath, **kwargs) as response:
+        response.read()
+
+
+def _is_transient_failure(exc: Exception) -> bool:
+    match exc:
+        case HTTPError(code=code):
+            return code in (500, 502, 503, 504)
+        case OSError() | http.client.HTTPException():
+            # Includes timeouts and connections reset or closed by the server
+            return True
+        case _:
+            return False
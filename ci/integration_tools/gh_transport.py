@@ -0,0 +1,298 @@
+"""
+Shared HTTP transport for GitHub API requests
+
+Requests are sent over a process-wide pool of keep-alive connections so that commands issuing
+many requests (possibly from several threads, and against several repositories) don't pay for a
+new TLS handshake each time. The pool also tracks the rate limit headers GitHub returns for each
+token so that callers slow down before the budget is exhausted instead of failing outright.
+"""
+
+from __future__ import annotations
+
+from dataclasses import dataclass
+import hashlib
+import http.client
+from http.client import HTTPConnection, HTTPResponse, HTTPSConnection
+import select
+import ssl
+import threading
+import time
+from urllib.parse import urljoin, urlsplit
+from urllib.request import Request
+
+from .output import emit_warning, print_info_line
+
+MAX_REDIRECTS = 5
+
+# Methods which have the same effect however many times a request is sent
+IDEMPOTENT_METHODS = frozenset(["GET", "HEAD", "PUT", "DELETE"])
+
+
+class RateLimitExhaustedError(RuntimeError):
+    pass
+
+
+@dataclass
+class _TokenBudget:
+    limit: int | None = None
+    remaining: int | None = None
+    reset_at: float | None = None
+
+
+class RateLimitBudget:
+    """Track the primary rate limit budget reported by GitHub for each token
+
+    When the remaining budget for a token drops to the reserve, requests using that token wait
+    for the reset time (up to max_wait seconds) rather than spending the rest of the budget.
+    """
+
+    def __init__(self, reserve: int = 50, max_wait: float = 300.0) -> None:
+        self.reserve = reserve
+        self.max_wait = max_wait
+        self._lock = threading.Lock()
+        self._budgets: dict[str, _TokenBudget] = {}
+
+    def before_request(self, key: str) -> None:
+        with self._lock:
+            budget = self._budgets.get(key)
+            if budget is None or budget.remaining is None:
+                return
+
+            if budget.remaining > self.reserve:
+                budget.remaining -= 1
+                return
+
+            remaining = budget.remaining
+            wait = (budget.reset_at or 0) - time.time()
+
+            # Whatever happens next, the budget needs to be refreshed from a response
+            budget.remaining = None
+
+        if wait <= 0:
+            return
+
+        if wait > self.max_wait:
+            raise RateLimitExhaustedError(
+                f"rate limit budget exhausted: {remaining} requests remaining, "
+                f"reset in {wait:.0f}s"
+            )
+
+        emit_warning(f"Rate limit budget at {remaining}; waiting {wait:.0f}s for reset")
+        time.sleep(wait)
+
+    def update(self, key: str, response: HTTPResponse) -> None:
+        headers = response.headers
+
+        try:
+            limit = int(headers["X-RateLimit-Limit"])
+            remaining = int(headers["X-RateLimit-Remaining"])
+            reset_at = float(headers["X-RateLimit-Reset"])
+        except (KeyError, TypeError, ValueError):
+            return
+
+        with self._lock:
+            self._budgets[key] = _TokenBudget(limit=limit, remaining=remaining, reset_at=reset_at)
+
+    def snapshot(self) -> dict[str, tuple[int | None, int | None]]:
+        with self._lock:
+            return {k: (b.remaining, b.limit) for k, b in self._budgets.items()}
+
+
+@dataclass
+class _PooledConnection:
+    connection: HTTPConnection
+    response: HTTPResponse | None = None
+    checked_out: bool = False
+
+    def set_timeout(self, timeout: float | None) -> None:
+        self.connection.timeout = timeout
+        if self.connection.sock is not None:
+            self.connection.sock.settimeout(timeout)
+
+    def is_idle(self) -> bool:
+        return not self.checked_out and (self.response is None or self.response.isclosed())
+
+    def is_reusable(self) -> bool:
+        """Check whether the connection can carry another request
+
+        A response which was closed before being read to the end leaves the rest of its body
+        unread on the socket, so its connection has to be thrown away.
+        """
+        response = self.response
+
+        if response is None or response.will_close:
+            return True
+
+        if response.chunked:
+            return getattr(response, "chunk_left", None) is None
+
+        return response.length == 0
+
+    def is_dropped(self) -> bool:
+        """Check whether the server has closed an idle connection
+
+        An idle connection has nothing to read unless the server has closed it (or misbehaved), so
+        a socket which polls as readable is not worth sending a request over.
+        """
+        sock = self.connection.sock
+        if sock is None:
+            return False
+
+        readable, _, _ = select.select([sock], [], [], 0)
+        return bool(readable)
+
+
+class ConnectionPool:
+    """Keep-alive connections keyed by scheme and host
+
+    A connection is handed out again once the response last read from it has been fully consumed
+    or closed; callers which hold a response open simply cause another connection to be opened.
+    """
+
+    def __init__(self, max_idle_per_host: int = 8) -> None:
+        self.max_idle_per_host = max_idle_per_host
+        self.budget = RateLimitBudget()
+        self._lock = threading.Lock()
+        self._connections: dict[tuple[str, str], list[_PooledConnection]] = {}
+        self._ssl_context = ssl.create_default_context()
+
+    def open(self, req: Request, timeout: float | None = None) -> HTTPResponse:
+        """Send a request, following redirects for GET and HEAD
+
+        The timeout applies to each socket operation, including reads of the response body.
+        """
+        url = req.full_url
+        method = req.get_method()
+
+        for _ in range(MAX_REDIRECTS + 1):
+            response = self._send(req, url, method, timeout)
+
+            if method not in ("GET", "HEAD") or response.status not in (301, 302, 307, 308):
+                return response
+
+            location = response.getheader("Location")
+            if location is None:
+                return response
+
+            response.close()
+            url = urljoin(url, location)
+            print_info_line("redirect", url)
+
+        raise http.client.HTTPException(f"too many redirects for {method} {req.full_url}")
+
+    def close(self) -> None:
+        with self._lock:
+            for pooled in (p for conns in self._connections.values() for p in conns):
+                pooled.connection.close()
+            self._connections.clear()
+
+    def _send(self, req: Request, url: str, method: str, timeout: float | None) -> HTTPResponse:
+        parts = urlsplit(url)
+        path = parts.path + (f"?{parts.query}" if parts.query else "")
+
+        headers = dict(req.header_items())
+        if req.data is not None and not any(k.lower() == "content-type" for k in headers):
+            headers["Content-Type"] = "application/json"
+
+        budget_key = _budget_key(headers)
+        self.budget.before_request(budget_key)
+
+        pooled, reused = self._acquire(parts.scheme, parts.netloc)
+        pooled.set_timeout(timeout)
+        sent = False
+
+        try:
+            pooled.connection.request(method, path, body=req.data, headers=headers)
+            sent = True
+            response = pooled.connection.getresponse()
+
+        except TimeoutError:
+            # A slow server, not a stale connection; whether to try again is up to the caller
+            self._discard(parts.scheme, parts.netloc, pooled)
+            raise
+
+        except (http.client.HTTPException, OSError):
+            self._discard(parts.scheme, parts.netloc, pooled)
+
+            # A kept-alive connection may have been closed by the server while idle, so the
+            # request is tried once more on a fresh connection. The server may already have acted
+            # on a request which was sent in full, however, so that's only resent if sending it
+            # twice is harmless.
+            if not reused or (sent and method not in IDEMPOTENT_METHODS):
+                raise
+
+            pooled, _ = self._acquire(parts.scheme, parts.netloc, fresh=True)
+            pooled.set_timeout(timeout)
+            try:
+                pooled.connection.request(method, path, body=req.data, headers=headers)
+                response = pooled.connection.getresponse()
+            except BaseException:
+                self._discard(parts.scheme, parts.netloc, pooled)
+                raise
+
+        except BaseException:
+            self._discard(parts.scheme, parts.netloc, pooled)
+            raise
+
+        self.budget.update(budget_key, response)
+
+        with self._lock:
+            pooled.response = response
+            pooled.checked_out = False
+
+        return response
+
+    def _acquire(
+        self, scheme: str, netloc: str, fresh: bool = False
+    ) -> tuple[_PooledConnection, bool]:
+        key = (scheme, netloc)
+
+        with self._lock:
+            conns = self._connections.setdefault(key, [])
+
+            for pooled in [
+                p for p in conns if p.is_idle() and (not p.is_reusable() or p.is_dropped())
+            ]:
+                pooled.connection.close()
+                conns.remove(pooled)
+
+            if not fresh:
+                for pooled in conns:
+                    if pooled.is_idle():
+                        pooled.checked_out = True
+                        pooled.response = None
+                        return pooled, True
+
+            # Drop the oldest idle connections beyond the cap
+            idle = [p for p in conns if p.is_idle()]
+            for stale in idle[: max(0, len(idle) + 1 - self.max_idle_per_host)]:
+                stale.connection.close()
+                conns.remove(stale)
+
+            pooled = _PooledConnection(connection=self._connect(scheme, netloc), checked_out=True)
+            conns.append(pooled)
+            return pooled, False
+
+    def _discard(self, scheme: str, netloc: str, pooled: _PooledConnection) -> None:
+        pooled.connection.close()
+        with self._lock:
+            conns = self._connections.get((scheme, netloc), [])
+            if pooled in conns:
+                conns.remove(pooled)
+
+    def _connect(self, scheme: str, netloc: str) -> HTTPConnection:
+        match scheme:
+            case "https":
+                return HTTPSConnection(netloc, context=self._ssl_context)
+            case "http":
+                return HTTPConnection(netloc)
+            case _:
+                raise ValueError(f"unsupported URL scheme {scheme!r}")
+
+
+def _budget_key(headers: dict[str, str]) -> str:
+    auth = next((v for k, v in headers.items() if k.lower() == "authorization"), "")
+    return hashlib.sha256(auth.encode()).hexdigest()[:16]
+
+
+POOL = ConnectionPool()
@@ -0,0 +1,238 @@
+"""
+Writes to pull requests, queued and coalesced per pull request, then sent as a batch
+
+Label changes, approvals and branch updates are queued as they're decided on, and only sent when
+the queue is flushed. Callers flush at fixed points: before anything which relies on the writes
+having landed, such as dispatching a workflow or pushing a merge, and when they're done. Until
+then, writes to the same pull request are coalesced:
+
+- a label change cancels an opposite change to the same label that's still queued, since labels
+  are only queued for adding when absent and for removal when present
+- the remaining label changes are sent as one request: a POST of the added labels if none are
+  removed, or a PUT of the whole label set if the pull request's labels are known
+- repeated approvals and branch updates are sent once
+
+Pull requests are flushed concurrently, each one's writes in order on a single worker. Every
+request's result is reported, and a failure doesn't stop the rest of the batch.
+"""
+
+from __future__ import annotations
+
+from concurrent.futures import ThreadPoolExecutor
+import contextlib
+from dataclasses import dataclass, field
+import threading
+from typing import Callable, Iterable, Iterator
+
+from . import cassette
+from .gh_state import add_labels, remove_label, send_github_api, set_labels
+from .output import emit_warning, print_info_line, print_info_multi
+
+
+@dataclass(frozen=True, kw_only=True)
+class WriteResult:
+    repo: str
+    pr_number: int
+    description: str
+    error: Exception | None = None
+
+
+@dataclass
+class _PendingWrites:
+    # Label to whether it's being added
+    labels: dict[str, bool] = field(default_factory=dict)
+    current_labels: frozenset[str] | None = None
+
+    # Review request body and the token to send it with
+    approval: tuple[str, str | None] | None = None
+    update_branch: bool = False
+
+    # Number of calls which queued writes, for reporting how many were coalesced away
+    queued: int = 0
+
+
+class WriteQueue:
+    def __init__(self, dry_run: bool = False, max_workers: int = 8) -> None:
+        self.dry_run = dry_run
+        self.max_workers = max_workers
+        self._lock = threading.Lock()
+        self._pending: dict[tuple[str, int], _PendingWrites] = {}
+
+    def add_label(
+        self, repo: str, pr_number: int, label: str, current_labels: Iterable[str] | None = None
+    ) -> None:
+        self._change_label(repo, pr_number, label, True, current_labels)
+
+    def remove_label(
+        self, repo: str, pr_number: int, label: str, current_labels: Iterable[str] | None = None
+    ) -> None:
+        self._change_label(repo, pr_number, label, False, current_labels)
+
+    def approve(self, repo: str, pr_number: int, review: str, token: str | None = None) -> None:
+        """Queue a review, given as its JSON request body; a later one replaces an earlier one"""
+        with self._queue(repo, pr_number) as pending:
+            pending.approval = (review, token)
+
+    def update_branch(self, repo: str, pr_number: int) -> None:
+        with self._queue(repo, pr_number) as pending:
+            pending.update_branch = True
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._pending)
+
+    def flush(self, check: bool = True) -> list[WriteResult]:
+        """Send the queued writes, reporting the result of each request
+
+        If check is set, the first failure is raised once the whole batch has been sent.
+        """
+        with self._lock:
+            batch, self._pending = self._pending, {}
+
+        if not batch:
+            return []
+
+        with (
+            cassette.concurrent(),
+            ThreadPoolExecutor(
+                max_workers=min(self.max_workers, len(batch)), thread_name_prefix="writes"
+            ) as executor,
+        ):
+            results = [
+                result
+                for pr_results in executor.map(self._send, batch, batch.values())
+                for result in pr_results
+            ]
+
+        failed = [result for result in results if result.error is not None]
+        queued = sum(pending.queued for pending in batch.values())
+
+        print_info_line(
+            "writes",
+            f"{len(results)} requests for {len(batch)} pull requests "
+            f"({queued} writes queued), {len(failed)} failed",
+        )
+
+        if check and failed:
+            assert failed[0].error is not None
+            failed[0].error.add_note(f"{len(failed)} of {len(results)} write requests failed")
+            raise failed[0].error
+
+        return results
+
+    def _change_label(
+        self,
+        repo: str,
+        pr_number: int,
+        label: str,
+        add: bool,
+        current_labels: Iterable[str] | None,
+    ) -> None:
+        with self._queue(repo, pr_number) as pending:
+            if current_labels is not None:
+                pending.current_labels = frozenset(current_labels)
+
+            if pending.labels.get(label) == (not add):
+                del pending.labels[label]
+            elif pending.current_labels is not None and (label in pending.current_labels) == add:
+                pending.labels.pop(label, None)
+            else:
+                pending.labels[label] = add
+
+    @contextlib.contextmanager
+    def _queue(self, repo: str, pr_number: int) -> Iterator[_PendingWrites]:
+        with self._lock:
+            pending = self._pending.setdefault((repo, pr_number), _PendingWrites())
+            pending.queued += 1
+            yield pending
+
+    def _send(self, key: tuple[str, int], pending: _PendingWrites) -> list[WriteResult]:
+        repo, pr_number = key
+        results = []
+
+        def attempt(description: str, send: Callable[[], None]) -> None:
+            try:
+                send()
+            except Exception as exc:
+                emit_warning(f"{repo}#{pr_number}: {description} failed: {exc!r}")
+                results.append(
+                    WriteResult(repo=repo, pr_number=pr_number, description=description, error=exc)
+                )
+            else:
+                print_info_line(f"{repo}#{pr_number}", f"{description}: ok")
+                results.append(WriteResult(repo=repo, pr_number=pr_number, description=description))
+
+        added = sorted(label for label, add in pending.labels.items() if add)
+        removed = sorted(label for label, add in pending.labels.items() if not add)
+
+        if removed and pending.current_labels is not None and len(pending.labels) > 1:
+            labels = sorted((pending.current_labels - set(removed)) | set(added))
+            attempt(
+                f"set labels {labels}",
+                lambda: self._labels("put", set_labels, repo, pr_number, labels),
+            )
+        else:
+            if added:
+                attempt(
+                    f"add labels {added}",
+                    lambda: self._labels("post", add_labels, repo, pr_number, added),
+                )
+
+            for label in removed:
+                attempt(f"remove label {label}", lambda: self._remove(repo, pr_number, label))
+
+        if pending.approval is not None:
+            review, token = pending.approval
+            attempt("approve", lambda: self._approve(repo, pr_number, review, token))
+
+        if pending.update_branch:
+            attempt("update branch", lambda: self._update_branch(repo, pr_number))
+
+        return results
+
+    def _labels(
+        self,
+        action: str,
+        send: Callable[..., None],
+        repo: str,
+        pr_number: int,
+        labels: list[str],
+    ) -> None:
+        if self.dry_run:
+            print_info_multi(f"{action} [dry-run]", f"{repo} PR", pr_number, "labels", labels)
+        else:
+            send(pr_number, labels, repo=repo)
+
+    def _remove(self, repo: str, pr_number: int, label: str) -> None:
+        if self.dry_run:
+            print_info_multi("delete [dry-run]", f"{repo} PR", pr_number, "label", label)
+        else:
+            remove_label(pr_number, label, repo=repo)
+
+    def _approve(self, repo: str, pr_number: int, review: str, token: str | None) -> None:
+        url = f"/repos/{repo}/pulls/{pr_number}/reviews"
+
+        if self.dry_run:
+            print_info_multi("post [dry-run]", url, review)
+        else:
+            send_github_api(url, method="POST", token=token, data=review.encode())
+
+    def _update_branch(self, repo: str, pr_number: int) -> None:
+        url = f"/repos/{repo}/pulls/{pr_number}/update-branch"
+
+        if self.dry_run:
+            print_info_multi("put [dry-run]", url)
+        else:
+            send_github_api(url, method="PUT", data=b"{}")
+
+
+@contextlib.contextmanager
+def flushing(queue: WriteQueue) -> Iterator[WriteQueue]:
+    """Flush the queue when the block exits, without masking an exception raised by it"""
+    try:
+        yield queue
+    except BaseException:
+        queue.flush(check=False)
+        raise
+
+    queue.flush()
@@ -0,0 +1,204 @@
+"""
+Leases letting concurrent runs on one machine share a clone and a remote
+
+Runs hold a lease only around the steps that can't safely overlap, so that fetching, evaluation
+and building the deploy tree proceed in parallel:
+
+- the push lease for a remote, which is host-wide, covers assigning a deploy number and pushing
+  it, so that runs deploy one at a time and each numbers its deploy after the one before
+- repository leases cover git operations which take a repository-wide lock file and fail rather
+  than wait when another process holds it, such as fetches which move the shallow boundary
+
+Everything else a run writes to the shared clone goes in its own ref namespace, which
+run_namespace() allocates and removes again afterwards.
+
+Leases are flock(2) locks, so the kernel releases them when their holder exits, however it exits.
+A namespace's lock file is likewise held for as long as its run is alive; runs delete the
+namespaces of dead runs they come across.
+
+A replayed run takes no leases and writes no lock files. Its namespace and the abandoned ones it
+deletes are those of the recorded run, read back from the cassette.
+"""
+
+from __future__ import annotations
+
+import contextlib
+import fcntl
+import hashlib
+import os
+from pathlib import Path
+import secrets
+import tempfile
+import time
+from typing import IO, Iterator
+
+from . import cassette, deadlines
+from .output import print_info_line
+from .utils import cache_dir, run
+
+RUN_REF_ROOT = "refs/ci-tools/runs"
+
+# Bounds of the delay between attempts to take a held lease
+_POLL_MIN_SECONDS = 0.05
+_POLL_MAX_SECONDS = 1.0
+
+
+class LeaseTimeoutError(TimeoutError):
+    pass
+
+
+@contextlib.contextmanager
+def push_lease(remote: str) -> Iterator[None]:
+    """Hold the host-wide lease on pushing deploys to a remote"""
+    url = run(["git", "remote", "get-url", "--", remote]).removesuffix("\n")
+    key = hashlib.sha256(url.encode()).hexdigest()[:16]
+
+    with _lease(_host_lease_dir() / f"push-{key}.lock", f"push to {remote}"):
+        yield
+
+
+@contextlib.contextmanager
+def repo_lease(name: str) -> Iterator[None]:
+    """Hold a lease on an operation in the current repository"""
+    with _lease(_repo_lease_dir() / f"{name}.lock", name):
+        yield
+
+
+@contextlib.contextmanager
+def run_namespace() -> Iterator[str]:
+    """Allocate a ref namespace for this run, deleting it and any abandoned ones afterwards"""
+    runs_dir = _repo_lease_dir() / "runs"
+    run_id = cassette.local_value("run id", lambda: f"{os.getpid()}-{secrets.token_hex(4)}")
+
+    with _namespace_lock(runs_dir, run_id) as lock_path:
+        _collect_abandoned_namespaces(runs_dir)
+
+        namespace = f"{RUN_REF_ROOT}/{run_id}"
+        print_info_line("namespace", namespace)
+
+        try:
+            yield namespace
+        finally:
+            _delete_refs(namespace)
+            if lock_path is not None:
+                lock_path.unlink()
+
+
+@contextlib.contextmanager
+def _namespace_lock(runs_dir: Path, run_id: str) -> Iterator[Path | None]:
+    """Hold the lock file marking a namespace as in use, unless replaying"""
+    if cassette.replaying():
+        yield None
+        return
+
+    runs_dir.mkdir(parents=True, exist_ok=True)
+    lock_path = runs_dir / f"{run_id}.lock"
+
+    # Locked before it's given the name other runs look for, so they never see it unlocked
+    with open(runs_dir / f"{run_id}.new", "w") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        os.rename(lock_file.name, lock_path)
+
+        yield lock_path
+
+
+@contextlib.contextmanager
+def _lease(path: Path, description: str) -> Iterator[None]:
+    if cassette.replaying():
+        yield
+        return
+
+    path.parent.mkdir(parents=True, exist_ok=True)
+
+    with open(path, "a+") as lock_file:
+        start = time.monotonic()
+        _acquire(lock_file, description)
+        waited = time.monotonic() - start
+
+        if waited >= _POLL_MIN_SECONDS:
+            print_info_line("lease", f"{description}: acquired after {waited:.1f}s")
+
+        # Recorded so that runs left waiting can say who they're waiting for
+        lock_file.truncate(0)
+        lock_file.write(f"pid {os.getpid()}\n")
+        lock_file.flush()
+
+        try:
+            yield
+        finally:
+            lock_file.truncate(0)
+
+
+def _acquire(lock_file: IO[str], description: str) -> None:
+    delay = _POLL_MIN_SECONDS
+
+    while True:
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return
+        except BlockingIOError:
+            pass
+
+        if delay == _POLL_MIN_SECONDS:
+            lock_file.seek(0)
+            holder = lock_file.read().strip() or "unknown"
+            print_info_line("lease", f"{description}: waiting for {holder}")
+
+        # Waiting counts against the run's deadline like any other operation
+        if (left := deadlines.remaining()) is not None and left <= 0:
+            raise LeaseTimeoutError(f"run deadline passed waiting for lease on {description}")
+
+        time.sleep(delay if left is None else min(delay, left))
+        delay = min(delay * 2, _POLL_MAX_SECONDS)
+
+
+def _collect_abandoned_namespaces(runs_dir: Path) -> None:
+    with contextlib.ExitStack() as stack:
+        abandoned = cassette.local_value(
+            "abandoned runs", lambda: _lock_abandoned_namespaces(runs_dir, stack)
+        )
+
+        for run_id in abandoned:
+            print_info_line("namespace", f"removing abandoned run {run_id}")
+            _delete_refs(f"{RUN_REF_ROOT}/{run_id}")
+
+            if not cassette.replaying():
+                (runs_dir / f"{run_id}.lock").unlink(missing_ok=True)
+
+
+def _lock_abandoned_namespaces(runs_dir: Path, stack: contextlib.ExitStack) -> list[str]:
+    """Lock the lock files of dead runs' namespaces for the stack's lifetime, returning their IDs"""
+    abandoned = []
+
+    for path in runs_dir.glob("*.lock"):
+        try:
+            lock_file = stack.enter_context(open(path))
+        except FileNotFoundError:
+            continue
+
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            continue
+
+        abandoned.append(path.stem)
+
+    return abandoned
+
+
+def _delete_refs(namespace: str) -> None:
+    refs = run(["git", "for-each-ref", "--format=%(refname)", f"{namespace}/"]).split()
+
+    if refs:
+        run(["git", "update-ref", "--stdin"], input="".join(f"delete {ref}\n" for ref in refs))
+
+
+def _repo_lease_dir() -> Path:
+    git_dir = run(["git", "rev-parse", "--git-common-dir"]).removesuffix("\n")
+    return Path(git_dir).resolve() / "ci-tools-leases"
+
+
+def _host_lease_dir() -> Path:
+    if (root := cache_dir()) is not None:
+        return root / "leases"
+    return Path(tempfile.gettempdir()) / f"ci-tools-leases-{os.getuid()}"
@@ -0,0 +1,165 @@
+"""
+Content manifest of a built site, written by the build and verified before deploying
+
+The manifest lists every file and symlink in the site with its size, its git mode and its git blob
+ID (the SHA-1 of a "blob <size>\\0" header followed by the content, or for a symlink its target).
+Blob IDs make the manifest directly usable for staging: once the deploy directory has been
+verified against it, the deploy tree can be built from the manifest's entries without git hashing
+every file a second time, and only blobs missing from the repository need to be written.
+
+Files are hashed concurrently from memory maps; hashlib releases the GIL while hashing large
+buffers, so this scales with the available cores.
+"""
+
+from __future__ import annotations
+
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+import hashlib
+import json
+import mmap
+import os
+from pathlib import Path
+import stat
+from typing import Iterable
+
+from ..output import print_info_line
+
+MANIFEST_VERSION = 1
+
+# Blob ID of an empty file
+EMPTY_BLOB = "e69de29bb2d1d6434b8b29ae775ad8c2e48c5391"
+
+
+class ManifestMismatchError(ValueError):
+    """Raised when a directory's content doesn't match its manifest"""
+
+
+@dataclass(frozen=True, kw_only=True)
+class ManifestEntry:
+    mode: str
+    size: int
+    blob: str
+
+    def as_dict(self) -> dict[str, str | int]:
+        return {"mode": self.mode, "size": self.size, "blob": self.blob}
+
+
+Manifest = dict[str, ManifestEntry]
+
+
+def build_manifest(root: Path, paths: Iterable[str], max_workers: int | None = None) -> Manifest:
+    """Hash the given paths, which are relative to root"""
+    paths = sorted(set(paths))
+
+    with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="manifest") as executor:
+        entries = list(executor.map(lambda path: hash_entry(root / path), paths))
+
+    return dict(zip(paths, entries))
+
+
+def write_manifest(manifest: Manifest, dest: Path) -> None:
+    content = {
+        "version": MANIFEST_VERSION,
+        "files": {path: entry.as_dict() for path, entry in manifest.items()},
+    }
+    dest.write_text(json.dumps(content, indent=1, sort_keys=True) + "\n")
+
+
+def load_manifest(src: Path) -> Manifest:
+    match json.loads(src.read_text()):
+        case {"version": version, "files": dict(files)} if version == MANIFEST_VERSION:
+            return {
+                path: ManifestEntry(mode=f["mode"], size=f["size"], blob=f["blob"])
+                for path, f in files.items()
+            }
+
+        case _:
+            raise ValueError(f"{src} is not a version {MANIFEST_VERSION} site manifest")
+
+
+def list_tree(root: Path) -> list[str]:
+    """List the files and symlinks under root, relative to it"""
+    paths: list[str] = []
+
+    for dirpath, dirnames, filenames in os.walk(root):
+        rel_dir = Path(dirpath).relative_to(root)
+
+        # Symlinks to directories are listed in dirnames but shouldn't be followed
+        for name in list(dirnames):
+            if (Path(dirpath) / name).is_symlink():
+                dirnames.remove(name)
+                filenames.append(name)
+
+        paths.extend((rel_dir / name).as_posix() for name in filenames)
+
+    return paths
+
+
+def verify_manifest(root: Path, manifest: Manifest, max_workers: int | None = None) -> None:
+    """Check that root holds exactly the files in the manifest, with the same content"""
+    present = set(list_tree(root))
+    expected = set(manifest)
+
+    problems = [f"missing: {path}" for path in sorted(expected - present)]
+    problems.extend(f"unexpected: {path}" for path in sorted(present - expected))
+
+    # Comparing sizes first catches truncated files without reading anything
+    for path in sorted(present & expected):
+        st = os.lstat(root / path)
+        if _git_mode(st) != manifest[path].mode or st.st_size != manifest[path].size:
+            problems.append(f"changed: {path}")
+
+    if not problems:
+        actual = build_manifest(root, expected, max_workers=max_workers)
+        problems.extend(
+            f"changed: {path}" for path in sorted(expected) if actual[path] != manifest[path]
+        )
+
+    if problems:
+        shown = problems[:20]
+        if len(problems) > len(shown):
+            shown.append(f"... and {len(problems) - len(shown)} more")
+
+        raise ManifestMismatchError(
+            f"{root} doesn't match its manifest:\n" + "\n".join(f"  {p}" for p in shown)
+        )
+
+    print_info_line(
+        "manifest",
+        f"verified {len(manifest)} files, {sum(e.size for e in manifest.values())} bytes",
+    )
+
+
+def hash_entry(path: Path) -> ManifestEntry:
+    st = os.lstat(path)
+    mode = _git_mode(st)
+
+    if mode == "120000":
+        target = os.fsencode(os.readlink(path))
+        return ManifestEntry(mode=mode, size=st.st_size, blob=_blob_id(target, len(target)))
+
+    with open(path, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+
+        if size == 0:
+            return ManifestEntry(mode=mode, size=0, blob=EMPTY_BLOB)
+
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as content:
+            return ManifestEntry(mode=mode, size=size, blob=_blob_id(content, size))
+
+
+def _blob_id(content: bytes | mmap.mmap, size: int) -> str:
+    digest = hashlib.sha1(f"blob {size}\0".encode())
+    digest.update(content)
+    return digest.hexdigest()
+
+
+def _git_mode(st: os.stat_result) -> str:
+    if stat.S_ISLNK(st.st_mode):
+        return "120000"
+
+    if not stat.S_ISREG(st.st_mode):
+        raise ManifestMismatchError(f"unsupported file type: {stat.filemode(st.st_mode)}")
+
+    return "100755" if st.st_mode & stat.S_IXUSR else "100644"
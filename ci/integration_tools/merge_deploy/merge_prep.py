@@ -2,6 +2,7 @@ from __future__ import annotations
 
 import itertools
 import os
+import subprocess
 from typing import Sequence
 
 from ..gh_state import PullRequestEvaluation
@@ -12,6 +13,47 @@ def pull_request_merge_ref(pr_number: int) -> str:
     return f"refs/pull/{pr_number}/merge"
 
 
+def pull_request_merge_message(pr_number: int, pr_eval: PullRequestEvaluation) -> str:
+    return f"Merge pull request #{pr_number} from {pr_eval.head_ref}"
+
+
+def merge_base(base_sha: str, head_sha: str) -> str | None:
+    """Find the best common ancestor of two commits, if it is present locally"""
+    try:
+        return run(["git", "merge-base", base_sha, head_sha]).removesuffix("\n")
+    except subprocess.CalledProcessError as exc:
+        # Exit status 1 means no common ancestor was found, which for a shallow clone may just
+        # mean the history stops short of it
+        if exc.returncode != 1:
+            raise
+        return None
+
+
+def merge_tree(base_sha: str, head_sha: str) -> str | None:
+    """Merge head into base without touching any worktree, returning the resulting tree
+
+    Returns None if the merge has conflicts. Both commits and their merge base must be present
+    locally; in a shallow clone that means fetching each side down to where they diverge.
+    """
+    try:
+        out = run(["git", "merge-tree", "--write-tree", "--no-messages", base_sha, head_sha])
+    except subprocess.CalledProcessError as exc:
+        # Exit status 1 means the merge completed with conflicts; anything else is an error
+        if exc.returncode != 1:
+            raise
+        return None
+
+    return out.split("\n", maxsplit=1)[0]
+
+
+def commit_merge_tree(tree: str, parents: Sequence[str], message: str) -> str:
+    args = ["git", "commit-tree", tree, "-m", message]
+    for parent in parents:
+        args.extend(["-p", parent])
+
+    return run(args).removesuffix("\n")
+
+
 def rewrite_pull_request_merge_commit_message(
     pr_number: int,
     pr_eval: PullRequestEvaluation,
@@ -48,7 +90,7 @@ def rewrite_pull_request_merge_commit_message(
             "--amend",
             "--no-edit",
             "-m",
-            f"Merge pull request #{pr_number} from {pr_eval.head_ref}",
+            pull_request_merge_message(pr_number, pr_eval),
         ],
         env=amend_env,
     )
@@ -20,11 +20,14 @@ class RevisionInfo:
     base_ref: str
     base_sha: str | None = dataclasses.field(default=None)
     merge_sha: str | None = dataclasses.field(default=None)
+    tree: str | None = dataclasses.field(default=None)
 
     def as_dict(self) -> dict[str, str | None]:
         d = dataclasses.asdict(self)
         if self.base_sha is None:
             del d["base_sha"]
+        if self.tree is None:
+            del d["tree"]
         return d
 
     @staticmethod
@@ -85,7 +88,7 @@ def _load_deploy_revision_info(src: Path) -> RevisionInfo:
             "base_ref": str(base_ref),
             "base_ref_sha": str(base_sha),
             "sha": str(merge_sha),
-            "tree": str(),
+            "tree": str(tree),
         }:
             return RevisionInfo(
                 head_ref=head_ref,
@@ -93,12 +96,13 @@ def _load_deploy_revision_info(src: Path) -> RevisionInfo:
                 base_ref=base_ref,
                 base_sha=base_sha,
                 merge_sha=merge_sha,
+                tree=tree,
             )
 
         case {
             "ref": str(ref),
             "sha": str(sha),
-            "tree": str(),
+            "tree": str(tree),
             **other,
         } if not {
             "head_ref",
@@ -106,7 +110,7 @@ def _load_deploy_revision_info(src: Path) -> RevisionInfo:
             "base_ref",
             "base_ref_sha",
         }.intersection(other):
-            return RevisionInfo(head_ref=ref, head_sha=sha, base_ref=ref)
+            return RevisionInfo(head_ref=ref, head_sha=sha, base_ref=ref, tree=tree)
 
         case _:
             raise ValueError(f"unexpected deploy revision content: {json.dumps(info, indent=2)}")
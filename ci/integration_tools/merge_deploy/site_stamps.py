@@ -0,0 +1,131 @@
+"""
+Comparison of deploy trees which ignores what every build stamps into the site
+
+Builds embed their release version, which names the source commit, in every page (the version
+meta tag), in .test-meta.json and in the JavaScript bundles, and jekyll-feed writes the build
+time into the feed. Two builds of the same content from different source commits, such as a
+merge which only touches CI or tooling, therefore never produce the same tree. Trees are compared
+file by file instead: the paths and modes have to match, and files whose blobs differ have to be
+of a type builds stamp and be identical once the stamps are masked out.
+
+The release version each tree was built as is read from its .test-meta.json, so a tree without
+one only matches an identical tree.
+"""
+
+from __future__ import annotations
+
+import json
+import re
+import subprocess
+
+from ..utils import run
+
+TEST_META_PATH = ".test-meta.json"
+
+# Files which can carry a stamp; any other file which differs is a change to the site
+STAMPED_SUFFIXES = (".html", ".js", ".json", ".xml")
+
+# Feed-level timestamp, which comes before any entry's
+_FEED_PATH = "feed.xml"
+_FEED_UPDATED = re.compile(rb"<updated>[^<]*</updated>")
+
+_RELEASE_MASK = b"<release-version>"
+
+
+def same_site(tree: str, other: str) -> bool:
+    """Whether two deploy trees (or commits) have the same content apart from build stamps"""
+    entries = _list_tree(tree)
+    other_entries = _list_tree(other)
+
+    if entries.keys() != other_entries.keys():
+        return False
+
+    changed = []
+    for path, (mode, blob) in entries.items():
+        other_mode, other_blob = other_entries[path]
+
+        if mode != other_mode:
+            return False
+
+        if blob != other_blob:
+            if not path.endswith(STAMPED_SUFFIXES):
+                return False
+            changed.append(path)
+
+    if not changed:
+        return True
+
+    release = release_version_of(tree)
+    other_release = release_version_of(other)
+    if release is None or other_release is None:
+        return False
+
+    try:
+        contents = _read_blobs(
+            [entries[path][1] for path in changed] + [other_entries[path][1] for path in changed]
+        )
+    except UnicodeDecodeError:
+        return False
+
+    return all(
+        _mask(path, contents[entries[path][1]], release)
+        == _mask(path, contents[other_entries[path][1]], other_release)
+        for path in changed
+    )
+
+
+def release_version_of(tree: str) -> str | None:
+    """The release version a deploy tree was built as, if its .test-meta.json records one"""
+    try:
+        test_meta = json.loads(run(["git", "show", f"{tree}:{TEST_META_PATH}"]))
+    except (subprocess.CalledProcessError, ValueError):
+        return None
+
+    match test_meta:
+        case {"release_version": str(release_version)}:
+            return release_version
+        case _:
+            return None
+
+
+def _mask(path: str, content: bytes, release_version: str) -> bytes:
+    content = content.replace(release_version.encode(), _RELEASE_MASK)
+
+    if path == _FEED_PATH:
+        content = _FEED_UPDATED.sub(b"<updated></updated>", content, count=1)
+
+    return content
+
+
+def _list_tree(tree: str) -> dict[str, tuple[str, str]]:
+    """Map each path in a tree to its mode and object ID"""
+    entries = {}
+
+    for entry in run(["git", "ls-tree", "-r", "-z", "--full-tree", tree]).split("\0"):
+        if not entry:
+            continue
+
+        info, path = entry.split("\t", maxsplit=1)
+        mode, _kind, object_id = info.split()
+        entries[path] = (mode, object_id)
+
+    return entries
+
+
+def _read_blobs(blobs: list[str]) -> dict[str, bytes]:
+    # Only blobs of stamped (text) file types are read, so the output decodes as UTF-8; the sizes
+    # cat-file reports are in bytes, so it's split up after encoding it again
+    output = run(["git", "cat-file", "--batch"], input="".join(f"{b}\n" for b in blobs)).encode()
+
+    contents = {}
+    pos = 0
+
+    for _ in blobs:
+        header_end = output.index(b"\n", pos)
+        blob, _kind, size = output[pos:header_end].decode().split()
+
+        start = header_end + 1
+        contents[blob] = output[start : start + int(size)]
+        pos = start + int(size) + 1
+
+    return contents
@@ -0,0 +1,186 @@
+"""
+Sourcemap uploads for a Sentry release, limited to the artifacts a new deploy actually needs
+
+Artifacts (bundles and sourcemaps) are grouped with their sourcemap, as webpack writes them
+(`<bundle>` and `<bundle>.map`), and each group's blobs are compared with those in the previous
+deploy's tree. Changed and new groups are uploaded. Unchanged groups are only skipped where Sentry
+can still find the earlier upload:
+
+- bundles carrying a debug ID are resolved by that ID regardless of release, so their earlier
+  upload is reused
+- other JavaScript bundles are resolved through the release an event reports, so they have to be
+  attached to the new release again
+- anything else (stylesheet sourcemaps, for instance) isn't used to symbolicate events at all
+
+Uploads are split into batches of roughly equal size which run concurrently. Each batch is staged
+in a directory mirroring the assets directory's layout, so that URLs derived from paths relative
+to it are the same as for a single upload of the whole directory.
+"""
+
+from __future__ import annotations
+
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+import os
+from pathlib import Path
+import re
+import shutil
+import tempfile
+from typing import Callable
+
+from .. import cassette
+from ..output import print_info_line
+from ..utils import run
+
+# The file types sentry-cli picks up from a directory by default
+ARTIFACT_SUFFIXES = (".js", ".mjs", ".cjs", ".map")
+
+BUNDLE_SUFFIXES = (".js", ".mjs", ".cjs")
+
+UPLOAD_WORKERS = 4
+
+# Bundles processed with `sentry-cli sourcemaps inject` end with a comment like this one
+_DEBUG_ID_COMMENT = re.compile(rb"^//# debugId=[0-9a-fA-F-]+\s*$", re.MULTILINE)
+
+
+@dataclass(frozen=True, kw_only=True)
+class Artifact:
+    path: str
+    """Path relative to the assets directory"""
+    blob: str
+    size: int
+
+
+@dataclass(kw_only=True)
+class UploadPlan:
+    upload: list[frozenset[Artifact]]
+    """Groups of a bundle and its sourcemap to be uploaded, by descending size"""
+    changed: int
+    reattached: int
+    skipped: int
+
+    @property
+    def size(self) -> int:
+        return sum(a.size for group in self.upload for a in group)
+
+    def describe(self) -> str:
+        return (
+            f"{self.changed} changed or new, {self.reattached} unchanged without debug IDs, "
+            f"{self.skipped} unchanged and skipped; uploading {self.size} bytes"
+        )
+
+
+def plan_upload(
+    assets_dir: Path, tree_path: str, previous_commit: str, current_commit: str
+) -> UploadPlan:
+    """Compare the artifacts under tree_path in two deploy commits
+
+    assets_dir holds the files of current_commit's tree_path, which are read to look for debug
+    IDs.
+    """
+    current = _group(artifact_blobs(current_commit, tree_path))
+    previous = _group(artifact_blobs(previous_commit, tree_path))
+
+    plan = UploadPlan(upload=[], changed=0, reattached=0, skipped=0)
+
+    for key, group in current.items():
+        if previous.get(key) != group:
+            plan.changed += 1
+            plan.upload.append(group)
+        elif key.endswith(BUNDLE_SUFFIXES) and not has_debug_id(assets_dir / key):
+            plan.reattached += 1
+            plan.upload.append(group)
+        else:
+            plan.skipped += 1
+
+    plan.upload.sort(key=lambda group: sum(a.size for a in group), reverse=True)
+
+    return plan
+
+
+def artifact_blobs(commit: str, tree_path: str) -> list[Artifact]:
+    """List the artifacts under tree_path in a commit, with paths relative to tree_path"""
+    artifacts = []
+    prefix = tree_path.rstrip("/") + "/"
+
+    listing = run(["git", "ls-tree", "-r", "-l", "-z", "--full-tree", commit, "--", prefix])
+
+    for entry in listing.split("\0"):
+        if not entry:
+            continue
+
+        info, path = entry.split("\t", maxsplit=1)
+        _mode, kind, blob, size = info.split()
+
+        if kind == "blob" and path.endswith(ARTIFACT_SUFFIXES):
+            artifacts.append(Artifact(path=path.removeprefix(prefix), blob=blob, size=int(size)))
+
+    return artifacts
+
+
+def has_debug_id(bundle: Path) -> bool:
+    try:
+        with open(bundle, "rb") as f:
+            # The comment is appended at the end, after any sourceMappingURL comment
+            f.seek(max(0, f.seek(0, os.SEEK_END) - 512))
+            return _DEBUG_ID_COMMENT.search(f.read()) is not None
+    except FileNotFoundError:
+        return False
+
+
+def upload(
+    plan: UploadPlan,
+    assets_dir: Path,
+    upload_directory: Callable[[Path], None],
+    max_workers: int = UPLOAD_WORKERS,
+) -> None:
+    """Stage the planned groups into batches and pass each batch's directory to upload_directory
+
+    Up to max_workers batches are uploaded concurrently.
+    """
+    if not plan.upload:
+        print_info_line("sourcemaps", "nothing to upload")
+        return
+
+    batches: list[list[Artifact]] = [[] for _ in range(min(max_workers, len(plan.upload)))]
+    batch_sizes = [0] * len(batches)
+
+    # Largest first into the smallest batch so far keeps the batches close in size
+    for group in plan.upload:
+        i = batch_sizes.index(min(batch_sizes))
+        batches[i].extend(group)
+        batch_sizes[i] += sum(a.size for a in group)
+
+    with tempfile.TemporaryDirectory(prefix="sourcemaps-") as staging_root:
+        staging_dirs = []
+
+        for i, batch in enumerate(batches):
+            staging_dir = Path(staging_root) / str(i)
+            for artifact in batch:
+                _stage(assets_dir / artifact.path, staging_dir / artifact.path)
+            staging_dirs.append(staging_dir)
+
+        with (
+            cassette.concurrent(),
+            ThreadPoolExecutor(
+                max_workers=len(batches), thread_name_prefix="sourcemaps"
+            ) as executor,
+        ):
+            for _ in executor.map(upload_directory, staging_dirs):
+                pass
+
+
+def _group(artifacts: list[Artifact]) -> dict[str, frozenset[Artifact]]:
+    groups: dict[str, set[Artifact]] = {}
+    for artifact in artifacts:
+        groups.setdefault(artifact.path.removesuffix(".map"), set()).add(artifact)
+
+    return {key: frozenset(group) for key, group in sorted(groups.items())}
+
+
+def _stage(src: Path, dest: Path) -> None:
+    dest.parent.mkdir(parents=True, exist_ok=True)
+    try:
+        os.link(src, dest)
+    except OSError:
+        shutil.copyfile(src, dest)
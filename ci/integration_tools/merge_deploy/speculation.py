@@ -0,0 +1,176 @@
+"""
+Merge and deploy commits prepared ahead of a pull request becoming eligible, kept on the remote
+
+A speculative run pushes the rewritten merge commit and the deploy commit built on top of the
+current master to refs/speculative/pr-<n>/<prepared-at>-<digest>/{merge,deploy}, where the digest
+covers every input the commits depend on. Deploy runs start from a fresh clone, so the refs live on
+the remote rather than in the run's checkout: a later run which finds a group with the digest of
+its own inputs fetches those commits and adopts them instead of rebuilding them.
+
+Groups are removed once their pull request is deployed or a newer group replaces them, and groups
+prepared more than MAX_AGE_SECONDS ago (those of pull requests closed without merging, say) are
+removed by the next speculative run for any pull request.
+"""
+
+from __future__ import annotations
+
+from dataclasses import dataclass
+import hashlib
+import re
+import time
+
+from ..output import print_info_line
+from ..utils import resolve_commit, run
+
+SPECULATIVE_REF_ROOT = "refs/speculative"
+
+MAX_AGE_SECONDS = 7 * 24 * 60 * 60
+
+_GROUP_REF = re.compile(
+    rf"^(?P<prefix>{SPECULATIVE_REF_ROOT}/pr-(?P<pr_number>\d+)/"
+    r"(?P<prepared_at>\d+)-(?P<digest>[0-9a-f]+))/(?P<kind>merge|deploy)$"
+)
+
+
+@dataclass(frozen=True, kw_only=True)
+class SpeculationKey:
+    pr_number: int
+    head_sha: str
+    base_sha: str
+    merge_sha: str
+    master_sha: str | None
+
+    @property
+    def digest(self) -> str:
+        shas = [self.head_sha, self.base_sha, self.merge_sha, self.master_sha or "none"]
+        return hashlib.sha256(" ".join(shas).encode()).hexdigest()[:32]
+
+
+@dataclass(frozen=True, kw_only=True)
+class SpeculativeCommits:
+    merge_commit: str
+    deploy_commit: str | None
+
+
+@dataclass(frozen=True, kw_only=True)
+class _Group:
+    prefix: str
+    pr_number: int
+    prepared_at: int
+    digest: str
+    refs: dict[str, str]
+    """Kind of commit (merge or deploy) to its SHA"""
+
+
+def lookup(remote: str, key: SpeculationKey, *, namespace: str) -> SpeculativeCommits | None:
+    """Fetch the commits prepared for the key, if there are any, into the ref namespace"""
+    groups = [
+        group
+        for group in _list_groups(remote, key.pr_number)
+        if group.digest == key.digest and "merge" in group.refs
+    ]
+
+    if not groups:
+        return None
+
+    group = max(groups, key=lambda g: g.prepared_at)
+
+    # The deploy commit is the expensive part; without it there's little to reuse
+    if key.master_sha is not None and "deploy" not in group.refs:
+        return None
+
+    run(
+        [
+            "git",
+            "fetch",
+            "--no-tags",
+            "--no-write-fetch-head",
+            "--",
+            remote,
+            *(f"+{ref}:{_local_ref(namespace, ref)}" for ref in _refs(group)),
+        ],
+        network="git-fetch",
+    )
+
+    print_info_line("speculation", f"reusing prepared commits from {group.prefix}")
+
+    return SpeculativeCommits(
+        merge_commit=resolve_commit(_local_ref(namespace, f"{group.prefix}/merge")),
+        deploy_commit=(
+            resolve_commit(_local_ref(namespace, f"{group.prefix}/deploy"))
+            if "deploy" in group.refs
+            else None
+        ),
+    )
+
+
+def store(
+    remote: str, key: SpeculationKey, commits: SpeculativeCommits, *, dry_run: bool = False
+) -> None:
+    """Push the prepared commits, replacing the pull request's earlier groups and expired ones"""
+    prefix = f"{SPECULATIVE_REF_ROOT}/pr-{key.pr_number}/{int(time.time())}-{key.digest}"
+
+    refspecs = [f"{commits.merge_commit}:{prefix}/merge"]
+    if commits.deploy_commit is not None:
+        refspecs.append(f"{commits.deploy_commit}:{prefix}/deploy")
+
+    cutoff = time.time() - MAX_AGE_SECONDS
+    stale = [
+        group
+        for group in _list_groups(remote)
+        if group.prefix != prefix
+        and (group.pr_number == key.pr_number or group.prepared_at < cutoff)
+    ]
+
+    _push(remote, refspecs + [f":{ref}" for group in stale for ref in _refs(group)], dry_run)
+
+    print_info_line("speculation", f"stored prepared commits under {prefix}")
+    if stale:
+        print_info_line("speculation", f"removed {len(stale)} stale groups")
+
+
+def discard(remote: str, pr_number: int, *, dry_run: bool = False) -> None:
+    """Delete the pull request's groups, once it's been deployed"""
+    refs = [ref for group in _list_groups(remote, pr_number) for ref in _refs(group)]
+
+    if refs:
+        _push(remote, [f":{ref}" for ref in refs], dry_run)
+        print_info_line("speculation", f"removed {len(refs)} refs for pull request {pr_number}")
+
+
+def _list_groups(remote: str, pr_number: int | None = None) -> list[_Group]:
+    pattern = f"{SPECULATIVE_REF_ROOT}/" + (f"pr-{pr_number}/*" if pr_number is not None else "*")
+    groups: dict[str, _Group] = {}
+
+    for line in run(["git", "ls-remote", "--", remote, pattern], network="git-fetch").splitlines():
+        sha, ref = line.split("\t", maxsplit=1)
+
+        if (match := _GROUP_REF.match(ref)) is None:
+            continue
+
+        group = groups.setdefault(
+            match["prefix"],
+            _Group(
+                prefix=match["prefix"],
+                pr_number=int(match["pr_number"]),
+                prepared_at=int(match["prepared_at"]),
+                digest=match["digest"],
+                refs={},
+            ),
+        )
+        group.refs[match["kind"]] = sha
+
+    return list(groups.values())
+
+
+def _push(remote: str, refspecs: list[str], dry_run: bool) -> None:
+    args = ["git", "push", "--atomic", *(["--dry-run"] if dry_run else []), remote, *refspecs]
+    run(args, network="git-push", idempotent=False)
+
+
+def _refs(group: _Group) -> list[str]:
+    return [f"{group.prefix}/{kind}" for kind in sorted(group.refs)]
+
+
+def _local_ref(namespace: str, ref: str) -> str:
+    return f"{namespace}/{ref.removeprefix('refs/')}"
@@ -0,0 +1,185 @@
+"""
+Populate a deploy worktree from the built site without rewriting every byte
+
+Files are cloned with a reflink where the filesystem supports it, otherwise hard linked where the
+source and destination share a filesystem, and only copied (in-kernel via copy_file_range where
+possible) as a last resort. Nothing downstream of the copy writes to the files in place, so
+sharing storage with the source directory is safe.
+"""
+
+from __future__ import annotations
+
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+import errno
+import fcntl
+import os
+from pathlib import Path
+import shutil
+import threading
+
+from ..output import print_info_line
+
+# From linux/fs.h: _IOW(0x94, 9, int)
+FICLONE = 0x40049409
+
+# Errors indicating that a strategy is not available for this pair of files, as opposed to a
+# genuine I/O failure
+_UNSUPPORTED_ERRNOS = frozenset(
+    [errno.EOPNOTSUPP, errno.ENOTSUP, errno.EXDEV, errno.EINVAL, errno.ENOTTY, errno.ENOSYS]
+)
+
+
+@dataclass
+class CopyStats:
+    files: int = 0
+    symlinks: int = 0
+    bytes_cloned: int = 0
+    bytes_linked: int = 0
+    bytes_copied: int = 0
+
+    def add(self, other: CopyStats) -> None:
+        self.files += other.files
+        self.symlinks += other.symlinks
+        self.bytes_cloned += other.bytes_cloned
+        self.bytes_linked += other.bytes_linked
+        self.bytes_copied += other.bytes_copied
+
+    def describe(self) -> str:
+        return (
+            f"{self.files} files, {self.symlinks} symlinks: "
+            f"{self.bytes_cloned} bytes cloned, {self.bytes_linked} bytes linked, "
+            f"{self.bytes_copied} bytes copied"
+        )
+
+
+class _Strategies:
+    """Track which copy strategies are still worth attempting"""
+
+    def __init__(self, allow_links: bool) -> None:
+        self._lock = threading.Lock()
+        self.clone = hasattr(fcntl, "ioctl")
+        self.link = allow_links
+        self.copy_file_range = hasattr(os, "copy_file_range")
+
+    def disable(self, name: str) -> None:
+        with self._lock:
+            setattr(self, name, False)
+
+
+def populate_tree(
+    src: Path, dest: Path, *, allow_links: bool = True, max_workers: int | None = None
+) -> CopyStats:
+    """Copy the contents of src into dest, which must already exist
+
+    Like `rsync -a src/ dest/` this preserves modes, modification times and symlinks and leaves
+    existing entries in dest which are not present in src untouched.
+    """
+    strategies = _Strategies(allow_links=allow_links)
+    stats = CopyStats()
+    directories: list[tuple[Path, Path]] = []
+
+    with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="tree-copy") as executor:
+        futures = []
+
+        for dirpath, dirnames, filenames in os.walk(src):
+            src_dir = Path(dirpath)
+            dest_dir = dest / src_dir.relative_to(src)
+
+            dest_dir.mkdir(exist_ok=True)
+            directories.append((src_dir, dest_dir))
+
+            # Symlinks to directories are listed in dirnames but shouldn't be followed
+            entries = list(filenames)
+            for name in list(dirnames):
+                if (src_dir / name).is_symlink():
+                    dirnames.remove(name)
+                    entries.append(name)
+
+            if entries:
+                futures.append(
+                    executor.submit(_populate_directory, src_dir, dest_dir, entries, strategies)
+                )
+
+        for future in futures:
+            stats.add(future.result())
+
+    # Apply directory metadata last (deepest first) since populating them updates their mtimes
+    for src_dir, dest_dir in reversed(directories):
+        shutil.copystat(src_dir, dest_dir)
+
+    print_info_line("copy", src, "->", dest, stats.describe())
+
+    return stats
+
+
+def _populate_directory(
+    src_dir: Path, dest_dir: Path, names: list[str], strategies: _Strategies
+) -> CopyStats:
+    stats = CopyStats()
+
+    for name in names:
+        src, dest = src_dir / name, dest_dir / name
+
+        if dest.is_symlink() or dest.is_file():
+            dest.unlink()
+
+        if src.is_symlink():
+            os.symlink(os.readlink(src), dest)
+            stats.symlinks += 1
+            continue
+
+        size = src.stat().st_size
+        stats.files += 1
+
+        if strategies.clone and _try_strategy(strategies, "clone", _clone_file, src, dest):
+            stats.bytes_cloned += size
+        elif strategies.link and _try_strategy(strategies, "link", os.link, src, dest):
+            # The link shares the source's inode, so there's no metadata to copy
+            stats.bytes_linked += size
+            continue
+        elif strategies.copy_file_range and _try_strategy(
+            strategies, "copy_file_range", _copy_file_range, src, dest
+        ):
+            stats.bytes_copied += size
+        else:
+            shutil.copyfile(src, dest)
+            stats.bytes_copied += size
+
+        shutil.copystat(src, dest)
+
+    return stats
+
+
+def _try_strategy(strategies: _Strategies, name: str, impl, src: Path, dest: Path) -> bool:
+    try:
+        impl(src, dest)
+    except OSError as exc:
+        if exc.errno not in _UNSUPPORTED_ERRNOS and not isinstance(exc, PermissionError):
+            raise
+
+        strategies.disable(name)
+        dest.unlink(missing_ok=True)
+        return False
+
+    return True
+
+
+def _clone_file(src: Path, dest: Path) -> None:
+    with open(src, "rb") as src_file, open(dest, "wb") as dest_file:
+        fcntl.ioctl(dest_file.fileno(), FICLONE, src_file.fileno())
+
+
+def _copy_file_range(src: Path, dest: Path) -> None:
+    with open(src, "rb") as src_file, open(dest, "wb") as dest_file:
+        remaining = os.fstat(src_file.fileno()).st_size
+        while remaining > 0:
+            copied = os.copy_file_range(src_file.fileno(), dest_file.fileno(), remaining)
+            if copied == 0:
+                break
+            remaining -= copied
+
+    # Some filesystems report end of file early to copy_file_range (procfs, some FUSE mounts); a
+    # short copy must never be left in the tree, so copy the file again the ordinary way
+    if remaining > 0:
+        shutil.copyfile(src, dest)
@@ -0,0 +1,227 @@
+"""
+Per-run deploy metrics, kept in a SQLite database across runs
+
+A run is recorded as one row of run-level facts (event, pull request, outcome, byte counts) plus
+the time spent in each phase. Phases are timed with phase(), which can wrap a block or decorate a
+function and does nothing unless a run is being recorded, so it can be used anywhere without
+threading a recorder through.
+
+Where the database itself can't be shared safely, as when it would be saved to the Actions cache
+by overlapping runs, each run appends its record to a JSON lines file of its own instead, and the
+files are imported into a database when reporting. A run is identified by its repository and start
+time, so importing the same file twice doesn't count its runs twice.
+"""
+
+from __future__ import annotations
+
+import contextlib
+from dataclasses import dataclass, field
+import json
+from pathlib import Path
+import sqlite3
+import time
+from typing import Any, Iterator, Literal
+
+from .utils import cache_dir
+
+Outcome = Literal[
+    "deployed",
+    "stale",
+    "ineligible",
+    "superseded",
+    "already-deployed",
+    "unchanged",
+    "speculative",
+    "nothing-to-do",
+    "failed",
+]
+
+PHASES = ["evaluate", "mergeability", "fetch", "prepare", "sentry", "push"]
+
+# Run-level facts, in the order of the runs table's columns
+RUN_COLUMNS = [
+    "started_at",
+    "repo",
+    "event",
+    "pr_number",
+    "outcome",
+    "total_seconds",
+    "bytes_fetched",
+    "bytes_pushed",
+    "tree_bytes",
+]
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY,
+    started_at REAL NOT NULL,
+    repo TEXT NOT NULL,
+    event TEXT NOT NULL,
+    pr_number INTEGER,
+    outcome TEXT NOT NULL,
+    total_seconds REAL NOT NULL,
+    bytes_fetched INTEGER,
+    bytes_pushed INTEGER,
+    tree_bytes INTEGER
+);
+CREATE INDEX IF NOT EXISTS runs_started_at ON runs (started_at);
+CREATE UNIQUE INDEX IF NOT EXISTS runs_identity ON runs (repo, started_at);
+CREATE TABLE IF NOT EXISTS phases (
+    run_id INTEGER NOT NULL REFERENCES runs (id) ON DELETE CASCADE,
+    phase TEXT NOT NULL,
+    seconds REAL NOT NULL,
+    PRIMARY KEY (run_id, phase)
+);
+"""
+
+
+@dataclass(kw_only=True)
+class RunRecorder:
+    repo: str
+    event: str
+    pr_number: int | None
+    started_at: float = field(default_factory=time.time)
+    outcome: Outcome = "failed"
+    phases: dict[str, float] = field(default_factory=dict)
+    bytes_fetched: int | None = None
+    bytes_pushed: int | None = None
+    tree_bytes: int | None = None
+    total_seconds: float = 0.0
+
+    _start: float = field(default_factory=time.monotonic, init=False, repr=False)
+
+    def finish(self) -> None:
+        self.total_seconds = time.monotonic() - self._start
+
+    def to_record(self) -> dict[str, Any]:
+        """The run as a record for a JSON lines file"""
+        return {**{column: getattr(self, column) for column in RUN_COLUMNS}, "phases": self.phases}
+
+
+_active: RunRecorder | None = None
+
+
+@contextlib.contextmanager
+def recording(recorder: RunRecorder) -> Iterator[RunRecorder]:
+    """Make the recorder the target of phase() and set_outcome() for the duration"""
+    global _active
+
+    previous, _active = _active, recorder
+    try:
+        yield recorder
+    finally:
+        _active = previous
+        recorder.finish()
+
+
+@contextlib.contextmanager
+def phase(name: str) -> Iterator[None]:
+    """Add the time spent in the block to the named phase of the active run"""
+    start = time.monotonic()
+    try:
+        yield
+    finally:
+        if _active is not None:
+            _active.phases[name] = _active.phases.get(name, 0.0) + time.monotonic() - start
+
+
+def active() -> RunRecorder | None:
+    return _active
+
+
+def set_outcome(outcome: Outcome) -> None:
+    if _active is not None:
+        _active.outcome = outcome
+
+
+class MetricsStore:
+    def __init__(self, path: Path) -> None:
+        self.path = path
+
+    def record(self, run: RunRecorder) -> None:
+        with self._connect() as db:
+            _insert(db, run.to_record())
+
+    def import_records(self, path: Path) -> int:
+        """Add the runs in a JSON lines file which aren't in the store yet, returning how many"""
+        records = [json.loads(line) for line in path.read_text().splitlines() if line.strip()]
+
+        with self._connect() as db:
+            return sum(_insert(db, record) for record in records)
+
+    def runs_since(self, since: float, repo: str | None = None) -> list[sqlite3.Row]:
+        with self._connect() as db:
+            return db.execute(
+                "SELECT * FROM runs WHERE started_at >= ? AND (? IS NULL OR repo = ?) "
+                "ORDER BY started_at",
+                (since, repo, repo),
+            ).fetchall()
+
+    def phases_since(self, since: float, repo: str | None = None) -> list[sqlite3.Row]:
+        with self._connect() as db:
+            return db.execute(
+                "SELECT phases.phase, phases.seconds FROM phases JOIN runs ON runs.id = run_id "
+                "WHERE runs.started_at >= ? AND (? IS NULL OR runs.repo = ?)",
+                (since, repo, repo),
+            ).fetchall()
+
+    @contextlib.contextmanager
+    def _connect(self) -> Iterator[sqlite3.Connection]:
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+
+        # Concurrent runs on one machine wait for each other's writes rather than failing
+        db = sqlite3.connect(self.path, timeout=30)
+        try:
+            db.row_factory = sqlite3.Row
+            db.execute("PRAGMA foreign_keys = ON")
+            db.executescript(_SCHEMA)
+            with db:
+                yield db
+        finally:
+            db.close()
+
+
+def append_record(path: Path, run: RunRecorder) -> None:
+    """Append a run to a JSON lines file, for a store to import later"""
+    path.parent.mkdir(parents=True, exist_ok=True)
+
+    with open(path, "a", encoding="utf8") as f:
+        f.write(json.dumps(run.to_record()) + "\n")
+
+
+def _insert(db: sqlite3.Connection, record: dict[str, Any]) -> bool:
+    """Insert a run unless it's already recorded, returning whether it was inserted"""
+    cursor = db.execute(
+        f"INSERT OR IGNORE INTO runs ({', '.join(RUN_COLUMNS)}) "
+        f"VALUES ({', '.join('?' for _ in RUN_COLUMNS)})",
+        [record[column] for column in RUN_COLUMNS],
+    )
+    if cursor.rowcount == 0:
+        return False
+
+    db.executemany(
+        "INSERT INTO phases (run_id, phase, seconds) VALUES (?, ?, ?)",
+        [(cursor.lastrowid, name, seconds) for name, seconds in record["phases"].items()],
+    )
+    return True
+
+
+def percentile(values: list[float], q: float) -> float:
+    """Linearly interpolated percentile, q in [0, 1]"""
+    if not values:
+        raise ValueError("no values")
+
+    ordered = sorted(values)
+    rank = q * (len(ordered) - 1)
+    lower = int(rank)
+    upper = min(lower + 1, len(ordered) - 1)
+
+    return ordered[lower] + (ordered[upper] - ordered[lower]) * (rank - lower)
+
+
+def default_store() -> MetricsStore | None:
+    """Return the store in the cache directory, if one is configured"""
+    if (root := cache_dir()) is not None:
+        return MetricsStore(root / "deploy-metrics.sqlite3")
+
+    return None
@@ -0,0 +1,250 @@
+"""
+Bare repository of objects shared by CI runs through git alternates
+
+The cache lives at <cache dir>/objects.git and can be persisted between runs (for example with
+the Actions cache). While a run is attached, the cache's object directory is listed in the working
+repository's objects/info/alternates; since fetches advertise the tips of an alternate's refs as
+objects the client already has, only objects newer than the cache are transferred.
+
+The cache holds complete history for the branches it tracks, under refs/cache/<remote>/<branch>,
+and is updated from the working repository once its own fetches of those branches succeed.
+It must never become shallow: an alternate's refs are taken to imply all of their history, so a
+ref whose ancestors are missing would lead the server to omit objects the working repository
+needs.
+
+Concurrent runs on one machine coordinate through two lock files:
+
+- update.lock is held exclusively to create, update or prune the cache
+- readers.lock is held shared by each attached run for as long as it may read from the cache;
+  pruning only deletes objects if it can take it exclusively, so it's skipped while any run is
+  attached
+
+Attached working repositories rely on the cache for objects they didn't fetch themselves, so
+they're expected to be discarded after the run, as a CI checkout is, and the cache is only pruned
+(by maintain-repo --object-cache) once nothing will use the checkout again.
+
+A replayed run neither takes the locks nor writes to the cache or alternates; what the recorded
+run found in the cache is read back from the cassette.
+"""
+
+from __future__ import annotations
+
+import contextlib
+import fcntl
+import hashlib
+import json
+import os
+from pathlib import Path
+import time
+from typing import Iterator, Mapping
+
+from . import cassette, repo_maintenance
+from .output import emit_warning, log_group, print_info_line
+from .utils import cache_dir, run
+
+CACHE_REF_ROOT = "refs/cache"
+
+# Tracked branches which haven't been updated for this long are dropped
+MAX_AGE_SECONDS = 14 * 24 * 60 * 60
+
+# Beyond this size only the most recently updated branches are kept
+MAX_SIZE_BYTES = 2 * 1024 * 1024 * 1024
+
+
+class ObjectCache:
+    def __init__(
+        self,
+        path: Path,
+        max_age: float = MAX_AGE_SECONDS,
+        max_size: int = MAX_SIZE_BYTES,
+    ) -> None:
+        self.path = path
+        self.max_age = max_age
+        self.max_size = max_size
+        self.git_args = [f"--git-dir={path}"]
+
+    @property
+    def objects_dir(self) -> Path:
+        return self.path.resolve() / "objects"
+
+    @contextlib.contextmanager
+    def attached(self) -> Iterator[None]:
+        """Borrow objects from the cache in the current repository for the duration"""
+        if not cassette.replaying():
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+
+        with self._lock("readers.lock", fcntl.LOCK_SH):
+            with self._lock("update.lock", fcntl.LOCK_EX):
+                if not self._exists():
+                    run(["git", "init", "--quiet", "--bare", str(self.path)])
+
+            alternates = Path(
+                run(["git", "rev-parse", "--git-path", "objects/info/alternates"]).removesuffix(
+                    "\n"
+                )
+            )
+            existing = alternates.read_text().splitlines() if alternates.exists() else []
+
+            if str(self.objects_dir) not in existing and not cassette.replaying():
+                alternates.parent.mkdir(parents=True, exist_ok=True)
+                with open(alternates, "a") as f:
+                    f.write(f"{self.objects_dir}\n")
+
+            print_info_line("object cache", f"attached {self.path}")
+            yield
+
+    @log_group("Update object cache")
+    def update(self, remote: str, refs: Mapping[str, str]) -> None:
+        """Copy the complete history of the given branches into the cache from this repository
+
+        refs maps each branch of the remote to the local ref it was fetched into. Nothing is
+        transferred over the network: the objects were fetched by the run already, and those the
+        cache has are skipped. A branch whose history is shallow locally is rejected by git rather
+        than making the cache shallow.
+        """
+        if not refs:
+            return
+
+        url = run(["git", "remote", "get-url", "--", remote]).removesuffix("\n")
+        namespace = f"{CACHE_REF_ROOT}/{_remote_key(url)}"
+        refspecs = [f"+{ref}:{namespace}/{branch}" for branch, ref in refs.items()]
+        git_dir = run(["git", "rev-parse", "--absolute-git-dir"]).removesuffix("\n")
+
+        with self._lock("update.lock", fcntl.LOCK_EX):
+            run(["git", *self.git_args, "fetch", "--no-tags", "--quiet", "--", git_dir, *refspecs])
+
+            with self._refs_metadata() as updated_at:
+                now = time.time()
+                for refspec in refspecs:
+                    updated_at[refspec.rsplit(":", maxsplit=1)[1]] = now
+
+            repo_maintenance.maintain_if_needed(self.git_args)
+
+    def prune(self) -> None:
+        """Drop branches by age and size, then delete unreachable objects if no run is attached"""
+        if not self._exists():
+            return
+
+        with self._lock("update.lock", fcntl.LOCK_EX):
+            with self._refs_metadata() as updated_at:
+                existing = set(
+                    run(
+                        [
+                            "git",
+                            *self.git_args,
+                            "for-each-ref",
+                            "--format=%(refname)",
+                            CACHE_REF_ROOT,
+                        ]
+                    ).splitlines()
+                )
+                for ref in list(updated_at):
+                    if ref not in existing:
+                        del updated_at[ref]
+
+                cutoff = time.time() - self.max_age
+                stale = [ref for ref in existing if updated_at.get(ref, 0) < cutoff]
+
+                if self._size() > self.max_size and updated_at:
+                    # Keep only the branches from the most recent update
+                    newest = max(updated_at.values())
+                    stale.extend(ref for ref, at in updated_at.items() if at < newest)
+
+                stale = sorted(set(stale))
+
+                if stale:
+                    print_info_line("object cache", f"dropping {len(stale)} refs")
+
+                for ref in stale:
+                    run(["git", *self.git_args, "update-ref", "-d", ref])
+                    updated_at.pop(ref, None)
+
+            # Remembers that refs were dropped until the objects they referenced have been deleted
+            gc_pending = self.path / "ci-tools-gc-pending"
+            if stale:
+                if not cassette.replaying():
+                    gc_pending.touch()
+            elif not cassette.local_value("object cache gc pending", gc_pending.exists):
+                return
+
+            with contextlib.ExitStack() as stack:
+                if not cassette.local_value(
+                    "object cache unused", lambda: self._try_lock(stack, "readers.lock")
+                ):
+                    print_info_line("object cache", "in use; leaving unreachable objects for later")
+                    return
+
+                run(["git", *self.git_args, "gc", "--quiet", "--prune=now"])
+                if not cassette.replaying():
+                    gc_pending.unlink()
+
+            if self._size() > self.max_size:
+                emit_warning(
+                    f"object cache at {self.path} exceeds {self.max_size} bytes after pruning"
+                )
+
+    def _size(self) -> int:
+        return repo_maintenance.ObjectStoreStats.collect(self.git_args).size
+
+    def _exists(self) -> bool:
+        return cassette.local_value("object cache exists", (self.path / "HEAD").exists)
+
+    @contextlib.contextmanager
+    def _lock(self, name: str, operation: int) -> Iterator[None]:
+        if cassette.replaying():
+            yield
+            return
+
+        with open(self.path.parent / f"{self.path.name}.{name}", "a") as lock_file:
+            fcntl.flock(lock_file, operation)
+            yield
+
+    def _try_lock(self, stack: contextlib.ExitStack, name: str) -> bool:
+        """Take a lock exclusively for the stack's lifetime if it's free, returning whether it was"""
+        try:
+            stack.enter_context(self._lock(name, fcntl.LOCK_EX | fcntl.LOCK_NB))
+        except BlockingIOError:
+            return False
+
+        return True
+
+    @contextlib.contextmanager
+    def _refs_metadata(self) -> Iterator[dict[str, float]]:
+        """Read-modify-write the last update time of each ref; the update lock must be held"""
+        path = self.path / "ci-tools-refs.json"
+        updated_at = cassette.local_value("object cache update times", lambda: _read_json(path))
+
+        yield updated_at
+
+        if cassette.replaying():
+            return
+
+        tmp = path.with_suffix(".tmp")
+        tmp.write_text(json.dumps(updated_at))
+        os.replace(tmp, path)
+
+
+def _read_json(path: Path) -> dict[str, float]:
+    try:
+        content: dict[str, float] = json.loads(path.read_text())
+    except (FileNotFoundError, ValueError):
+        return {}
+
+    return content
+
+
+def _remote_key(url: str) -> str:
+    return hashlib.sha256(url.encode()).hexdigest()[:16]
+
+
+_default_cache: ObjectCache | None = None
+
+
+def default_cache() -> ObjectCache | None:
+    """Return the process-wide cache if a cache directory is configured"""
+    global _default_cache
+
+    if _default_cache is None and (root := cache_dir()) is not None:
+        _default_cache = ObjectCache(root / "objects.git")
+
+    return _default_cache
@@ -1,11 +1,33 @@
+"""
+Console output for CI runs
+
+Everything written to the console goes through _console(), which also copies it to the log
+archive if one is configured (CI_TOOLS_LOG_DIR, one gzip file per process). With an archive,
+the output of individual commands is capped on the console by print_capped() to its first and
+last lines; the lines in between are only in the archive, and the console says where to find
+them.
+"""
+
 from __future__ import annotations
 
+import atexit
+import collections
 import contextlib
 from enum import Enum
 import functools
+import gzip
 import os
+from pathlib import Path
+import re
 import sys
-from typing import Any, Callable, TypeVar
+import threading
+from typing import Any, Callable, Iterable, TypeVar
+import zlib
+
+# Lines of each capped block shown on the console, unless overridden by CI_TOOLS_LOG_HEAD_LINES
+# and CI_TOOLS_LOG_TAIL_LINES
+DEFAULT_HEAD_LINES = 20
+DEFAULT_TAIL_LINES = 20
 
 
 @contextlib.contextmanager
@@ -16,14 +38,14 @@ def enter_log_group(title: str):
 
     try:
         if is_within_github_action():
-            print(f"::group::{title}", file=sys.stderr)
+            _console(f"::group::{title}")
         else:
             print_info_line("group", title)
 
         yield
     finally:
         if is_within_github_action():
-            print("::endgroup::", file=sys.stderr)
+            _console("::endgroup::")
         else:
             print_info_line("endgroup", title)
 
@@ -57,18 +79,65 @@ class AnsiStyle(Enum):
 
 
 def print_info_line(prefix: str, *etc: Any, header_style: AnsiStyle = AnsiStyle.BoldWhite) -> None:
-    print(header_style(prefix), *etc, file=sys.stderr)
+    _console(" ".join([header_style(prefix), *(str(a) for a in etc)]))
 
 
 def print_info_multi(prefix: str, subhead: str, *etc: Any) -> None:
-    print(
-        AnsiStyle.BoldWhite(prefix),
-        *([AnsiStyle.Cyan(subhead)] if subhead else ()),
-        file=sys.stderr,
+    _console(
+        " ".join([AnsiStyle.BoldWhite(prefix), *([AnsiStyle.Cyan(subhead)] if subhead else ())])
     )
 
     if etc:
-        print(AnsiStyle.DimWhite(*etc), file=sys.stderr)
+        rendered = " ".join(str(a) for a in etc)
+        print_capped(AnsiStyle.DimWhite(line) for line in rendered.splitlines())
+
+
+def print_capped(lines: Iterable[str]) -> None:
+    """Print the output of one command, keeping only its first and last lines if archiving
+
+    Workflow commands (lines starting with "::", such as annotations and group markers) are
+    always printed, since dropping them would change the structure of the log.
+    """
+    if (archive := log_archive()) is None:
+        for line in lines:
+            _console(line)
+        return
+
+    head, tail_size = log_limits()
+    tail: collections.deque[str] = collections.deque()
+    shown = omitted = 0
+    first_omitted = 0
+
+    # Held throughout so that the archive line numbers given for the block are contiguous
+    with _console_lock:
+        for line in lines:
+            if shown < head or line.startswith("::"):
+                # Lines held back for the tail come first, to keep the console in order
+                while tail:
+                    _console(tail.popleft())
+                _console(line)
+                shown += 1
+                continue
+
+            tail.append(line)
+            if len(tail) > tail_size:
+                lineno = archive.write(tail.popleft())
+                first_omitted = first_omitted or lineno
+                omitted += 1
+
+        if omitted:
+            print(
+                AnsiStyle.DimWhite(
+                    f"... {omitted} lines omitted; full output from line {first_omitted} "
+                    f"of {archive.path}"
+                ),
+                file=sys.stderr,
+            )
+
+        for line in tail:
+            _console(line)
+
+        archive.flush()
 
 
 class MessageType(Enum):
@@ -80,7 +149,7 @@ class MessageType(Enum):
         is_gh_action = is_within_github_action()
         for line in " ".join(str(a) for a in message).splitlines():
             if is_gh_action:
-                print(f"::{self.value}::", line, file=sys.stderr)
+                _console(f"::{self.value}:: {line}")
             else:
                 print_info_line(self.value, line, header_style=self.style)
 
@@ -116,3 +185,67 @@ def emit_summary(*content: Any, title: str | None = None) -> None:
 def is_within_github_action() -> bool:
     # Double-check for actions mostly just to make the dependency explicit
     return os.getenv("GITHUB_ACTIONS") == "true"
+
+
+class LogArchive:
+    """Gzip-compressed copy of everything written to the console, without ANSI styling"""
+
+    def __init__(self, path: Path) -> None:
+        self.path = path
+        self.lines = 0
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self._file = gzip.open(path, "wb")
+
+    def write(self, text: str) -> int:
+        """Append text, returning the line number of its first line"""
+        first = self.lines + 1
+        plain = _ANSI_ESCAPE.sub("", text)
+        self._file.write(plain.encode(errors="replace") + b"\n")
+        self.lines += plain.count("\n") + 1
+        return first
+
+    def flush(self) -> None:
+        # A sync flush leaves a readable archive even if the process is killed later
+        self._file.flush(zlib.Z_SYNC_FLUSH)
+
+    def close(self) -> None:
+        self._file.close()
+
+
+_ANSI_ESCAPE = re.compile(r"\033\[[0-9;]*m")
+
+# Reentrant since print_capped() holds it while writing lines through _console()
+_console_lock = threading.RLock()
+_archive: LogArchive | None = None
+_archive_checked = False
+
+
+def log_archive() -> LogArchive | None:
+    """Return the process's log archive, opening it on first use if one is configured"""
+    global _archive, _archive_checked
+
+    with _console_lock:
+        if not _archive_checked:
+            _archive_checked = True
+
+            if log_dir := os.getenv("CI_TOOLS_LOG_DIR"):
+                _archive = LogArchive(Path(log_dir) / f"ci-tools-{os.getpid()}.log.gz")
+                atexit.register(_archive.close)
+
+        return _archive
+
+
+def log_limits() -> tuple[int, int]:
+    """Lines shown on the console at the start and end of each capped block"""
+    return (
+        int(os.getenv("CI_TOOLS_LOG_HEAD_LINES", DEFAULT_HEAD_LINES)),
+        int(os.getenv("CI_TOOLS_LOG_TAIL_LINES", DEFAULT_TAIL_LINES)),
+    )
+
+
+def _console(text: str) -> None:
+    with _console_lock:
+        print(text, file=sys.stderr)
+
+        if (archive := log_archive()) is not None:
+            archive.write(text)
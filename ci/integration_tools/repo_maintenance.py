@@ -0,0 +1,169 @@
+"""
+Object store maintenance for the CI clone
+
+Deploys walk the whole of master with rev-list and negotiate shallow fetches of the pull request
+refs, both of which slow down as history grows unless git has a commit-graph (generation numbers
+and changed-path Bloom filters) and a multi-pack-index to work from. Neither is written by a plain
+clone or fetch, so they're maintained here once the object store is large enough to benefit.
+
+Git ignores commit-graphs in shallow repositories, so only the multi-pack-index and loose object
+packing apply to those.
+"""
+
+from __future__ import annotations
+
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, Sequence
+
+from . import cassette
+from .output import log_group, print_info_line
+from .utils import run
+
+# Below this many packed objects maintenance isn't worth the time it takes
+MIN_PACKED_OBJECTS = 10_000
+
+# Loose objects beyond this are packed; each one is a separate file to open during a walk
+MAX_LOOSE_OBJECTS = 2_000
+
+# Packs newer than the commit-graph or multi-pack-index beyond this trigger a rewrite of both
+MAX_UNINDEXED_PACKS = 4
+
+
+@dataclass(kw_only=True)
+class ObjectStoreStats:
+    loose_objects: int
+    packed_objects: int
+    size: int
+    packs: int
+    unindexed_packs: int
+    shallow: bool
+    has_alternates: bool
+    has_commit_graph: bool
+    has_multi_pack_index: bool
+
+    @staticmethod
+    def collect(global_git_args: Sequence[str] = ()) -> ObjectStoreStats:
+        counts = {}
+        has_alternates = False
+        for line in run(["git", *global_git_args, "count-objects", "-v"]).splitlines():
+            match line.split(": ", maxsplit=1):
+                case ["alternate", _]:
+                    has_alternates = True
+                case [key, value]:
+                    counts[key] = int(value)
+
+        objects_dir = Path(
+            run(["git", *global_git_args, "rev-parse", "--git-path", "objects"]).removesuffix("\n")
+        )
+
+        indexes = cassette.local_value("object store indexes", lambda: _index_state(objects_dir))
+
+        shallow = run(["git", *global_git_args, "rev-parse", "--is-shallow-repository"])
+
+        return ObjectStoreStats(
+            loose_objects=counts["count"],
+            packed_objects=counts["in-pack"],
+            # Sizes are reported in KiB
+            size=(counts["size"] + counts["size-pack"]) * 1024,
+            packs=counts["packs"],
+            unindexed_packs=indexes["unindexed_packs"],
+            shallow=shallow.strip() == "true",
+            has_alternates=has_alternates,
+            has_commit_graph=indexes["has_commit_graph"],
+            has_multi_pack_index=indexes["has_multi_pack_index"],
+        )
+
+    def maintenance_reasons(self) -> list[str]:
+        if self.packed_objects + self.loose_objects < MIN_PACKED_OBJECTS:
+            return []
+
+        reasons = []
+
+        if self.loose_objects > MAX_LOOSE_OBJECTS:
+            reasons.append(f"{self.loose_objects} loose objects")
+
+        if not self.has_multi_pack_index and self.packs > 1:
+            reasons.append("no multi-pack-index")
+
+        if not self.has_commit_graph and not self.shallow:
+            reasons.append("no commit-graph")
+
+        if self.unindexed_packs > MAX_UNINDEXED_PACKS:
+            reasons.append(f"{self.unindexed_packs} packs not covered by indexes")
+
+        return reasons
+
+
+def _index_state(objects_dir: Path) -> dict[str, Any]:
+    """Which indexes an object directory has, and how many packs arrived after them"""
+    graph_files = [
+        objects_dir / "info/commit-graph",
+        objects_dir / "info/commit-graphs/commit-graph-chain",
+    ]
+    midx_file = objects_dir / "pack/multi-pack-index"
+
+    # Both indexes have to be rewritten to cover packs which arrived after them
+    indexed_at = min(
+        max((f.stat().st_mtime for f in graph_files if f.exists()), default=0.0),
+        midx_file.stat().st_mtime if midx_file.exists() else 0.0,
+    )
+
+    return {
+        "unindexed_packs": sum(
+            1 for pack in objects_dir.glob("pack/*.pack") if pack.stat().st_mtime > indexed_at
+        ),
+        "has_commit_graph": any(f.exists() for f in graph_files),
+        "has_multi_pack_index": midx_file.exists(),
+    }
+
+
+def maintain_if_needed(global_git_args: Sequence[str] = ()) -> bool:
+    """Run maintenance if the object store has outgrown its indexes, returning whether it ran"""
+    stats = ObjectStoreStats.collect(global_git_args)
+    reasons = stats.maintenance_reasons()
+
+    if not reasons:
+        return False
+
+    print_info_line("maintenance", "needed:", ", ".join(reasons))
+    maintain(stats, global_git_args)
+    return True
+
+
+@log_group("Repository maintenance")
+def maintain(stats: ObjectStoreStats, global_git_args: Sequence[str] = ()) -> None:
+    if stats.loose_objects > MAX_LOOSE_OBJECTS:
+        # Only packs the loose objects; existing packs are left alone
+        run(["git", *global_git_args, "repack", "-d", "-q", "--no-write-bitmap-index"])
+
+    if stats.shallow:
+        print_info_line("maintenance", "shallow repository; skipping commit-graph")
+    else:
+        run(
+            [
+                "git",
+                *global_git_args,
+                "commit-graph",
+                "write",
+                "--reachable",
+                "--changed-paths",
+                "--split",
+                "--no-progress",
+            ]
+        )
+
+    # Bitmaps need every reachable object in the repository's own packs, which isn't the case for
+    # a shallow repository or one borrowing objects from an alternate
+    bitmap = not stats.shallow and not stats.has_alternates
+
+    run(
+        [
+            "git",
+            *global_git_args,
+            "multi-pack-index",
+            "write",
+            "--no-progress",
+            *(["--bitmap"] if bitmap else []),
+        ]
+    )
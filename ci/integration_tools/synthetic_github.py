@@ -0,0 +1,333 @@
+"""
+Synthetic GitHub API for benchmarking pull request polling
+
+generate_repo() builds a repository's open pull requests, their reviews and build workflow runs
+from a SyntheticRepoSpec, using the fixtures in ci/pull-request/test as templates so that
+responses are the size of real ones. The server answers the part of the REST API which the
+pollers use (pull request listings, single pull requests, reviews, labels, workflow runs and
+dispatches) with ETags and conditional requests like GitHub's, applies label changes so that later
+poll cycles see them, and counts the requests it receives.
+
+running_server() serves from a child process so that the server shares neither memory nor the GIL
+with the client being measured.
+"""
+
+from __future__ import annotations
+
+from collections import Counter
+import contextlib
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta
+import hashlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import multiprocessing
+from pathlib import Path
+import random
+import re
+import threading
+from typing import Any, Iterator
+from urllib.parse import parse_qs, unquote, urlsplit
+from urllib.request import urlopen
+
+FIXTURES = Path(__file__).parent.parent / "pull-request" / "test"
+
+BUILD_WORKFLOW_ID = 1
+
+_REPO_PATH = re.compile(r"/repos/(?P<repo>[^/]+/[^/]+)/(?P<rest>.*)$")
+
+# Creation time of the first synthetic pull request; later ones follow at one minute intervals
+_EPOCH = datetime(2024, 1, 1)
+
+
+@dataclass(frozen=True, kw_only=True)
+class SyntheticRepoSpec:
+    repo: str = "bench/site"
+    prs: int = 500
+    automerge: float = 0.5
+    """Fraction of pull requests labelled automerge"""
+    merge_pending: float = 0.3
+    """Fraction of pull requests labelled merge-pending"""
+    drafts: float = 0.05
+    null_mergeable: float = 0.1
+    """Fraction of pull requests whose mergeability GitHub is still computing"""
+    conflicting: float = 0.05
+    max_reviews: int = 4
+    author_mix: dict[str, float] = field(
+        default_factory=lambda: {"OWNER": 3, "COLLABORATOR": 1, "CONTRIBUTOR": 4, "NONE": 2}
+    )
+    """Relative weights of pull request and review author associations"""
+    review_mix: dict[str, float] = field(
+        default_factory=lambda: {"APPROVED": 2, "CHANGES_REQUESTED": 1, "COMMENTED": 3}
+    )
+    seed: int = 0
+
+
+@dataclass(kw_only=True)
+class SyntheticRepo:
+    pulls: dict[int, dict[str, Any]]
+    reviews: dict[int, list[dict[str, Any]]]
+    runs: list[dict[str, Any]]
+
+
+def generate_repo(spec: SyntheticRepoSpec) -> SyntheticRepo:
+    rng = random.Random(spec.seed)
+
+    pr_template = (FIXTURES / "first-party.pr.json").read_text()
+    review_template = json.dumps(
+        json.loads((FIXTURES / "third-party.pr-reviews.json").read_text())[0]
+    )
+
+    def association() -> str:
+        return rng.choices(list(spec.author_mix), weights=list(spec.author_mix.values()))[0]
+
+    def sha(*parts: object) -> str:
+        return hashlib.sha1(":".join(map(str, parts)).encode()).hexdigest()
+
+    repo = SyntheticRepo(pulls={}, reviews={}, runs=[])
+
+    for number in range(1, spec.prs + 1):
+        pr = json.loads(pr_template)
+
+        labels = []
+        if rng.random() < spec.automerge:
+            labels.append("automerge")
+        if rng.random() < spec.merge_pending:
+            labels.append("merge-pending")
+        if rng.random() < 0.2:
+            labels.append(rng.choice(["bug", "dependencies", "documentation"]))
+
+        mergeable: bool | None = True
+        if (roll := rng.random()) < spec.null_mergeable:
+            mergeable = None
+        elif roll < spec.null_mergeable + spec.conflicting:
+            mergeable = False
+
+        head_sha = sha("head", spec.seed, number)
+
+        pr.update(
+            number=number,
+            id=number,
+            labels=[{"id": i, "name": name} for i, name in enumerate(labels)],
+            author_association=association(),
+            draft=rng.random() < spec.drafts,
+            mergeable=mergeable,
+            merge_commit_sha=sha("merge", spec.seed, number),
+            created_at=(_EPOCH + timedelta(minutes=number)).isoformat() + "Z",
+        )
+        pr["head"].update(ref=f"feature-{number}", sha=head_sha)
+        pr["base"].update(ref="develop", sha=sha("base", spec.seed))
+
+        reviews = []
+        for i in range(rng.randint(0, spec.max_reviews)):
+            review = json.loads(review_template)
+            review.update(
+                id=number * 100 + i,
+                state=rng.choices(list(spec.review_mix), weights=list(spec.review_mix.values()))[0],
+                author_association=association(),
+                commit_id=head_sha,
+            )
+            reviews.append(review)
+
+        repo.pulls[number] = pr
+        repo.reviews[number] = reviews
+        repo.runs.append(
+            {
+                "id": number,
+                "name": "Build and test",
+                "event": "pull_request",
+                "head_branch": f"feature-{number}",
+                "head_sha": head_sha,
+                "status": "completed",
+                "conclusion": "success",
+                "workflow_url": f"/repos/{spec.repo}/actions/workflows/{BUILD_WORKFLOW_ID}",
+            }
+        )
+
+    return repo
+
+
+class SyntheticGitHub(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, spec: SyntheticRepoSpec, address: tuple[str, int]) -> None:
+        super().__init__(address, _Handler)
+        self.spec = spec
+        self.repo = generate_repo(spec)
+        self.lock = threading.Lock()
+        self.requests: Counter[str] = Counter()
+
+    def handle_error(self, request: Any, client_address: Any) -> None:
+        # Clients dropping keep-alive connections are expected, and not worth a traceback
+        pass
+
+    @property
+    def url(self) -> str:
+        host, port = self.server_address[:2]
+        return f"http://{host!s}:{port}"
+
+
+@dataclass
+class _Reply:
+    status: int
+    content: Any
+    route: str
+    """Name under which the request is counted"""
+    headers: dict[str, str] = field(default_factory=dict)
+
+
+class _Handler(BaseHTTPRequestHandler):
+    server: SyntheticGitHub
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format: str, *args: Any) -> None:
+        pass
+
+    def do_GET(self) -> None:
+        self._handle()
+
+    do_POST = do_PUT = do_DELETE = do_GET
+
+    def _handle(self) -> None:
+        parts = urlsplit(self.path)
+        query = {k: v[-1] for k, v in parse_qs(parts.query).items()}
+        body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+
+        if parts.path == "/_bench/stats":
+            with self.server.lock:
+                stats = dict(self.server.requests)
+                if query.get("reset"):
+                    self.server.requests.clear()
+            return self._send(200, {}, json.dumps(stats).encode())
+
+        # Responses are encoded under the lock, so that they're consistent with each other, but
+        # sent without it
+        with self.server.lock:
+            match = _REPO_PATH.match(parts.path)
+            if match is None or match["repo"] != self.server.spec.repo:
+                reply = _Reply(404, {"message": "Not Found"}, "other")
+            else:
+                reply = self._route(match["rest"], query, body)
+
+            status, headers, payload = self._encode(reply)
+
+        self._send(status, headers, payload)
+
+    def _route(self, rest: str, query: dict[str, str], body: bytes) -> _Reply:
+        repo = self.server.repo
+        method = self.command
+
+        match method, rest.split("/"):
+            case "GET", ["pulls"]:
+                per_page = int(query.get("per_page", 30))
+                page = int(query.get("page", 1))
+                pulls = [repo.pulls[n] for n in sorted(repo.pulls)]
+                headers = {}
+                if page * per_page < len(pulls):
+                    next_query = f"state=open&per_page={per_page}&page={page + 1}"
+                    headers["Link"] = f'<{self._repo_url()}/pulls?{next_query}>; rel="next"'
+                chunk = pulls[(page - 1) * per_page : page * per_page]
+                return _Reply(200, chunk, "list pulls", headers)
+
+            case "GET", ["pulls", n] if (number := _number(repo.pulls, n)) is not None:
+                return _Reply(200, repo.pulls[number], "get pull")
+
+            case "GET", ["pulls", n, "reviews"] if (number := _number(repo.pulls, n)) is not None:
+                return _Reply(200, repo.reviews[number], "list reviews")
+
+            case ("POST" | "PUT"), ["issues", n, "labels"] if (
+                number := _number(repo.pulls, n)
+            ) is not None:
+                pr = repo.pulls[number]
+                names = json.loads(body)["labels"]
+                if method == "POST":
+                    names = [label["name"] for label in pr["labels"]] + names
+                pr["labels"] = [{"id": i, "name": n} for i, n in enumerate(dict.fromkeys(names))]
+                return _Reply(200, pr["labels"], f"{method.lower()} labels")
+
+            case "DELETE", ["issues", n, "labels", name] if (
+                number := _number(repo.pulls, n)
+            ) is not None:
+                pr = repo.pulls[number]
+                pr["labels"] = [label for label in pr["labels"] if label["name"] != unquote(name)]
+                return _Reply(200, pr["labels"], "delete label")
+
+            case "GET", ["actions", "runs"]:
+                runs = [
+                    {**run, "workflow_url": self.server.url + run["workflow_url"]}
+                    for run in repo.runs
+                    if query.get("branch") in (None, run["head_branch"])
+                    and query.get("head_sha") in (None, run["head_sha"])
+                ]
+                per_page = int(query.get("per_page", 30))
+                page = int(query.get("page", 1))
+                chunk = runs[(page - 1) * per_page : page * per_page]
+                return _Reply(200, {"total_count": len(runs), "workflow_runs": chunk}, "list runs")
+
+            case "POST", ["actions", "workflows", _, "dispatches"]:
+                return _Reply(204, None, "dispatch")
+
+        return _Reply(404, {"message": "Not Found"}, "other")
+
+    def _encode(self, reply: _Reply) -> tuple[int, dict[str, str], bytes]:
+        status = reply.status
+        payload = b"" if reply.content is None else json.dumps(reply.content).encode()
+        headers = dict(reply.headers)
+
+        if status == 200 and self.command == "GET":
+            etag = '"' + hashlib.sha1(payload).hexdigest() + '"'
+            headers["ETag"] = etag
+
+            if self.headers.get("If-None-Match") == etag:
+                status, payload = 304, b""
+
+        self.server.requests[f"{self.command} {reply.route}"] += 1
+        if status == 304:
+            self.server.requests["not modified"] += 1
+
+        return status, headers, payload
+
+    def _send(self, status: int, headers: dict[str, str], payload: bytes) -> None:
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def _repo_url(self) -> str:
+        return f"{self.server.url}/repos/{self.server.spec.repo}"
+
+
+@contextlib.contextmanager
+def running_server(spec: SyntheticRepoSpec) -> Iterator[str]:
+    """Serve the synthetic repository from a child process, yielding the API URL"""
+    context = multiprocessing.get_context("fork")
+    receiver, sender = context.Pipe(duplex=False)
+
+    process = context.Process(target=_serve, args=(spec, sender), daemon=True)
+    process.start()
+
+    try:
+        yield receiver.recv()
+    finally:
+        process.terminate()
+        process.join()
+
+
+def request_counts(url: str, reset: bool = False) -> Counter[str]:
+    """Requests received by the server, by method and route, since it was last reset"""
+    with urlopen(f"{url}/_bench/stats" + ("?reset=1" if reset else "")) as response:
+        return Counter(json.load(response))
+
+
+def _serve(spec: SyntheticRepoSpec, sender: Any) -> None:
+    server = SyntheticGitHub(spec, ("127.0.0.1", 0))
+    sender.send(server.url)
+    server.serve_forever()
+
+
+def _number(items: dict[int, Any], segment: str) -> int | None:
+    """The pull request number in a path segment, if it's one the repository has"""
+    return int(segment) if segment.isdigit() and int(segment) in items else None
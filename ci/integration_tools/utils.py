@@ -1,12 +1,23 @@
 from __future__ import annotations
 
 import contextlib
+import os
+from pathlib import Path
+import re
 import shlex
 import subprocess
 import tempfile
 from typing import Generator, Iterable
 
-from .output import AnsiStyle, print_info_line
+from . import cassette, deadlines
+from .output import AnsiStyle, print_capped, print_info_line
+
+
+def cache_dir() -> Path | None:
+    """Directory for state kept across runs, if one is configured"""
+    if path := os.getenv("CI_TOOLS_CACHE_DIR"):
+        return Path(path)
+    return None
 
 
 def validate_branch_ref(branch: str) -> None:
@@ -29,10 +40,53 @@ def temporary_worktree(rev: str, args: Iterable[str] = ()) -> Generator[str, Non
             run(["git", "worktree", "remove", "-f", tempdir])
 
 
-def run(args: list[str], *, env=None, capture_output: bool = True) -> str:
+# Error output from git and sentry-cli indicating a failure which may not happen again
+_TRANSIENT_ERRORS = re.compile(
+    r"Connection (reset|refused|timed out)|Could not resolve host|Operation timed out|"
+    r"early EOF|RPC failed|remote end hung up|(error|status):? 5\d\d|TLS|SSL",
+    re.IGNORECASE,
+)
+
+
+def run(
+    args: list[str],
+    *,
+    env=None,
+    capture_output: bool = True,
+    network: deadlines.Kind | None = None,
+    idempotent: bool = True,
+    input: str | None = None,
+) -> str:
+    """Run a command and return its output
+
+    Commands which talk to a remote should pass the kind of operation as network, which gives
+    them a timeout and, if they're idempotent, retries for transient failures.
+    """
     print_info_line("run", *(shlex.quote(s) for s in args))
-    out = subprocess.run(args, check=True, encoding="utf8", capture_output=capture_output, env=env)
+
+    if network is None:
+        out = cassette.run_process(args, env=env, capture_output=capture_output, input=input)
+    else:
+        out = deadlines.call(
+            network,
+            lambda timeout: cassette.run_process(
+                args, env=env, capture_output=capture_output, timeout=timeout, input=input
+            ),
+            retryable=_is_transient,
+            idempotent=idempotent,
+            description=shlex.join(args[:2]),
+        )
+
     if out.stderr is not None:
-        for line in out.stderr.splitlines():
-            print_info_line("stderr:", line, header_style=AnsiStyle.DimWhite)
+        print_capped(f"{AnsiStyle.DimWhite('stderr:')} {line}" for line in out.stderr.splitlines())
     return out.stdout or ""
+
+
+def _is_transient(exc: Exception) -> bool:
+    match exc:
+        case subprocess.TimeoutExpired():
+            return True
+        case subprocess.CalledProcessError(stderr=str(stderr)):
+            return _TRANSIENT_ERRORS.search(stderr) is not None
+        case _:
+            return False
@@ -64,6 +64,7 @@ run-test "First party: Eligible" \
         "base_ref": "develop",
         "merge_sha": "5444c4152d815ee49bf240ae6aba9b8b0a0ff288",
         "merge_commit": "5444c4152d815ee49bf240ae6aba9b8b0a0ff288",
+        "labels": ["automerge"],
         "merge_pending_label_present": false,
         "pr_is_eligible": true,
         "pr_may_be_eligible": true,
@@ -88,6 +89,7 @@ run-test "No automerge label" \
         "base_ref": "develop",
         "merge_sha": "5444c4152d815ee49bf240ae6aba9b8b0a0ff288",
         "merge_commit": "5444c4152d815ee49bf240ae6aba9b8b0a0ff288",
+        "labels": [],
         "merge_pending_label_present": false,
         "pr_is_eligible": false,
         "pr_may_be_eligible": false,
@@ -112,6 +114,7 @@ run-test "Not mergeable" \
         "base_ref": "develop",
         "merge_sha": "5444c4152d815ee49bf240ae6aba9b8b0a0ff288",
         "merge_commit": "5444c4152d815ee49bf240ae6aba9b8b0a0ff288",
+        "labels": ["automerge"],
         "merge_pending_label_present": false,
         "pr_is_eligible": false,
         "pr_may_be_eligible": false,
@@ -136,6 +139,7 @@ run-test "Null mergeability" \
         "base_ref": "develop",
         "merge_sha": "5444c4152d815ee49bf240ae6aba9b8b0a0ff288",
         "merge_commit": "5444c4152d815ee49bf240ae6aba9b8b0a0ff288",
+        "labels": ["automerge"],
         "merge_pending_label_present": false,
         "pr_is_eligible": false,
         "pr_may_be_eligible": true,
@@ -160,6 +164,7 @@ run-test "Draft" \
         "base_ref": "develop",
         "merge_sha": "5444c4152d815ee49bf240ae6aba9b8b0a0ff288",
         "merge_commit": "5444c4152d815ee49bf240ae6aba9b8b0a0ff288",
+        "labels": ["automerge"],
         "merge_pending_label_present": false,
         "pr_is_eligible": false,
         "pr_may_be_eligible": false,
@@ -182,6 +187,7 @@ run-test "Third-party: Approved by owner" \
         "base_ref": "develop",
         "merge_sha": "2fd095284174e8574b56a4735a204f030eadf8e6",
         "merge_commit": "2fd095284174e8574b56a4735a204f030eadf8e6",
+        "labels": ["automerge", "dependencies", "javascript"],
         "merge_pending_label_present": false,
         "pr_is_eligible": true,
         "pr_may_be_eligible": true,
@@ -204,6 +210,7 @@ run-test "Third-party: Unapproved" \
         "base_ref": "develop",
         "merge_sha": "2fd095284174e8574b56a4735a204f030eadf8e6",
         "merge_commit": "2fd095284174e8574b56a4735a204f030eadf8e6",
+        "labels": ["automerge", "dependencies", "javascript"],
         "merge_pending_label_present": false,
         "pr_is_eligible": false,
         "pr_may_be_eligible": false,
@@ -228,6 +235,7 @@ run-test "Third-party: Approved by other" \
         "base_ref": "develop",
         "merge_sha": "2fd095284174e8574b56a4735a204f030eadf8e6",
         "merge_commit": "2fd095284174e8574b56a4735a204f030eadf8e6",
+        "labels": ["automerge", "dependencies", "javascript"],
         "merge_pending_label_present": false,
         "pr_is_eligible": false,
         "pr_may_be_eligible": false,
@@ -0,0 +1,121 @@
+"""
+HTTP server which injects latency, error statuses and connection resets
+
+Each request takes the next fault from the server's script, or succeeds once the script runs out,
+and is recorded along with the fault it was given. Any client speaking HTTP can be pointed at it:
+get_github_api through GITHUB_API_URL, or git through an http:// remote URL.
+"""
+
+from __future__ import annotations
+
+from collections import deque
+import contextlib
+from dataclasses import dataclass
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import socket
+import struct
+import threading
+import time
+from typing import Any, Iterable, Iterator
+
+
+@dataclass(frozen=True, kw_only=True)
+class Fault:
+    status: int = 200
+    delay: float = 0.0
+    """Seconds to wait before responding"""
+    reset: bool = False
+    """Reset the connection instead of responding"""
+    drop: bool = False
+    """Close the connection after responding, without announcing it as the last response"""
+
+
+OK = Fault()
+RESET = Fault(reset=True)
+DROP = Fault(drop=True)
+
+
+def status(code: int) -> Fault:
+    return Fault(status=code)
+
+
+def delay(seconds: float) -> Fault:
+    return Fault(delay=seconds)
+
+
+class FaultServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self) -> None:
+        super().__init__(("127.0.0.1", 0), _Handler)
+        self.lock = threading.Lock()
+        self.script: deque[Fault] = deque()
+        self.requests: list[tuple[str, str]] = []
+
+    @property
+    def url(self) -> str:
+        host, port = self.server_address[:2]
+        return f"http://{host!s}:{port}"
+
+    def inject(self, faults: Iterable[Fault]) -> None:
+        with self.lock:
+            self.script.extend(faults)
+
+    def methods(self) -> list[str]:
+        with self.lock:
+            return [method for method, _ in self.requests]
+
+    def handle_error(self, request: Any, client_address: Any) -> None:
+        # Writing to a connection the client abandoned after a timeout is expected to fail
+        pass
+
+    def next_fault(self, method: str, path: str) -> Fault:
+        with self.lock:
+            self.requests.append((method, path))
+            return self.script.popleft() if self.script else OK
+
+
+class _Handler(BaseHTTPRequestHandler):
+    server: FaultServer
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format: str, *args: Any) -> None:
+        pass
+
+    def do_GET(self) -> None:
+        self.rfile.read(int(self.headers.get("Content-Length") or 0))
+
+        fault = self.server.next_fault(self.command, self.path)
+        time.sleep(fault.delay)
+
+        if fault.reset:
+            # Closing with a zero linger time sends a RST rather than a FIN
+            self.connection.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack("ii", 1, 0))
+            self.connection.close()
+            self.close_connection = True
+            return
+
+        body = b"{}"
+        self.send_response(fault.status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+        if fault.drop:
+            self.close_connection = True
+
+    do_POST = do_PUT = do_DELETE = do_GET
+
+
+@contextlib.contextmanager
+def running() -> Iterator[FaultServer]:
+    server = FaultServer()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+
+    try:
+        yield server
+    finally:
+        server.shutdown()
+        server.server_close()
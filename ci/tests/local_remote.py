@@ -0,0 +1,180 @@
+"""
+A local bare remote to deploy to, with a repository for authoring source commits and a clone to
+run deploy-commit from
+
+The remote starts with an orphan master holding a first deploy, and a develop branch once a source
+commit is pushed. Sites are built into plain directories, stamped with their release version the
+way the real build stamps .test-meta.json.
+"""
+
+from __future__ import annotations
+
+import json
+import os
+from pathlib import Path
+import subprocess
+import sys
+from typing import Any
+
+GIT_IDENTITY = {
+    "GIT_AUTHOR_NAME": "Test",
+    "GIT_AUTHOR_EMAIL": "test@example.com",
+    "GIT_COMMITTER_NAME": "Test",
+    "GIT_COMMITTER_EMAIL": "test@example.com",
+}
+
+
+def git(*args: str, cwd: Path, env: dict[str, str] | None = None, input: str | None = None) -> str:
+    return subprocess.run(
+        ["git", *args],
+        cwd=cwd,
+        env={**os.environ, **GIT_IDENTITY, **(env or {})},
+        input=input,
+        check=True,
+        capture_output=True,
+        text=True,
+    ).stdout.strip()
+
+
+class LocalRemote:
+    def __init__(self, root: Path) -> None:
+        self.root = root
+        self.remote = root / "remote.git"
+        self.source = root / "source"
+        self.clone = root / "clone"
+        self.bin_dir = root / "bin"
+
+        self.bin_dir.mkdir()
+        git("init", "-q", "--bare", "-b", "develop", str(self.remote), cwd=root)
+
+        # The first deploy, built before release versions were recorded
+        git("init", "-q", "-b", "master", str(self.source), cwd=root)
+        (self.source / "index.html").write_text("first\n")
+        git("add", "index.html", cwd=self.source)
+        git("commit", "-q", "-m", "Deploy 1", cwd=self.source)
+        git("push", "-q", str(self.remote), "master", cwd=self.source)
+
+        git("checkout", "-q", "--orphan", "develop", cwd=self.source)
+        git("rm", "-qrf", ".", cwd=self.source)
+
+        self.install_command("sentry-cli", "#!/bin/sh\n")
+
+    def env(self) -> dict[str, str]:
+        """Environment for running the tools against this remote"""
+        return {
+            "PATH": f"{self.bin_dir}{os.pathsep}{os.environ['PATH']}",
+            "CI_TOOLS_CACHE_DIR": str(self.root / "cache"),
+            **GIT_IDENTITY,
+        }
+
+    def install_command(self, name: str, script: str) -> None:
+        """Put a stub command on the tools' PATH"""
+        command = self.bin_dir / name
+        command.write_text(script)
+        command.chmod(0o755)
+
+    def commit_source(
+        self,
+        files: dict[str, str],
+        *,
+        branch: str = "develop",
+        base: str | None = None,
+        push: bool = True,
+    ) -> str:
+        """Commit files to a branch of the source repository, returning the commit
+
+        Given a base, the branch is (re)started from it first.
+        """
+        if base is not None:
+            git("checkout", "-q", "-B", branch, base, cwd=self.source)
+        elif git("symbolic-ref", "--short", "HEAD", cwd=self.source) != branch:
+            git("checkout", "-q", branch, cwd=self.source)
+
+        for path, content in files.items():
+            (self.source / path).parent.mkdir(parents=True, exist_ok=True)
+            (self.source / path).write_text(content)
+
+        git("add", "-A", cwd=self.source)
+        git("commit", "-q", "--allow-empty", "-m", f"Change {', '.join(files)}", cwd=self.source)
+
+        if push:
+            git("push", "-q", "--force", str(self.remote), branch, cwd=self.source)
+
+        return git("rev-parse", "HEAD", cwd=self.source)
+
+    def update_clone(self) -> None:
+        """Clone the remote, or bring the clone's develop up to date with it, as CI checks out"""
+        if not self.clone.exists():
+            git(
+                "clone",
+                "-q",
+                "--branch",
+                "develop",
+                str(self.remote),
+                str(self.clone),
+                cwd=self.root,
+            )
+        else:
+            git("fetch", "-q", "origin", cwd=self.clone)
+            git("checkout", "-q", "-B", "develop", "origin/develop", cwd=self.clone)
+
+    def push_revisions(self, sha: str) -> tuple[Path, str]:
+        """Write the revision info of a push build, returning it and its release version"""
+        tree = git("rev-parse", f"{sha}^{{tree}}", cwd=self.source)
+
+        path = self.root / f"revisions-{sha}.json"
+        path.write_text(json.dumps({"ref": "develop", "sha": sha, "tree": tree}))
+
+        return path, f"{sha}+tree:{tree}"
+
+    def build_site(self, name: str, release_version: str, files: dict[str, str]) -> Path:
+        """Write a built site, with {release} in file contents replaced by the release version"""
+        site = self.root / f"site-{name}"
+
+        for path, content in files.items():
+            (site / path).parent.mkdir(parents=True, exist_ok=True)
+            (site / path).write_text(content.replace("{release}", release_version))
+
+        (site / ".test-meta.json").write_text(json.dumps({"release_version": release_version}))
+
+        return site
+
+    def deploy_command(self, *args: str) -> list[str]:
+        return [sys.executable, "-m", "integration_tools", *args]
+
+    def run_deploy(self, *args: str, **kwargs: Any) -> subprocess.CompletedProcess[str]:
+        """Run deploy-commit in the clone, returning its combined output"""
+        return subprocess.run(
+            self.deploy_command("deploy-commit", "--repo", "owner/repo", *args),
+            cwd=self.clone,
+            env={**os.environ, **self.env()},
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            text=True,
+            **kwargs,
+        )
+
+    def push_deploy(self, sha: str, site_files: dict[str, str], name: str = "") -> str:
+        """Build a site for a source commit on develop and deploy it, returning the run's output
+
+        The run is expected to succeed.
+        """
+        revisions, release_version = self.push_revisions(sha)
+        site = self.build_site(name or sha, release_version, site_files)
+
+        result = self.run_deploy(
+            "--effective-event=push",
+            "--base-ref=develop",
+            "--head-ref=develop",
+            f"--run-url=https://example.com/run/{name or sha}",
+            f"--deploy-dir={site}",
+            f"--deploy-revision-info={revisions}",
+        )
+
+        if result.returncode != 0:
+            raise AssertionError(f"deploy-commit failed:\n{result.stdout[-4000:]}")
+
+        return result.stdout
+
+    def remote_git(self, *args: str) -> str:
+        return git(*args, cwd=self.remote)
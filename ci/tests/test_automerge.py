@@ -0,0 +1,76 @@
+"""Merge-pending label changes, sent to a synthetic GitHub API"""
+
+from __future__ import annotations
+
+import json
+import os
+import unittest
+from unittest import mock
+from urllib.request import urlopen
+
+from integration_tools import automerge
+from integration_tools.gh_state import evaluate_pull_request_state
+from integration_tools.gh_writes import WriteQueue
+from integration_tools.synthetic_github import SyntheticRepoSpec, request_counts, running_server
+
+REPO = "owner/repo"
+
+
+class MergePendingLabelTest(unittest.TestCase):
+    api_url: str
+
+    @classmethod
+    def setUpClass(cls) -> None:
+        # Every pull request carries merge-pending but none can become eligible
+        cls.api_url = cls.enterClassContext(
+            running_server(SyntheticRepoSpec(repo=REPO, prs=3, automerge=0, merge_pending=1.0))
+        )
+        cls.enterClassContext(
+            mock.patch.dict(os.environ, {"GITHUB_API_URL": cls.api_url, "GH_TOKEN": "test"})
+        )
+
+    def labels(self, pr_number: int) -> list[str]:
+        with urlopen(f"{self.api_url}/repos/{REPO}/pulls/{pr_number}") as response:
+            return [label["name"] for label in json.load(response)["labels"]]
+
+    def flush(self, writes: WriteQueue) -> dict[str, int]:
+        """Flush the queue, returning the write requests it sent"""
+        request_counts(self.api_url, reset=True)
+        writes.flush()
+        return dict(request_counts(self.api_url))
+
+    def test_ineligible_candidate_loses_label(self) -> None:
+        writes = WriteQueue()
+        review = automerge.review_candidate(REPO, 1, writes)
+
+        self.assertEqual(review.outcome, "ineligible")
+        self.assertEqual(self.flush(writes), {"DELETE delete label": 1})
+        self.assertNotIn(automerge.MERGE_PENDING_LABEL, self.labels(1))
+
+    def test_label_already_present(self) -> None:
+        writes = WriteQueue()
+        pr_eval = evaluate_pull_request_state(2, repo=REPO)
+
+        # The labels as evaluated already have it, so there's nothing to send
+        automerge.set_merge_pending_label(writes, REPO, 2, True, current_labels=pr_eval.labels)
+
+        self.assertEqual(self.flush(writes), {})
+        self.assertIn(automerge.MERGE_PENDING_LABEL, self.labels(2))
+
+    def test_changes_sent_as_label_set(self) -> None:
+        writes = WriteQueue()
+        pr_eval = automerge.review_candidate(REPO, 3, writes).pr_eval
+        writes.add_label(REPO, 3, "stale")
+
+        self.assertEqual(self.flush(writes), {"PUT put labels": 1})
+        self.assertEqual(
+            sorted(self.labels(3)),
+            sorted(
+                [label for label in pr_eval.labels if label != automerge.MERGE_PENDING_LABEL]
+                + ["stale"]
+            ),
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,144 @@
+"""Recording a run against a synthetic GitHub API and replaying it without one"""
+
+from __future__ import annotations
+
+from concurrent.futures import ThreadPoolExecutor
+import json
+import os
+from pathlib import Path
+import tempfile
+import time
+from typing import Any
+import unittest
+from unittest import mock
+
+from integration_tools import cassette
+from integration_tools.cassette import Cassette, CassetteMismatchError
+from integration_tools.gh_state import evaluate_pull_request_state
+from integration_tools.gh_writes import WriteQueue
+from integration_tools.synthetic_github import SyntheticRepoSpec, running_server
+from integration_tools.utils import run
+
+REPO = "owner/repo"
+PRS = 4
+
+# How long the commands run in order and the slowest of those run concurrently take
+SERIAL_SECONDS = 0.2
+CONCURRENT_SECONDS = 0.3
+
+
+def slow_echo(i: int) -> str:
+    """Echo a number after a delay which is shorter for higher numbers"""
+    delay = CONCURRENT_SECONDS * (PRS - i) / PRS
+    return run(["sh", "-c", f"sleep {delay}; echo {i}"])
+
+
+def scenario() -> dict[str, Any]:
+    """Make requests and run commands both in order and from several threads at once"""
+    out: dict[str, Any] = {"serial": run(["sh", "-c", f"sleep {SERIAL_SECONDS}; echo serial"])}
+
+    out["labels"] = evaluate_pull_request_state(1, repo=REPO).labels
+
+    writes = WriteQueue()
+    for pr_number in range(1, PRS + 1):
+        writes.add_label(REPO, pr_number, "stale")
+    out["writes"] = sorted((r.pr_number, r.error is None) for r in writes.flush())
+
+    with cassette.concurrent(), ThreadPoolExecutor(max_workers=PRS) as executor:
+        out["concurrent"] = list(executor.map(slow_echo, range(PRS)))
+
+    return out
+
+
+class RoundTripTest(unittest.TestCase):
+    recorded: dict[str, Any]
+    cassette_path: Path
+
+    @classmethod
+    def setUpClass(cls) -> None:
+        tmp = Path(cls.enterClassContext(tempfile.TemporaryDirectory()))
+        cls.cassette_path = tmp / "run.cassette"
+
+        with running_server(SyntheticRepoSpec(repo=REPO, prs=PRS)) as api_url:
+            cls.enterClassContext(
+                mock.patch.dict(os.environ, {"GITHUB_API_URL": api_url, "GH_TOKEN": "test"})
+            )
+            cls.recorded = cls.play(Cassette.record(cls.cassette_path))
+
+        # Replays go to the same URLs, but there's no longer a server there
+
+    @staticmethod
+    def play(active: Cassette) -> dict[str, Any]:
+        cassette.install(active)
+        try:
+            out = scenario()
+        finally:
+            cassette.install(None)
+
+        active.close()
+        return out
+
+    def entries(self) -> list[dict[str, Any]]:
+        return [json.loads(line) for line in self.cassette_path.read_text().splitlines()]
+
+    def test_recorded(self) -> None:
+        entries = self.entries()
+
+        self.assertEqual(self.recorded["serial"], "serial\n")
+        self.assertEqual(self.recorded["writes"], [(n, True) for n in range(1, PRS + 1)])
+        self.assertEqual(self.recorded["concurrent"], [f"{i}\n" for i in range(PRS)])
+
+        self.assertEqual({entry["kind"] for entry in entries}, {"header", "run", "http"})
+
+        # Both concurrent sections are tagged, with the commands recorded as they finished
+        sections = [entry["section"] for entry in entries if "section" in entry]
+        self.assertEqual(sections, [1] * PRS + [2] * PRS)
+
+        finished = [e["stdout"] for e in entries if e.get("section") == 2]
+        self.assertEqual(finished, [f"{i}\n" for i in reversed(range(PRS))])
+
+    def test_replay(self) -> None:
+        start = time.monotonic()
+        replayed = self.play(Cassette.replay(self.cassette_path, time_scale=0))
+
+        self.assertEqual(replayed, self.recorded)
+        self.assertLess(time.monotonic() - start, SERIAL_SECONDS)
+
+    def test_replay_recorded_timings(self) -> None:
+        start = time.monotonic()
+        replayed = self.play(Cassette.replay(self.cassette_path, time_scale=1))
+        elapsed = time.monotonic() - start
+
+        self.assertEqual(replayed, self.recorded)
+
+        # The concurrent commands' recorded durations overlap again
+        self.assertGreaterEqual(elapsed, SERIAL_SECONDS + CONCURRENT_SECONDS)
+        self.assertLess(elapsed, SERIAL_SECONDS + PRS * CONCURRENT_SECONDS)
+
+    def test_unused_section_entry(self) -> None:
+        replay = Cassette.replay(self.cassette_path, time_scale=0)
+        cassette.install(replay)
+        self.addCleanup(cassette.install, None)
+
+        run(["sh", "-c", f"sleep {SERIAL_SECONDS}; echo serial"])
+        evaluate_pull_request_state(1, repo=REPO)
+
+        # The section's entries can be used in any order, but all of them have to be
+        with self.assertRaisesRegex(CassetteMismatchError, "1 unused entries"):
+            with cassette.concurrent():
+                for pr_number in reversed(range(2, PRS + 1)):
+                    writes = WriteQueue()
+                    writes.add_label(REPO, pr_number, "stale")
+                    writes.flush()
+
+    def test_divergence(self) -> None:
+        replay = Cassette.replay(self.cassette_path, time_scale=0)
+        cassette.install(replay)
+        self.addCleanup(cassette.install, None)
+
+        with self.assertRaisesRegex(CassetteMismatchError, "entry 1 of"):
+            run(["sh", "-c", "echo other"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,204 @@
+"""Timeouts, retries and the run deadline, against a server which injects faults"""
+
+from __future__ import annotations
+
+import http.client
+import os
+import subprocess
+import tempfile
+import time
+import unittest
+from unittest import mock
+from urllib.error import HTTPError
+
+from fault_server import DROP, OK, RESET, delay, running, status
+from integration_tools import deadlines
+from integration_tools.gh_state import get_github_api
+from integration_tools.gh_transport import POOL
+from integration_tools.utils import run
+
+# Short timeouts and negligible backoff, so that the tests don't wait on the real policies
+FAST = deadlines.Policy(initial=0.5, floor=0.2, ceiling=2.0, attempts=3, backoff=0.01)
+
+
+class DeadlineTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self.server = self.enterContext(running())
+
+        self.enterContext(
+            mock.patch.dict(os.environ, {"GITHUB_API_URL": self.server.url, "GH_TOKEN": "test"})
+        )
+        self.enterContext(
+            mock.patch.dict(deadlines.POLICIES, dict.fromkeys(deadlines.POLICIES, FAST))
+        )
+        self.enterContext(
+            mock.patch.dict(
+                deadlines._trackers,
+                {kind: deadlines.LatencyTracker(FAST) for kind in deadlines.POLICIES},
+            )
+        )
+
+        # Every test starts on a fresh connection, which the pool doesn't retry on its own
+        POOL.close()
+        self.addCleanup(POOL.close)
+
+    def request(self, method: str = "GET") -> int:
+        data = b"{}" if method != "GET" else None
+        with get_github_api("/repos/owner/repo/pulls/1", method=method, data=data) as response:
+            response.read()
+            return response.status
+
+    def test_get_retried_after_server_error(self) -> None:
+        self.server.inject([status(503), status(502)])
+
+        self.assertEqual(self.request(), 200)
+        self.assertEqual(self.server.methods(), ["GET"] * 3)
+
+    def test_get_retried_after_reset(self) -> None:
+        self.server.inject([RESET])
+
+        self.assertEqual(self.request(), 200)
+        self.assertEqual(self.server.methods(), ["GET"] * 2)
+
+    def test_get_retried_after_timeout(self) -> None:
+        self.server.inject([delay(FAST.initial * 3)])
+
+        self.assertEqual(self.request(), 200)
+        self.assertEqual(self.server.methods(), ["GET"] * 2)
+
+    def test_get_gives_up_after_attempts(self) -> None:
+        self.server.inject([status(503)] * FAST.attempts + [OK])
+
+        with self.assertRaises(HTTPError) as caught:
+            self.request()
+
+        self.assertEqual(caught.exception.code, 503)
+        self.assertEqual(len(self.server.methods()), FAST.attempts)
+
+    def test_client_error_not_retried(self) -> None:
+        self.server.inject([status(404)])
+
+        with self.assertRaises(HTTPError):
+            self.request()
+
+        self.assertEqual(self.server.methods(), ["GET"])
+
+    def test_post_not_retried_after_server_error(self) -> None:
+        self.server.inject([status(503)])
+
+        with self.assertRaises(HTTPError):
+            self.request("POST")
+
+        self.assertEqual(self.server.methods(), ["POST"])
+
+    def test_post_not_retried_after_reset(self) -> None:
+        self.server.inject([RESET])
+
+        with self.assertRaises((OSError, http.client.HTTPException)):
+            self.request("POST")
+
+        self.assertEqual(self.server.methods(), ["POST"])
+
+    def test_post_not_resent_after_reset_on_reused_connection(self) -> None:
+        self.assertEqual(self.request(), 200)
+        self.server.inject([RESET])
+
+        # The server may have acted on the request before the connection went
+        with self.assertRaises((OSError, http.client.HTTPException)):
+            self.request("POST")
+
+        self.assertEqual(self.server.methods(), ["GET", "POST"])
+
+    def test_put_resent_after_reset_on_reused_connection(self) -> None:
+        self.assertEqual(self.request(), 200)
+        self.server.inject([RESET])
+
+        self.assertEqual(self.request("PUT"), 200)
+        self.assertEqual(self.server.methods(), ["GET", "PUT", "PUT"])
+
+    def test_dropped_connection_not_reused(self) -> None:
+        self.server.inject([DROP])
+        self.assertEqual(self.request(), 200)
+
+        # Once the server's close arrives, the pool opens a new connection for the next request
+        time.sleep(0.1)
+
+        self.assertEqual(self.request("POST"), 200)
+        self.assertEqual(self.server.methods(), ["GET", "POST"])
+
+    def test_deadline_caps_timeout(self) -> None:
+        self.server.inject([delay(5)] * FAST.attempts)
+
+        start = time.monotonic()
+        with deadlines.budget(0.3), self.assertRaises(TimeoutError):
+            self.request()
+
+        # One attempt, cut short by the deadline, and no retry since the budget is spent
+        self.assertLess(time.monotonic() - start, 1.5)
+        self.assertEqual(self.server.methods(), ["GET"])
+
+    def test_nothing_started_after_deadline(self) -> None:
+        with deadlines.budget(0.01):
+            time.sleep(0.05)
+
+            with self.assertRaises(deadlines.DeadlineExceededError):
+                self.request()
+
+        self.assertEqual(self.server.methods(), [])
+
+    def test_git_fetch_retried_after_reset(self) -> None:
+        self.server.inject([RESET] * FAST.attempts)
+
+        with self.assertRaises(subprocess.CalledProcessError):
+            run(["git", "ls-remote", f"{self.server.url}/repo.git"], network="git-fetch")
+
+        self.assertEqual(len(self.server.methods()), FAST.attempts)
+
+    def test_git_push_not_retried(self) -> None:
+        self.server.inject([RESET] * FAST.attempts)
+
+        with tempfile.TemporaryDirectory() as repo:
+            subprocess.run(["git", "init", "-q", repo], check=True)
+            subprocess.run(
+                ["git", "-C", repo, "-c", "user.name=Test", "-c", "user.email=test@example.com"]
+                + ["commit", "-q", "--allow-empty", "-m", "Test"],
+                check=True,
+            )
+
+            with self.assertRaises(subprocess.CalledProcessError):
+                run(
+                    ["git", "-C", repo, "push", f"{self.server.url}/repo.git", "HEAD:main"],
+                    network="git-push",
+                    idempotent=False,
+                )
+
+        self.assertEqual(len(self.server.methods()), 1)
+
+
+class LatencyTrackerTest(unittest.TestCase):
+    def test_initial_timeout_until_enough_samples(self) -> None:
+        tracker = deadlines.LatencyTracker(FAST)
+
+        for _ in range(deadlines.MIN_SAMPLES - 1):
+            tracker.observe(0.01)
+
+        self.assertEqual(tracker.timeout(), FAST.initial)
+
+    def test_timeout_follows_latency_within_bounds(self) -> None:
+        tracker = deadlines.LatencyTracker(FAST)
+
+        for _ in range(deadlines.MIN_SAMPLES):
+            tracker.observe(0.01)
+        self.assertEqual(tracker.timeout(), FAST.floor)
+
+        for _ in range(deadlines.SAMPLE_WINDOW):
+            tracker.observe(0.1)
+        self.assertAlmostEqual(tracker.timeout(), 0.1 * deadlines.LATENCY_MULTIPLIER)
+
+        for _ in range(deadlines.SAMPLE_WINDOW):
+            tracker.observe(10)
+        self.assertEqual(tracker.timeout(), FAST.ceiling)
+
+
+if __name__ == "__main__":
+    unittest.main()
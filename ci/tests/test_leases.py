@@ -0,0 +1,268 @@
+"""Concurrent deploy runs sharing one clone and one local bare remote"""
+
+from __future__ import annotations
+
+import contextlib
+import json
+import os
+from pathlib import Path
+import re
+import signal
+import subprocess
+import sys
+import tempfile
+import textwrap
+import unittest
+from unittest import mock
+
+from integration_tools import deadlines, leases
+
+RUNS = 6
+
+# Holds every run at the start of its Sentry release until all of them get there, which is after
+# each has checked for a prior deploy and committed its tree on the same master. So every run
+# deploys, and all but the first to take the push lease find master has moved.
+STUB_SENTRY_CLI = textwrap.dedent("""\
+    #!/bin/bash
+    set -eu
+    if [ "$1 $2" = "releases new" ]; then
+        touch "$SENTRY_STUB_BARRIER/$$"
+        for _ in $(seq 600); do
+            [ "$(ls "$SENTRY_STUB_BARRIER" | wc -l)" -ge "$SENTRY_STUB_RUNS" ] && exit 0
+            sleep 0.1
+        done
+        exit 1
+    fi
+    """)
+
+# Takes a lease or namespace in the current directory's clone, says so and waits to be killed
+LEASE_HOLDER = textwrap.dedent("""\
+    import sys, time
+    from integration_tools import leases, utils
+
+    if sys.argv[1] == "push":
+        with leases.push_lease("origin"):
+            print("held", flush=True)
+            time.sleep(60)
+    else:
+        with leases.run_namespace() as namespace:
+            utils.run(["git", "update-ref", f"{namespace}/heads/master", "origin/master"])
+            print(namespace, flush=True)
+            time.sleep(60)
+    """)
+
+# The info line naming the namespace a run allocated
+NAMESPACE_LINE = re.compile(rf"namespace\S*\s+({leases.RUN_REF_ROOT}/\S+)$", re.MULTILINE)
+
+
+def git(*args: str, cwd: Path) -> str:
+    return subprocess.run(
+        ["git", *args], cwd=cwd, check=True, capture_output=True, text=True
+    ).stdout.strip()
+
+
+class SharedCloneTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self.tmp = Path(self.enterContext(tempfile.TemporaryDirectory()))
+        self.remote = self.tmp / "remote.git"
+        self.clone = self.tmp / "clone"
+
+        bin_dir = self.tmp / "bin"
+        bin_dir.mkdir()
+        stub = bin_dir / "sentry-cli"
+        stub.write_text(STUB_SENTRY_CLI)
+        stub.chmod(0o755)
+
+        barrier = self.tmp / "barrier"
+        barrier.mkdir()
+
+        self.enterContext(
+            mock.patch.dict(
+                os.environ,
+                {
+                    "PATH": f"{bin_dir}{os.pathsep}{os.environ['PATH']}",
+                    "CI_TOOLS_CACHE_DIR": str(self.tmp / "cache"),
+                    "SENTRY_STUB_BARRIER": str(barrier),
+                    "SENTRY_STUB_RUNS": str(RUNS),
+                    "GIT_AUTHOR_NAME": "Test",
+                    "GIT_AUTHOR_EMAIL": "test@example.com",
+                    "GIT_COMMITTER_NAME": "Test",
+                    "GIT_COMMITTER_EMAIL": "test@example.com",
+                },
+            )
+        )
+
+        # A remote with a source branch and a deploy branch on its first deploy
+        git("init", "-q", "--bare", "-b", "develop", str(self.remote), cwd=self.tmp)
+
+        source = self.tmp / "source"
+        git("init", "-q", "-b", "develop", str(source), cwd=self.tmp)
+        (source / "README").write_text("source\n")
+        git("add", "README", cwd=source)
+        git("commit", "-q", "-m", "Source", cwd=source)
+        git("push", "-q", str(self.remote), "develop", cwd=source)
+
+        git("checkout", "-q", "--orphan", "master", cwd=source)
+        git("rm", "-qf", "README", cwd=source)
+        (source / "index.html").write_text("first\n")
+        git("add", "index.html", cwd=source)
+        git("commit", "-q", "-m", "Deploy 1", cwd=source)
+        git("push", "-q", str(self.remote), "master", cwd=source)
+
+        git("clone", "-q", "--branch", "develop", str(self.remote), str(self.clone), cwd=self.tmp)
+        self.source_sha = git("rev-parse", "develop", cwd=self.clone)
+
+    def start_deploy(self, i: int, *options: str) -> subprocess.Popen[str]:
+        """Start a push deploy of the source branch with a site of its own
+
+        Options are passed to the tools ahead of the command.
+        """
+        tree = git("rev-parse", f"{self.source_sha}^{{tree}}", cwd=self.clone)
+
+        revisions = self.tmp / "revisions.json"
+        revisions.write_text(json.dumps({"ref": "develop", "sha": self.source_sha, "tree": tree}))
+
+        site = self.tmp / f"site-{i}"
+        site.mkdir(exist_ok=True)
+        (site / "index.html").write_text(f"run {i}\n")
+        (site / ".test-meta.json").write_text(
+            json.dumps({"release_version": f"{self.source_sha}+tree:{tree}"})
+        )
+
+        return subprocess.Popen(
+            [sys.executable, "-m", "integration_tools", *options, "deploy-commit"]
+            + ["--repo", "owner/repo", "--effective-event", "push"]
+            + ["--base-ref", "develop", "--head-ref", "develop"]
+            + ["--run-url", f"https://example.com/run/{i}"]
+            + ["--deploy-dir", str(site), "--deploy-revision-info", str(revisions)],
+            cwd=self.clone,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            text=True,
+        )
+
+    def start_holder(self, kind: str) -> tuple[subprocess.Popen[str], str]:
+        holder = subprocess.Popen(
+            [sys.executable, "-c", LEASE_HOLDER, kind],
+            cwd=self.clone,
+            stdout=subprocess.PIPE,
+            text=True,
+        )
+        assert holder.stdout is not None
+
+        self.addCleanup(holder.stdout.close)
+        self.addCleanup(holder.wait)
+        self.addCleanup(holder.kill)
+
+        return holder, holder.stdout.readline().strip()
+
+    def test_parallel_deploys(self) -> None:
+        runs = [self.start_deploy(i) for i in range(RUNS)]
+        outputs = [run.communicate(timeout=300)[0] for run in runs]
+
+        for run, output in zip(runs, outputs):
+            self.assertEqual(run.returncode, 0, output[-4000:])
+
+        # Every run pushed a deploy, numbered in the order they landed
+        log = git("log", "--format=%H %s", "master", cwd=self.remote).splitlines()
+        deploys = [line.split(maxsplit=1) for line in reversed(log)]
+
+        self.assertEqual(
+            [subject for _, subject in deploys],
+            ["Deploy 1"] + [f"Deploy to GitHub Pages [{n}]" for n in range(2, RUNS + 2)],
+        )
+        self.assertEqual(
+            sorted(git("show", f"{sha}:index.html", cwd=self.remote) for sha, _ in deploys[1:]),
+            [f"run {i}" for i in range(RUNS)],
+        )
+
+        for n, (sha, _) in enumerate(deploys[1:], start=2):
+            tag = f"deploy/master/{n}-{self.source_sha}"
+            self.assertEqual(git("rev-parse", f"{tag}^{{commit}}", cwd=self.remote), sha)
+
+        # All but the first to push had prepared their commit on a master which had since moved
+        self.assertEqual(sum("master moved" in output for output in outputs), RUNS - 1)
+
+        self.assertEqual(git("for-each-ref", leases.RUN_REF_ROOT, cwd=self.clone), "")
+
+    def test_push_lease_released_when_holder_killed(self) -> None:
+        holder, line = self.start_holder("push")
+        self.assertEqual(line, "held")
+
+        self.enterContext(contextlib.chdir(self.clone))
+
+        with deadlines.budget(0.3), self.assertRaises(leases.LeaseTimeoutError):
+            with leases.push_lease("origin"):
+                pass
+
+        holder.send_signal(signal.SIGKILL)
+        holder.wait()
+
+        with deadlines.budget(5), leases.push_lease("origin"):
+            pass
+
+    def test_abandoned_namespace_removed(self) -> None:
+        holder, namespace = self.start_holder("namespace")
+        self.assertTrue(namespace.startswith(f"{leases.RUN_REF_ROOT}/"), namespace)
+
+        self.enterContext(contextlib.chdir(self.clone))
+
+        # Still in use, so left alone
+        with leases.run_namespace():
+            self.assertNotEqual(git("for-each-ref", namespace, cwd=self.clone), "")
+
+        holder.send_signal(signal.SIGKILL)
+        holder.wait()
+
+        with leases.run_namespace():
+            self.assertEqual(git("for-each-ref", namespace, cwd=self.clone), "")
+
+        self.assertEqual(git("for-each-ref", leases.RUN_REF_ROOT, cwd=self.clone), "")
+
+    def test_replay(self) -> None:
+        self.enterContext(mock.patch.dict(os.environ, {"SENTRY_STUB_RUNS": "1"}))
+        runs_dir = self.clone / ".git" / "ci-tools-leases" / "runs"
+
+        # Recorded with an abandoned namespace to remove
+        holder, recorded_abandoned = self.start_holder("namespace")
+        holder.send_signal(signal.SIGKILL)
+        holder.wait()
+
+        cassette_path = self.tmp / "deploy.cassette"
+        recording = self.start_deploy(0, "--record-cassette", str(cassette_path))
+        output = recording.communicate(timeout=300)[0]
+        self.assertEqual(recording.returncode, 0, output[-4000:])
+        self.assertIn(f"removing abandoned run {recorded_abandoned.rsplit('/')[-1]}", output)
+        namespaces = NAMESPACE_LINE.findall(output)
+        self.assertEqual(len(namespaces), 1, output[-4000:])
+
+        deployed = git("rev-parse", "master", cwd=self.remote)
+
+        # Replays aren't thrown by, and leave alone, namespaces abandoned since the recording
+        holder, abandoned = self.start_holder("namespace")
+        holder.send_signal(signal.SIGKILL)
+        holder.wait()
+
+        lock_files = sorted(runs_dir.iterdir())
+        namespace_refs = git("for-each-ref", leases.RUN_REF_ROOT, cwd=self.clone)
+        self.assertIn(abandoned, namespace_refs)
+
+        for _ in range(2):
+            replay = self.start_deploy(
+                0, "--replay-cassette", str(cassette_path), "--replay-time-scale", "0"
+            )
+            output = replay.communicate(timeout=300)[0]
+            self.assertEqual(replay.returncode, 0, output[-4000:])
+
+            # The recorded run's namespace and collection of abandoned ones are replayed
+            self.assertEqual(NAMESPACE_LINE.findall(output), namespaces)
+            self.assertIn(f"removing abandoned run {recorded_abandoned.rsplit('/')[-1]}", output)
+            self.assertEqual(git("rev-parse", "master", cwd=self.remote), deployed)
+            self.assertEqual(sorted(runs_dir.iterdir()), lock_files)
+            self.assertEqual(
+                git("for-each-ref", leases.RUN_REF_ROOT, cwd=self.clone), namespace_refs
+            )
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,231 @@
+"""Post recorded webhook payloads to the listener on localhost"""
+
+from __future__ import annotations
+
+import hashlib
+import hmac
+from http.client import HTTPConnection
+import json
+import os
+from pathlib import Path
+import time
+from typing import Any
+import unittest
+from unittest import mock
+import uuid
+
+from integration_tools.commands import listen
+from integration_tools.synthetic_github import (
+    SyntheticRepoSpec,
+    request_counts,
+    running_server,
+)
+
+FIXTURES = Path(__file__).parent.parent / "pull-request" / "test"
+
+REPO = "wabain/wabain.github.io"
+SECRET = b"test-secret"
+DEBOUNCE = 0.2
+
+
+def fixture(name: str) -> Any:
+    return json.loads((FIXTURES / name).read_text())
+
+
+def pull_request_payload(pr_number: int) -> dict[str, Any]:
+    """A pull_request labeled delivery for the first-party fixture, renumbered"""
+    pr = fixture("first-party.pr.json")
+    pr["number"] = pr_number
+
+    return {
+        "action": "labeled",
+        "number": pr_number,
+        "label": {"name": "automerge"},
+        "pull_request": pr,
+        "repository": pr["base"]["repo"],
+        "sender": pr["user"],
+    }
+
+
+def review_payload(pr_number: int) -> dict[str, Any]:
+    """A pull_request_review submitted delivery for the third-party fixtures, renumbered"""
+    pr = fixture("third-party.pr.json")
+    pr["number"] = pr_number
+
+    return {
+        "action": "submitted",
+        "review": fixture("third-party.pr-reviews.json")[0],
+        "pull_request": pr,
+        "repository": pr["base"]["repo"],
+        "sender": pr["user"],
+    }
+
+
+class ListenerTest(unittest.TestCase):
+    api_url: str
+
+    @classmethod
+    def setUpClass(cls) -> None:
+        cls.api_url = cls.enterClassContext(
+            running_server(SyntheticRepoSpec(repo=REPO, prs=20, merge_pending=1.0))
+        )
+        cls.enterClassContext(
+            mock.patch.dict(os.environ, {"GITHUB_API_URL": cls.api_url, "GH_TOKEN": "test"})
+        )
+
+    def setUp(self) -> None:
+        params = listen.ListenParams(
+            host="127.0.0.1",
+            port=0,
+            repos=[REPO],
+            secret_env="UNUSED",
+            debounce=DEBOUNCE,
+            dry_run=True,
+        )
+        self.server = listen.serve(params, SECRET)
+        self.addCleanup(listen.shutdown, self.server)
+
+        request_counts(self.api_url, reset=True)
+
+    def post(
+        self,
+        event: str,
+        body: bytes,
+        *,
+        delivery: str | None = None,
+        signature: str | None = None,
+        headers: dict[str, str] | None = None,
+    ) -> tuple[int, str]:
+        host, port = self.server.server_address[:2]
+        connection = HTTPConnection(str(host), port, timeout=5)
+        self.addCleanup(connection.close)
+
+        if signature is None:
+            signature = "sha256=" + hmac.new(SECRET, body, hashlib.sha256).hexdigest()
+
+        connection.putrequest("POST", "/")
+        for name, value in {
+            "Content-Type": "application/json",
+            "Content-Length": str(len(body)),
+            "X-GitHub-Event": event,
+            "X-GitHub-Delivery": delivery or str(uuid.uuid4()),
+            "X-Hub-Signature-256": signature,
+            **(headers or {}),
+        }.items():
+            connection.putheader(name, value)
+        connection.endheaders(body)
+
+        response = connection.getresponse()
+        return response.status, response.read().decode().strip()
+
+    def post_json(self, event: str, payload: Any, **kwargs: Any) -> tuple[int, str]:
+        return self.post(event, json.dumps(payload).encode(), **kwargs)
+
+    def wait_for_evaluations(self) -> dict[str, int]:
+        """Wait for the debouncer to run what's been scheduled, returning the API requests made
+
+        Evaluations can schedule more work, so that's once nothing is due and the API has seen
+        no requests for a while.
+        """
+        deadline = time.monotonic() + 30
+        requests: dict[str, int] = {}
+        quiet_since = time.monotonic()
+
+        while time.monotonic() < deadline:
+            time.sleep(0.1)
+
+            if (latest := dict(request_counts(self.api_url))) != requests:
+                requests, quiet_since = latest, time.monotonic()
+            elif (
+                not self.server.listener.debouncer.pending()
+                and time.monotonic() - quiet_since > DEBOUNCE + 0.5
+            ):
+                break
+
+        return requests
+
+    def test_pull_request_event_is_evaluated(self) -> None:
+        self.assertEqual(
+            self.post_json("pull_request", pull_request_payload(3)), (202, "scheduled 1")
+        )
+
+        requests = self.wait_for_evaluations()
+        self.assertEqual(requests.get("GET get pull"), 1)
+        self.assertEqual(requests.get("GET list reviews"), 1)
+
+    def test_review_event_is_evaluated(self) -> None:
+        self.assertEqual(
+            self.post_json("pull_request_review", review_payload(4)), (202, "scheduled 1")
+        )
+        self.assertEqual(self.wait_for_evaluations().get("GET get pull"), 1)
+
+    def test_burst_is_debounced(self) -> None:
+        for payload in [pull_request_payload(5), review_payload(5), pull_request_payload(5)]:
+            self.assertEqual(self.post_json("pull_request", payload)[0], 202)
+
+        self.assertEqual(self.wait_for_evaluations().get("GET get pull"), 1)
+
+    def test_label_event_schedules_candidates(self) -> None:
+        payload = {"action": "edited", "label": {"name": "automerge"}}
+        payload["repository"] = pull_request_payload(1)["repository"]
+
+        self.assertEqual(self.post_json("label", payload), (202, "scheduled 1"))
+
+        # Every synthetic pull request is merge-pending
+        requests = self.wait_for_evaluations()
+        self.assertEqual(requests.get("GET list pulls"), 1)
+        self.assertEqual(requests.get("GET get pull"), 20)
+
+    def test_duplicate_delivery(self) -> None:
+        delivery = str(uuid.uuid4())
+        payload = pull_request_payload(6)
+
+        self.assertEqual(self.post_json("pull_request", payload, delivery=delivery)[0], 202)
+        self.assertEqual(
+            self.post_json("pull_request", payload, delivery=delivery),
+            (202, "duplicate delivery"),
+        )
+
+    def test_invalid_signature(self) -> None:
+        status, _ = self.post_json(
+            "pull_request", pull_request_payload(7), signature="sha256=" + "0" * 64
+        )
+        self.assertEqual(status, 401)
+        self.assertEqual(self.server.listener.debouncer.pending(), 0)
+
+    def test_ping(self) -> None:
+        self.assertEqual(
+            self.post_json("ping", {"zen": "Keep it logically awesome."}), (200, "pong")
+        )
+
+    def test_unhandled_event(self) -> None:
+        self.assertEqual(self.post_json("star", {}), (202, "ignored star event"))
+
+    def test_unexpected_repository(self) -> None:
+        payload = pull_request_payload(8)
+        payload["repository"] = {**payload["repository"], "full_name": "someone/else"}
+
+        self.assertEqual(self.post_json("pull_request", payload), (202, "scheduled 0"))
+
+    def test_null_repository(self) -> None:
+        payload = pull_request_payload(9)
+        payload["repository"] = None
+
+        self.assertEqual(self.post_json("pull_request", payload), (202, "scheduled 0"))
+
+    def test_invalid_payload(self) -> None:
+        self.assertEqual(self.post("pull_request", b"{"), (400, "invalid payload"))
+        self.assertEqual(self.post_json("pull_request", []), (400, "invalid payload"))
+
+    def test_negative_content_length(self) -> None:
+        status, _ = self.post("pull_request", b"", headers={"Content-Length": "-1"})
+        self.assertEqual(status, 400)
+
+    def test_oversized_payload(self) -> None:
+        too_long = str(listen.MAX_PAYLOAD_BYTES + 1)
+        status, _ = self.post("pull_request", b"", headers={"Content-Length": too_long})
+        self.assertEqual(status, 413)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,143 @@
+"""Merging a pull request locally when its base has moved since the build"""
+
+from __future__ import annotations
+
+import contextlib
+import json
+import os
+from pathlib import Path
+import tempfile
+import unittest
+from unittest import mock
+
+from integration_tools.commands import deploy_commit
+from integration_tools.gh_state import PullRequestEvaluation
+from integration_tools.merge_deploy.revision_info import RevisionInfo
+from local_remote import GIT_IDENTITY, LocalRemote, git
+
+PR_NUMBER = 7
+
+
+class LocalMergeTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self.local = LocalRemote(Path(self.enterContext(tempfile.TemporaryDirectory())))
+        self.enterContext(mock.patch.dict(os.environ, GIT_IDENTITY))
+
+        self.built_base = self.local.commit_source({"README": "first\n", "a.md": "a\n"})
+        self.head = self.local.commit_source(
+            {"b.md": "b\n"}, branch="feature", base=self.built_base
+        )
+
+        # The build merged the head into the base as it was then
+        self.built_merge = self.merge_in_source(self.built_base, self.head)
+
+    def merge_in_source(self, base: str, head: str) -> str:
+        git("checkout", "-q", "--detach", base, cwd=self.local.source)
+        git("merge", "-q", "--no-edit", head, cwd=self.local.source)
+        return git("rev-parse", "HEAD", cwd=self.local.source)
+
+    def move_base(self, files: dict[str, str]) -> str:
+        return self.local.commit_source(files, base=self.built_base)
+
+    def prepare(self, base: str, *, head: str | None = None, tree: str | None = None) -> str | None:
+        """Fetch the refs as deploy-commit does, then try merging locally in the clone
+
+        The built revision is the merge of the original head into the base it was built from, with
+        its own tree unless another is given. The current head is the original one unless another
+        is given.
+        """
+        head = head or self.head
+        clone = self.local.clone
+        git("init", "-q", str(clone), cwd=self.local.root)
+        self.enterContext(contextlib.chdir(clone))
+
+        url = f"file://{self.local.remote}"
+        git("fetch", "-q", "--depth=1", url, "+develop:refs/remotes/origin/develop", cwd=clone)
+        for depth_arg in ["--shallow-exclude=refs/heads/develop", "--deepen=1"]:
+            git("fetch", "-q", depth_arg, url, "+feature:refs/remotes/origin/feature", cwd=clone)
+
+        revisions = self.local.root / "site.revisions.json"
+        revisions.write_text(
+            json.dumps(
+                {
+                    "head_ref": "feature",
+                    "head_sha": self.head,
+                    "base_ref": "develop",
+                    "base_ref_sha": self.built_base,
+                    "sha": self.built_merge,
+                    "tree": tree or git("rev-parse", f"{self.built_merge}^{{tree}}", cwd=clone),
+                }
+            )
+        )
+
+        params = deploy_commit.DeployParams(
+            remote=url,
+            repo="owner/repo",
+            head_ref="feature",
+            base_ref="develop",
+            effective_event="pull_request",
+            pr_number=PR_NUMBER,
+            run_url="https://example.com/run",
+            deploy_dir=None,
+            deploy_revision_info=revisions,
+            deploy_manifest=None,
+            outputs_file=None,
+            metrics_file=None,
+            speculative=False,
+            local_merge=True,
+            mergeability_wait=0,
+            deadline=0,
+            dry_run=False,
+        )
+        pr_eval = PullRequestEvaluation(
+            raw="{}",
+            head_ref="feature",
+            head_sha=head,
+            base_ref="develop",
+            merge_sha=None,
+            labels=[],
+            merge_pending_label_present=False,
+            pr_is_eligible=True,
+            pr_may_be_eligible=True,
+            pr_eligibility={},
+        )
+        current = RevisionInfo(head_ref="feature", head_sha=head, base_ref="develop", base_sha=base)
+
+        return deploy_commit.prepare_local_merge_commit(params, pr_eval, current=current)
+
+    def test_clean_merge(self) -> None:
+        base = self.move_base({"c.md": "c\n"})
+        merged = self.merge_in_source(base, self.head)
+        tree = git("rev-parse", f"{merged}^{{tree}}", cwd=self.local.source)
+
+        merge_commit = self.prepare(base, tree=tree)
+
+        assert merge_commit is not None
+        parents = git("rev-list", "--parents", "-n1", merge_commit, cwd=self.local.clone)
+        self.assertEqual(parents.split(), [merge_commit, base, self.head])
+        self.assertEqual(git("rev-parse", f"{merge_commit}^{{tree}}", cwd=self.local.clone), tree)
+        self.assertEqual(
+            git("log", "-1", "--format=%s", merge_commit, cwd=self.local.clone),
+            f"Merge pull request #{PR_NUMBER} from feature",
+        )
+
+    def test_conflicting_merge(self) -> None:
+        base = self.move_base({"b.md": "conflicting\n"})
+
+        self.assertIsNone(self.prepare(base))
+
+    def test_tree_mismatch(self) -> None:
+        # A clean merge, but not of what was built: the new base's change is missing from it
+        base = self.move_base({"c.md": "c\n"})
+
+        self.assertIsNone(self.prepare(base))
+
+    def test_head_changed(self) -> None:
+        base = self.move_base({"c.md": "c\n"})
+        head = self.local.commit_source({"b.md": "b again\n"}, branch="feature")
+
+        self.assertIsNone(self.prepare(base, head=head))
+
+
+if __name__ == "__main__":
+    unittest.main()
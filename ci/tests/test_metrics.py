@@ -0,0 +1,71 @@
+"""Deploy metrics written by separate runs and merged for reporting"""
+
+from __future__ import annotations
+
+from pathlib import Path
+import subprocess
+import sys
+import tempfile
+import unittest
+
+from integration_tools import metrics
+from integration_tools.metrics import MetricsStore, RunRecorder
+
+
+def finished_run(pr_number: int, outcome: metrics.Outcome) -> RunRecorder:
+    run = RunRecorder(repo="owner/repo", event="pull_request", pr_number=pr_number)
+
+    with metrics.recording(run), metrics.phase("evaluate"):
+        metrics.set_outcome(outcome)
+
+    return run
+
+
+class ImportTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self.tmp = Path(self.enterContext(tempfile.TemporaryDirectory()))
+
+        # Two overlapping runs, each with a file of its own; the second was attempted twice
+        self.files = [self.tmp / "run-1" / "runs.jsonl", self.tmp / "run-2" / "runs.jsonl"]
+
+        metrics.append_record(self.files[0], finished_run(1, "deployed"))
+        metrics.append_record(self.files[1], finished_run(2, "failed"))
+        metrics.append_record(self.files[1], finished_run(2, "deployed"))
+
+    def test_import(self) -> None:
+        store = MetricsStore(self.tmp / "metrics.sqlite3")
+
+        self.assertEqual([store.import_records(path) for path in self.files], [1, 2])
+
+        runs = store.runs_since(0)
+        self.assertEqual(
+            [(row["pr_number"], row["outcome"]) for row in runs],
+            [(1, "deployed"), (2, "failed"), (2, "deployed")],
+        )
+        self.assertEqual([row["phase"] for row in store.phases_since(0)], ["evaluate"] * 3)
+
+    def test_import_again(self) -> None:
+        store = MetricsStore(self.tmp / "metrics.sqlite3")
+        store.import_records(self.files[1])
+
+        # As when a later report imports every run's file, including those imported before
+        self.assertEqual([store.import_records(path) for path in self.files], [1, 0])
+        self.assertEqual(len(store.runs_since(0)), 3)
+        self.assertEqual(len(store.phases_since(0)), 3)
+
+    def test_report(self) -> None:
+        report = subprocess.run(
+            [sys.executable, "-m", "integration_tools", "metrics"]
+            + ["--db", str(self.tmp / "metrics.sqlite3"), "--import", *map(str, self.files)],
+            check=True,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            text=True,
+        )
+
+        self.assertIn("imported 3 runs from 2 files", report.stdout)
+        self.assertIn("Outcomes: deployed 2, failed 1", report.stdout)
+
+
+if __name__ == "__main__":
+    unittest.main()
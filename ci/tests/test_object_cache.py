@@ -0,0 +1,63 @@
+"""Updating the object cache from the working repository's own fetches"""
+
+from __future__ import annotations
+
+import contextlib
+from pathlib import Path
+import tempfile
+import unittest
+
+from integration_tools.object_cache import CACHE_REF_ROOT, ObjectCache
+from local_remote import LocalRemote, git
+
+
+class UpdateTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self.local = LocalRemote(Path(self.enterContext(tempfile.TemporaryDirectory())))
+        self.local.commit_source({"README": "first\n"})
+        self.local.commit_source({"README": "second\n"})
+
+        self.cache = ObjectCache(self.local.root / "cache" / "objects.git")
+
+    def cache_refs(self) -> dict[str, str]:
+        refs = git("for-each-ref", "--format=%(refname) %(objectname)", cwd=self.cache.path)
+        return dict(line.split(" ") for line in refs.splitlines())
+
+    def test_update_from_clone(self) -> None:
+        self.local.update_clone()
+        self.enterContext(contextlib.chdir(self.local.clone))
+        master = git("rev-parse", "refs/remotes/origin/master", cwd=self.local.clone)
+
+        # Anything the cache fetched from the remote itself would fail
+        self.local.remote.rename(self.local.root / "moved.git")
+
+        with self.cache.attached():
+            self.cache.update("origin", {"master": "refs/remotes/origin/master"})
+
+        [(ref, sha)] = self.cache_refs().items()
+        self.assertTrue(ref.startswith(f"{CACHE_REF_ROOT}/"), ref)
+        self.assertTrue(ref.endswith("/master"), ref)
+        self.assertEqual(sha, master)
+
+    def test_shallow_branch(self) -> None:
+        shallow = self.local.root / "shallow"
+        git(
+            "clone",
+            "-q",
+            "--depth=1",
+            f"file://{self.local.remote}",
+            str(shallow),
+            cwd=self.local.root,
+        )
+        self.enterContext(contextlib.chdir(shallow))
+
+        with self.cache.attached():
+            self.cache.update("origin", {"develop": "refs/remotes/origin/develop"})
+
+        # The branch is left out rather than the cache becoming shallow
+        self.assertEqual(self.cache_refs(), {})
+        self.assertFalse((self.cache.path / "shallow").exists())
+
+
+if __name__ == "__main__":
+    unittest.main()
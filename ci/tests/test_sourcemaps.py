@@ -0,0 +1,216 @@
+"""Sourcemap uploads for a deploy, against a stub sentry-cli which records what it's given"""
+
+from __future__ import annotations
+
+import contextlib
+import json
+import os
+from pathlib import Path
+import subprocess
+import tempfile
+import textwrap
+from typing import Any
+import unittest
+from unittest import mock
+
+from integration_tools.commands import deploy_commit
+from integration_tools.merge_deploy import sourcemaps
+
+# Records its arguments and the files in the directory it's asked to upload, one file per call
+# since batches are uploaded concurrently
+STUB_SENTRY_CLI = textwrap.dedent("""\
+    #!/usr/bin/env python3
+    import json, os, sys, tempfile
+    from pathlib import Path
+
+    args = sys.argv[1:]
+    files = {}
+    if args[:2] == ["sourcemaps", "upload"]:
+        root = Path(args[-1])
+        files = {
+            str(p.relative_to(root)): p.stat().st_size for p in root.rglob("*") if p.is_file()
+        }
+
+    fd, _ = tempfile.mkstemp(dir=os.environ["SENTRY_STUB_LOG"], suffix=".json")
+    with os.fdopen(fd, "w") as f:
+        json.dump({"args": args, "files": files}, f)
+    """)
+
+DEBUG_ID = "//# debugId=85314830-023f-4cf1-a267-535f4e37bb17\n"
+
+
+class SourcemapUploadTest(unittest.TestCase):
+    def setUp(self) -> None:
+        tmp = Path(self.enterContext(tempfile.TemporaryDirectory()))
+
+        self.repo = tmp / "repo"
+        self.log_dir = tmp / "log"
+        bin_dir = tmp / "bin"
+
+        self.log_dir.mkdir()
+        bin_dir.mkdir()
+        stub = bin_dir / "sentry-cli"
+        stub.write_text(STUB_SENTRY_CLI)
+        stub.chmod(0o755)
+
+        self.enterContext(
+            mock.patch.dict(
+                os.environ,
+                {
+                    "PATH": f"{bin_dir}{os.pathsep}{os.environ['PATH']}",
+                    "SENTRY_STUB_LOG": str(self.log_dir),
+                },
+            )
+        )
+
+        subprocess.run(["git", "init", "-q", str(self.repo)], check=True)
+        self.enterContext(contextlib.chdir(self.repo))
+
+        self.params = deploy_commit.DeployParams(
+            remote="origin",
+            repo="owner/repo",
+            head_ref="feature",
+            base_ref="develop",
+            effective_event="push",
+            pr_number=None,
+            run_url="https://example.com/run",
+            deploy_dir=self.repo,
+            deploy_revision_info=None,
+            deploy_manifest=None,
+            outputs_file=None,
+            metrics_file=None,
+            speculative=False,
+            local_merge=False,
+            mergeability_wait=0,
+            deadline=0,
+            dry_run=False,
+        )
+
+    def commit(self, files: dict[str, str]) -> str:
+        """Commit home-assets with exactly the given files, returning the commit"""
+        subprocess.run(["git", "rm", "-rq", "--ignore-unmatch", "home-assets"], check=True)
+
+        for path, content in files.items():
+            dest = self.repo / "home-assets" / path
+            dest.parent.mkdir(parents=True, exist_ok=True)
+            dest.write_text(content)
+
+        subprocess.run(["git", "add", "-A"], check=True)
+        subprocess.run(
+            ["git", "-c", "user.name=Test", "-c", "user.email=test@example.com"]
+            + ["commit", "-q", "--allow-empty", "-m", "Deploy"],
+            check=True,
+        )
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"], check=True, capture_output=True, text=True
+        ).stdout.strip()
+
+    def deploy(self, previous: dict[str, str], current: dict[str, str]) -> list[dict[str, Any]]:
+        """Upload for a deploy of current following previous, returning the stub's calls"""
+        previous_commit = self.commit(previous)
+        subprocess.run(
+            ["git", "update-ref", self.params.remote_branch_ref("master"), previous_commit],
+            check=True,
+        )
+
+        deploy_commit.prepare_sentry_deploy(self.params, "release-1", self.commit(current))
+
+        return [json.loads(p.read_text()) for p in sorted(self.log_dir.iterdir())]
+
+    def uploads(self, calls: list[dict[str, Any]]) -> list[dict[str, int]]:
+        uploads = [c for c in calls if c["args"][:2] == ["sourcemaps", "upload"]]
+
+        for call in uploads:
+            self.assertEqual(
+                call["args"][2:-1], ["--release=release-1", "--url-prefix", "/home-assets"]
+            )
+
+        return [call["files"] for call in uploads]
+
+    def test_unchanged_groups(self) -> None:
+        files = {
+            "plain.js": "plain();\n",
+            "plain.js.map": "{}",
+            "debug-id.js": "debugId();\n" + DEBUG_ID,
+            "debug-id.js.map": "{}",
+            "style.css.map": "{}",
+            "style.css": "body {}",
+        }
+
+        uploads = self.uploads(self.deploy(files, files))
+
+        # Only the bundle without a debug ID is attached to the new release again
+        self.assertEqual(len(uploads), 1)
+        self.assertEqual(sorted(uploads[0]), ["plain.js", "plain.js.map"])
+
+    def test_changed_groups(self) -> None:
+        previous = {
+            "changed.js": "before();\n" + DEBUG_ID,
+            "changed.js.map": "{}",
+            "same-map.js": "sameMap();\n" + DEBUG_ID,
+            "same-map.js.map": '{"version": 3}',
+            "removed.js": "removed();\n",
+        }
+        current = {
+            "changed.js": "after();\n" + DEBUG_ID,
+            "changed.js.map": "{}",
+            "same-map.js": "sameMap();\n" + DEBUG_ID,
+            "same-map.js.map": '{"version": 3, "names": []}',
+            "chunks/new.js": "added();\n" + DEBUG_ID,
+            "chunks/new.js.map": "{}",
+        }
+
+        uploads = self.uploads(self.deploy(previous, current))
+        uploaded = sorted(path for files in uploads for path in files)
+
+        # A group is uploaded whole if either file changed, and the staged layout keeps the
+        # paths relative to the assets directory
+        self.assertEqual(
+            uploaded,
+            [
+                "changed.js",
+                "changed.js.map",
+                "chunks/new.js",
+                "chunks/new.js.map",
+                "same-map.js",
+                "same-map.js.map",
+            ],
+        )
+        for files in uploads:
+            self.assertEqual(len({path.removesuffix(".map") for path in files}), 1)
+
+    def test_nothing_to_upload(self) -> None:
+        files = {"debug-id.js": "debugId();\n" + DEBUG_ID, "debug-id.js.map": "{}"}
+
+        calls = self.deploy(files, files)
+
+        self.assertEqual(self.uploads(calls), [])
+        self.assertEqual([c["args"][:2] for c in calls], [["releases", "new"]])
+
+    def test_batches(self) -> None:
+        # Groups of different sizes, more of them than there are workers
+        sizes = [4000, 3000, 2500, 2000, 1500, 1000, 500, 250]
+        current = {}
+        for i, size in enumerate(sizes):
+            current[f"bundle-{i}.js"] = "x" * size
+            current[f"bundle-{i}.js.map"] = "{}"
+
+        uploads = self.uploads(self.deploy({}, current))
+
+        self.assertEqual(len(uploads), sourcemaps.UPLOAD_WORKERS)
+
+        # Every planned file is uploaded exactly once, alongside its sourcemap
+        uploaded = [path for files in uploads for path in files]
+        self.assertEqual(sorted(uploaded), sorted(current))
+        for files in uploads:
+            self.assertEqual(
+                {p for p in files if p.endswith(".map")},
+                {f"{p}.map" for p in files if p.endswith(".js")},
+            )
+
+        # Largest first into the smallest batch so far: 4002 | 3002+502+252 | 2502+1002 | 2002+1502
+        self.assertEqual(sorted(sum(files.values()) for files in uploads), [3504, 3504, 3756, 4002])
+
+
+if __name__ == "__main__":
+    unittest.main()
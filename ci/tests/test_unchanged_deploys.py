@@ -0,0 +1,146 @@
+"""Deploys whose site only differs from master in what the build stamps into it"""
+
+from __future__ import annotations
+
+import contextlib
+from pathlib import Path
+import tempfile
+import unittest
+
+from integration_tools.merge_deploy import site_stamps
+from local_remote import LocalRemote, git
+
+
+def site(body: str, built_at: str) -> dict[str, str]:
+    """Files of a site stamped the way the real build stamps it"""
+    return {
+        "index.html": f'<meta name="version" content="{{release}}">\n<p>{body}</p>\n',
+        "home-assets/app.min.js": f'var release="{{release}}";render("{body}");\n',
+        "feed.xml": (
+            f"<feed><updated>{built_at}</updated>"
+            "<entry><updated>2020-01-01T00:00:00Z</updated></entry></feed>\n"
+        ),
+        "logo.svg": "<svg/>\n",
+    }
+
+
+class UnchangedDeployTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self.local = LocalRemote(Path(self.enterContext(tempfile.TemporaryDirectory())))
+
+        first = self.local.commit_source({"README": "first\n"})
+        self.local.update_clone()
+        self.local.push_deploy(first, site("Hello", "2024-01-01T00:00:00Z"))
+
+        self.master = self.local.remote_git("rev-parse", "master")
+
+    def test_same_content_from_new_source(self) -> None:
+        ci_only = self.local.commit_source({".github/workflows/ci.yml": "on: push\n"})
+        self.local.update_clone()
+
+        output = self.local.push_deploy(ci_only, site("Hello", "2024-01-02T00:00:00Z"))
+
+        self.assertIn("matches master apart from build stamps", output)
+        self.assertEqual(self.local.remote_git("rev-parse", "master"), self.master)
+        self.assertEqual(self.local.remote_git("rev-parse", "develop"), ci_only)
+
+        # The source commit is recorded against the deploy already serving it
+        tag = f"deploy/unchanged/2-{ci_only}"
+        self.assertEqual(self.local.remote_git("rev-parse", f"{tag}^{{commit}}"), self.master)
+
+        # A second build of the same commit finds that record
+        output = self.local.push_deploy(ci_only, site("Hello", "2024-01-03T00:00:00Z"), "again")
+        self.assertIn(f"already deployed via {self.master} ({tag})", output)
+        self.assertEqual(self.local.remote_git("rev-parse", "master"), self.master)
+
+    def test_changed_content_from_new_source(self) -> None:
+        change = self.local.commit_source({"content/index.md": "Hello again\n"})
+        self.local.update_clone()
+
+        self.local.push_deploy(change, site("Hello again", "2024-01-02T00:00:00Z"))
+
+        master = self.local.remote_git("rev-parse", "master")
+        self.assertEqual(self.local.remote_git("rev-parse", f"{master}^"), self.master)
+        self.assertEqual(
+            self.local.remote_git("rev-parse", f"deploy/master/3-{change}^{{commit}}"), master
+        )
+
+        # Redeploying the build is recognised by its deploy tag
+        output = self.local.push_deploy(change, site("Hello again", "2024-01-02T00:00:00Z"), "2")
+        self.assertIn(f"already deployed via {master} (deploy/master/3-{change})", output)
+
+
+class SameSiteTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self.repo = Path(self.enterContext(tempfile.TemporaryDirectory()))
+        git("init", "-q", str(self.repo), cwd=self.repo)
+        self.enterContext(contextlib.chdir(self.repo))
+
+    def tree(self, release_version: str | None, files: dict[str, str]) -> str:
+        """Write a tree of the given files, with .test-meta.json if there's a release version"""
+        with tempfile.TemporaryDirectory() as index_dir:
+            env = {"GIT_INDEX_FILE": f"{index_dir}/index"}
+
+            if release_version is not None:
+                files = {
+                    **{p: c.replace("{release}", release_version) for p, c in files.items()},
+                    site_stamps.TEST_META_PATH: f'{{"release_version": "{release_version}"}}\n',
+                }
+
+            for path, content in files.items():
+                blob = git("hash-object", "-w", "--stdin", cwd=self.repo, env=env, input=content)
+                git(
+                    "update-index",
+                    "--add",
+                    "--cacheinfo",
+                    f"100644,{blob},{path}",
+                    cwd=self.repo,
+                    env=env,
+                )
+
+            return git("write-tree", cwd=self.repo, env=env)
+
+    def test_stamps_masked(self) -> None:
+        self.assertTrue(
+            site_stamps.same_site(
+                self.tree("a+tree:1", site("Hello", "2024-01-01T00:00:00Z")),
+                self.tree("b+tree:2", site("Hello", "2024-01-02T00:00:00Z")),
+            )
+        )
+
+    def test_content_change(self) -> None:
+        self.assertFalse(
+            site_stamps.same_site(
+                self.tree("a+tree:1", site("Hello", "2024-01-01T00:00:00Z")),
+                self.tree("b+tree:2", site("Hello again", "2024-01-01T00:00:00Z")),
+            )
+        )
+
+    def test_unstamped_file_change(self) -> None:
+        files = site("Hello", "2024-01-01T00:00:00Z")
+
+        self.assertFalse(
+            site_stamps.same_site(
+                self.tree("a+tree:1", files),
+                self.tree("a+tree:1", {**files, "logo.svg": "<svg></svg>\n"}),
+            )
+        )
+
+    def test_feed_entry_change(self) -> None:
+        files = site("Hello", "2024-01-01T00:00:00Z")
+        changed = {**files, "feed.xml": files["feed.xml"].replace("2020-01-01", "2021-01-01")}
+
+        self.assertFalse(
+            site_stamps.same_site(self.tree("a+tree:1", files), self.tree("b+tree:2", changed))
+        )
+
+    def test_without_release_version(self) -> None:
+        files = site("Hello", "2024-01-01T00:00:00Z")
+        tree = self.tree(None, {p: c.replace("{release}", "") for p, c in files.items()})
+
+        self.assertTrue(site_stamps.same_site(tree, tree))
+        self.assertFalse(site_stamps.same_site(self.tree("a+tree:1", files), tree))
+
+
+if __name__ == "__main__":
+    unittest.main()
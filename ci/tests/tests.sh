@@ -0,0 +1,23 @@
+#!/bin/bash
+
+#
+# Run the integration_tools tests
+#
+# Tests run against local stand-ins (a synthetic GitHub API, bare git remotes, stub commands) and
+# need nothing beyond git, jq and the Python standard library. Arguments are passed on to
+# unittest, e.g. `ci/tests/tests.sh -k listen`.
+#
+
+set -euo pipefail
+
+cd "$(dirname "$0")"
+
+echo >&2 "Running in $(pwd)"
+echo >&2
+
+export PYTHONPATH="$(cd .. && pwd)${PYTHONPATH:+:$PYTHONPATH}"
+
+# Keep the tools' caches and logs out of the environment the tests run in
+unset CI_TOOLS_CACHE_DIR CI_TOOLS_LOG_DIR GITHUB_API_URL GITHUB_REPOSITORY GH_TOKEN GH_BOT_TOKEN
+
+exec python3 -m unittest discover --start-directory . --pattern 'test_*.py' "$@"